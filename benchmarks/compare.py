@@ -0,0 +1,55 @@
+"""
+Compare two result files written by benchmarks/load.py
+
+Prints throughput and latency of every endpoint measured in both runs, with
+the change from the baseline in percent.
+
+Usage:
+    python benchmarks/compare.py baseline.json candidate.json
+"""
+import argparse
+import json
+from typing import Any, Dict, Tuple
+
+METRICS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+
+def load(path: str) -> Tuple[Dict[str, Any], Dict[Tuple[int, str, str], Dict[str, Any]]]:
+    """Read a result file, indexing its results by (rows, target, endpoint)"""
+    with open(path) as f:
+        report = json.load(f)
+    results = {
+        (result["rows"], result["target"], result["endpoint"]): result for result in report["results"]
+    }
+    return report, results
+
+def change(baseline: float, candidate: float) -> str:
+    if not baseline:
+        return "n/a"
+    return f"{(candidate - baseline) / baseline * 100:+.1f}%"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+
+    baseline_report, baseline = load(args.baseline)
+    candidate_report, candidate = load(args.candidate)
+    print(f"baseline {baseline_report.get('commit')} vs candidate {candidate_report.get('commit')}")
+    if baseline_report["config"] != candidate_report["config"]:
+        print(f"warning: configurations differ: {baseline_report['config']} vs {candidate_report['config']}")
+
+    header = f"{'rows':>9} {'endpoint':<26}" + "".join(f"{metric:>24}" for metric in METRICS)
+    print(header)
+    for key in sorted(baseline.keys() & candidate.keys()):
+        rows, _, endpoint = key
+        cells = [
+            f"{candidate[key][metric]:>10.2f} ({change(baseline[key][metric], candidate[key][metric]):>8})"
+            for metric in METRICS
+        ]
+        print(f"{rows:>9} {endpoint:<26}" + "".join(f"{cell:>24}" for cell in cells))
+    for key in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"only in {'baseline' if key in baseline else 'candidate'}: {key[0]} {key[2]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Load and latency benchmark of Service A and of the Service B -> A path
+
+Seeds Service A's SQLite database with each requested number of rows, then
+sends a fixed number of requests to every endpoint with a fixed concurrency
+and reports throughput and p50/p95/p99 latency. By default both apps run in
+this process behind httpx's ASGI transport (Service B calls Service A through
+it as well); `--server uvicorn` or `--server gunicorn` launches real server
+processes instead. Results are written as JSON so runs can be compared
+between commits with benchmarks/compare.py.
+
+Usage:
+    python benchmarks/load.py [--rows 1000,100000] [--requests 500] [--concurrency 16]
+        [--server inprocess|uvicorn|gunicorn] [--workers 2] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from services import ROOT, module
+
+# Seeded values look like "item 42 tag0042": searching for a tag matches
+# about one row in TAG_COUNT
+TAG_COUNT = 10000
+SEED_BATCH_SIZE = 10000
+SEARCH_TAG = "tag0042"
+
+# /proxy-items returns the whole table, so it is only measured up to this size
+MAX_FULL_LIST_ROWS = 10000
+
+def seed_database(path: str, rows: int) -> str:
+    """
+    Create a Service A database with `rows` items, reusing it if it already has them
+
+    Args:
+        path: SQLite file to create
+        rows: Number of items
+
+    Returns:
+        The database URL
+    """
+    models = module("service_a", "models")
+    url = f"sqlite:///{path}"
+    engine = create_engine(url)
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        existing = connection.execute(select(func.count()).select_from(models.Item)).scalar()
+    if existing != rows:
+        print(f"seeding {rows} rows into {path}", file=sys.stderr)
+        models.Base.metadata.drop_all(bind=engine)
+        models.Base.metadata.create_all(bind=engine)
+        generator = random.Random(rows)
+        with engine.begin() as connection:
+            for start in range(0, rows, SEED_BATCH_SIZE):
+                batch = [
+                    {"value": f"item {i} tag{generator.randrange(TAG_COUNT):04d}"}
+                    for i in range(start, min(start + SEED_BATCH_SIZE, rows))
+                ]
+                connection.execute(insert(models.Item), batch)
+    engine.dispose()
+    return url
+
+def endpoints(rows: int) -> List[Tuple[str, str, Callable[[random.Random], Dict[str, Any]]]]:
+    """
+    The requests to measure for a database of `rows` items
+
+    Returns:
+        (target, name, build) tuples, where build returns httpx request
+        arguments for a random generator
+    """
+    pagination = module("service_a", "pagination")
+    middle_cursor = pagination.encode_cursor(rows // 2)
+
+    def random_ids(generator: random.Random, count: int) -> List[int]:
+        return [generator.randint(1, rows) for _ in range(count)]
+
+    measured = [
+        ("service_a", "GET /items", lambda g: {"method": "GET", "url": "/items", "params": {"limit": 100}}),
+        ("service_a", "GET /items?cursor", lambda g: {
+            "method": "GET", "url": "/items", "params": {"limit": 100, "cursor": middle_cursor}
+        }),
+        ("service_a", "GET /items/{id}", lambda g: {"method": "GET", "url": f"/items/{g.randint(1, rows)}"}),
+        ("service_a", "GET /items/search", lambda g: {
+            "method": "GET", "url": "/items/search", "params": {"q": SEARCH_TAG}
+        }),
+        ("service_a", "GET /items/count", lambda g: {"method": "GET", "url": "/items/count"}),
+        ("service_a", "POST /items/lookup", lambda g: {
+            "method": "POST", "url": "/items/lookup", "json": {"ids": random_ids(g, 100)}
+        }),
+        ("service_b", "GET /proxy-items/{id}", lambda g: {
+            "method": "GET", "url": f"/proxy-items/{g.randint(1, rows)}"
+        }),
+        ("service_b", "GET /proxy-items/search", lambda g: {
+            "method": "GET", "url": "/proxy-items/search", "params": {"q": SEARCH_TAG}
+        }),
+        ("service_b", "GET /proxy-items/count", lambda g: {"method": "GET", "url": "/proxy-items/count"}),
+        ("service_b", "GET /proxy-items/batch", lambda g: {
+            "method": "GET", "url": "/proxy-items/batch",
+            "params": {"ids": ",".join(map(str, random_ids(g, 100)))},
+        }),
+    ]
+    if rows <= MAX_FULL_LIST_ROWS:
+        measured.append(("service_b", "GET /proxy-items", lambda g: {"method": "GET", "url": "/proxy-items"}))
+    return measured
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not sorted_values:
+        return float("nan")
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+async def measure(
+    client: httpx.AsyncClient,
+    build: Callable[[random.Random], Dict[str, Any]],
+    requests: int,
+    concurrency: int,
+) -> Dict[str, Any]:
+    """
+    Send `requests` requests with `concurrency` in flight and summarize their latencies
+
+    Returns:
+        Request and error counts, throughput in requests per second and
+        latency percentiles in milliseconds
+    """
+    generator = random.Random(0)
+    arguments = [build(generator) for _ in range(requests)]
+    latencies: List[float] = []
+    errors = 0
+    next_index = 0
+
+    async def worker() -> None:
+        nonlocal errors, next_index
+        while next_index < len(arguments):
+            request = arguments[next_index]
+            next_index += 1
+            start = time.perf_counter()
+            try:
+                response = await client.request(**request)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+async def run_in_process(url: str, rows: int, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Benchmark both apps in this process, with Service B calling Service A over ASGI"""
+    db = module("service_a", "db")
+    a_app = module("service_a", "main").app
+    b_client = module("service_b", "client")
+    b_app = module("service_b", "main").app
+
+    # Serve this database instead of the one the app was imported with
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+    db.configure_engine(engine, "benchmark")
+    session_factory = sessionmaker(autoflush=False, bind=engine)
+
+    def override_get_db():
+        db_session = session_factory()
+        try:
+            yield db_session
+        finally:
+            db_session.close()
+
+    a_app.dependency_overrides[db.get_db] = override_get_db
+    b_client.cache.clear()
+    b_client._client = b_client.create_client(transport=httpx.ASGITransport(app=a_app))
+    clients = {
+        "service_a": httpx.AsyncClient(transport=httpx.ASGITransport(app=a_app), base_url="http://service-a"),
+        "service_b": httpx.AsyncClient(transport=httpx.ASGITransport(app=b_app), base_url="http://service-b"),
+    }
+    try:
+        return await run_endpoints(clients, rows, args)
+    finally:
+        for client in clients.values():
+            await client.aclose()
+        await b_client.close_client()
+        a_app.dependency_overrides.clear()
+        engine.dispose()
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _launch(service: str, port: int, env: Dict[str, str], args: argparse.Namespace) -> subprocess.Popen:
+    """Start a service with uvicorn or gunicorn and wait until /health answers"""
+    if args.server == "gunicorn":
+        command = [
+            "gunicorn", "app.main:app", "--workers", str(args.workers),
+            "--worker-class", "uvicorn.workers.UvicornWorker", "--bind", f"127.0.0.1:{port}",
+        ]
+    else:
+        command = [
+            sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+            "--workers", str(args.workers), "--log-level", "warning",
+        ]
+    process = subprocess.Popen(command, cwd=ROOT / service, env={**os.environ, **env})
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{service} exited with status {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{service} did not become healthy")
+
+async def run_servers(url: str, rows: int, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Benchmark both services running as separate server processes"""
+    a_port, b_port = _free_port(), _free_port()
+    processes = []
+    with tempfile.TemporaryDirectory() as metrics_a, tempfile.TemporaryDirectory() as metrics_b:
+        try:
+            processes.append(_launch("service_a", a_port, {"DATABASE_URL": url, "PROMETHEUS_MULTIPROC_DIR": metrics_a}, args))
+            processes.append(_launch(
+                "service_b", b_port,
+                {"SERVICE_A_BASE_URL": f"http://127.0.0.1:{a_port}", "PROMETHEUS_MULTIPROC_DIR": metrics_b},
+                args,
+            ))
+            limits = httpx.Limits(max_connections=args.concurrency)
+            clients = {
+                "service_a": httpx.AsyncClient(base_url=f"http://127.0.0.1:{a_port}", limits=limits),
+                "service_b": httpx.AsyncClient(base_url=f"http://127.0.0.1:{b_port}", limits=limits),
+            }
+            try:
+                return await run_endpoints(clients, rows, args)
+            finally:
+                for client in clients.values():
+                    await client.aclose()
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+async def run_endpoints(
+    clients: Dict[str, httpx.AsyncClient], rows: int, args: argparse.Namespace
+) -> List[Dict[str, Any]]:
+    """Warm up and measure every endpoint against the given clients"""
+    results = []
+    for target, name, build in endpoints(rows):
+        if args.endpoint and not any(pattern in name for pattern in args.endpoint):
+            continue
+        await measure(clients[target], build, args.warmup, args.concurrency)
+        result = await measure(clients[target], build, args.requests, args.concurrency)
+        result = {"rows": rows, "target": target, "endpoint": name, **result}
+        print(
+            f"{rows:>9} {name:<26} {result['throughput_rps']:>9.1f} req/s  p50 {result['p50_ms']:>8.2f} ms"
+            f"  p95 {result['p95_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  errors {result['errors']}"
+        )
+        results.append(result)
+    return results
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", default="1000", help="comma-separated database sizes, e.g. 1000,100000,1000000")
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--server", choices=["inprocess", "uvicorn", "gunicorn"], default="inprocess")
+    parser.add_argument("--workers", type=int, default=2, help="server worker processes")
+    parser.add_argument("--endpoint", action="append", help="only endpoints whose name contains this (repeatable)")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "items-benchmark"),
+                        help="where seeded databases are kept between runs")
+    parser.add_argument("--b-cache", action="store_true", help="enable Service B's response cache (1 s fresh, 5 s stale unless set)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.rows.split(",")]
+    os.makedirs(args.data_dir, exist_ok=True)
+    paths = {rows: os.path.join(args.data_dir, f"items-{rows}.db") for rows in sizes}
+
+    # Settings are read when the apps are imported, so set them first. Point
+    # Service A at a seeded database so importing it does not create one in
+    # the working directory.
+    os.environ["DATABASE_URL"] = f"sqlite:///{paths[sizes[0]]}"
+    if args.b_cache:
+        os.environ.setdefault("SERVICE_B_CACHE_TTL", "1")
+        os.environ.setdefault("SERVICE_B_CACHE_STALE_TTL", "5")
+        print("Service B results include its cache hits and coalesced requests", file=sys.stderr)
+    else:
+        # Measure the B -> A path rather than Service B's cache
+        os.environ["SERVICE_B_CACHE_TTL"] = "0"
+        os.environ["SERVICE_B_CACHE_STALE_TTL"] = "0"
+
+    urls = {rows: seed_database(path, rows) for rows, path in paths.items()}
+
+    results = []
+    for rows in sizes:
+        run = run_in_process if args.server == "inprocess" else run_servers
+        results.extend(asyncio.run(run(urls[rows], rows, args)))
+
+    if args.output:
+        report = {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "server": args.server,
+                "workers": args.workers if args.server != "inprocess" else 1,
+                "requests": args.requests,
+                "warmup": args.warmup,
+                "concurrency": args.concurrency,
+                "b_cache": args.b_cache,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Micro-benchmark of the default and fast serialization paths
+
+Measures the per-item cost of building a list page in Service A (query,
+validation and JSON encoding) and of handling it in Service B (decoding,
+transforming and encoding again), with and without the fast path, and the
+size and parse time of a page in the JSON and columns wire formats.
+
+Usage:
+    python benchmarks/serialization.py [--items 1000] [--repeat 20]
+"""
+import argparse
+import json
+import time
+from typing import Callable
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from services import module
+
+crud = module("service_a", "crud")
+models = module("service_a", "models")
+schemas = module("service_a", "schemas")
+a_serialization = module("service_a", "serialization")
+b_client = module("service_b", "client")
+b_serialization = module("service_b", "serialization")
+
+def per_item_us(fn: Callable[[], object], items: int, repeat: int) -> float:
+    """Best time of `repeat` calls of fn, in microseconds per item"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best / items * 1e6
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=1000, help="items per page")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per measurement (best is kept)")
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(models.Item), [{"value": f"item number {i}"} for i in range(args.items)]
+        )
+    db_session = Session(bind=engine)
+
+    def service_a_default() -> bytes:
+        # What FastAPI does with the ORM page: validate through the response
+        # model, dump it to JSON-compatible data and encode it
+        _, page = crud.read_items(db_session, 0, args.items, None, None)
+        db_session.expunge_all()
+        data = schemas.ItemList.model_validate(page).model_dump(mode="json")
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def service_a_fast() -> bytes:
+        _, page = crud.read_items(db_session, 0, args.items, None, None, True)
+        items = a_serialization.item_dicts(page["items"])
+        return a_serialization.dumps({"items": items, "next_cursor": page["next_cursor"]})
+
+    def service_a_columns() -> bytes:
+        _, page = crud.read_items(db_session, 0, args.items, None, None, True)
+        columns = a_serialization.item_columns(page["items"])
+        return a_serialization.dumps({**columns, "next_cursor": page["next_cursor"]})
+
+    body = service_a_fast()
+
+    def service_b_default() -> bytes:
+        # Decode as httpx does, transform, then encode as FastAPI does for a
+        # returned dict
+        data = b_client.transform_items(json.loads(body))
+        return json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def service_b_fast() -> bytes:
+        return b_serialization.dumps(b_client.transform_items(b_serialization.loads(body)))
+
+    encoder = "orjson" if a_serialization.orjson is not None else "json (orjson not installed)"
+    print(f"{args.items} items per page, best of {args.repeat}, encoder: {encoder}")
+    print(f"{'path':<12}{'default us/item':>18}{'fast us/item':>16}{'speedup':>10}")
+    for name, default, fast in [
+        ("service_a", service_a_default, service_a_fast),
+        ("service_b", service_b_default, service_b_fast),
+    ]:
+        default_us = per_item_us(default, args.items, args.repeat)
+        fast_us = per_item_us(fast, args.items, args.repeat)
+        print(f"{name:<12}{default_us:>18.2f}{fast_us:>16.2f}{default_us / fast_us:>9.1f}x")
+
+    print()
+    print(f"{'format':<12}{'bytes/item':>18}{'encode us/item':>16}{'parse us/item':>16}")
+    for name, encode in [("json", service_a_fast), ("columns", service_a_columns)]:
+        payload = encode()
+        encode_us = per_item_us(encode, args.items, args.repeat)
+        parse_us = per_item_us(lambda: b_serialization.loads(payload), args.items, args.repeat)
+        print(f"{name:<12}{len(payload) / args.items:>18.1f}{encode_us:>16.2f}{parse_us:>16.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Helpers to import both services side by side in one process"""
+import importlib
+import importlib.util
+import sys
+from pathlib import Path
+from types import ModuleType
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def load_service(name: str) -> ModuleType:
+    """
+    Import a service's `app` package under the name `<name>_app`
+
+    Both services call their package `app`, so they cannot be imported
+    normally in the same process. Settings are read from the environment at
+    import time, so set them before calling this.
+
+    Args:
+        name: Directory of the service, e.g. "service_a"
+
+    Returns:
+        The imported package; its modules are available with `module()`
+    """
+    package_name = f"{name}_app"
+    if package_name in sys.modules:
+        return sys.modules[package_name]
+    path = ROOT / name / "app"
+    spec = importlib.util.spec_from_file_location(
+        package_name, path / "__init__.py", submodule_search_locations=[str(path)]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[package_name] = package
+    spec.loader.exec_module(package)
+    return package
+
+def module(service: str, name: str) -> ModuleType:
+    """Import a module of a service loaded with load_service, e.g. ("service_a", "crud")"""
+    load_service(service)
+    return importlib.import_module(f"{service}_app.{name}")
@@ -0,0 +1,117 @@
+"""
+Measure how fast each service starts and becomes ready
+
+Every run starts a fresh interpreter per service, on a new empty database,
+and reports how long importing the app took, how long its lifespan took to
+make /ready answer 200, and for Service A the latency of the first request
+compared to warm ones. Medians over the runs are printed; with the --max-*
+options the script exits with status 1 when a median is over its limit, so
+CI can catch startup regressions.
+
+Usage:
+    python benchmarks/startup.py --runs 5 --max-import-ms 2000 --max-ready-ms 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+SERVICES = ("service_a", "service_b")
+
+# Requests timed once the service is ready, to compare with the first one
+WARM_REQUESTS = 20
+
+async def _measure_ready(app: Any) -> Dict[str, float]:
+    import httpx
+
+    metrics: Dict[str, float] = {}
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.001)
+            metrics["ready_ms"] = (time.perf_counter() - start) * 1000
+
+            if "/items" in {route.path for route in app.routes}:
+                latencies = []
+                for _ in range(WARM_REQUESTS + 1):
+                    request_start = time.perf_counter()
+                    (await client.get("/items", params={"limit": 10})).raise_for_status()
+                    latencies.append((time.perf_counter() - request_start) * 1000)
+                metrics["first_request_ms"] = latencies[0]
+                metrics["warm_request_ms"] = statistics.median(latencies[1:])
+    return metrics
+
+def child(service: str) -> None:
+    """Import a service and time its startup; runs in the fresh interpreter"""
+    start = time.perf_counter()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from services import module
+
+    app = module(service, "main").app
+    metrics = {"import_ms": (time.perf_counter() - start) * 1000}
+    metrics.update(asyncio.run(_measure_ready(app)))
+    print(json.dumps(metrics))
+
+def run(service: str, data_dir: str) -> Dict[str, float]:
+    """Start one service in a new interpreter and return its measurements"""
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(data_dir, 'items.db')}",
+        # Nothing listens there, so Service B's warm-up fails fast
+        SERVICE_A_BASE_URL="http://127.0.0.1:9",
+    )
+    env.pop("SERVICE_A_BASE_URLS", None)
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", service],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    metrics = json.loads(output.strip().splitlines()[-1])
+    metrics["process_ms"] = (time.perf_counter() - start) * 1000
+    return metrics
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=3, help="fresh starts per service")
+    parser.add_argument("--service", choices=SERVICES, action="append", help="only this service (repeatable)")
+    parser.add_argument("--max-import-ms", type=float, help="fail if a median import time is above this")
+    parser.add_argument("--max-ready-ms", type=float, help="fail if a median time to /ready is above this")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--child", choices=SERVICES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    results: Dict[str, Dict[str, float]] = {}
+    for service in args.service or SERVICES:
+        runs: List[Dict[str, float]] = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as data_dir:
+                runs.append(run(service, data_dir))
+        results[service] = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+
+    failures = []
+    for service, metrics in results.items():
+        print(f"{service}: " + ", ".join(f"{metric} {value:.1f}" for metric, value in metrics.items()))
+        for metric, limit in (("import_ms", args.max_import_ms), ("ready_ms", args.max_ready_ms)):
+            if limit is not None and metrics[metric] > limit:
+                failures.append(f"{service} {metric} {metrics[metric]:.1f} > {limit:.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"runs": args.runs, "results": results}, f, indent=2)
+    if failures:
+        print("startup regression: " + "; ".join(failures))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# This file makes the service_common directory a Python package
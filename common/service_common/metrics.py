@@ -0,0 +1,187 @@
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Counter, Gauge and Histogram are used by the services through this module
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Directory shared by the gunicorn workers of one server, read by
+# prometheus_client when it is imported. When set, every worker records its
+# metrics in files there and /metrics reports those of all workers, so a
+# scrape gives the same totals whichever worker answers it. Counters and
+# histograms are added up; gauges are combined as their `multiprocess_mode`
+# says (e.g. "livesum", "livemax", or "liveall" to keep one sample per
+# worker, labelled with its pid). Empty it before the server starts, since
+# counters of exited workers are kept.
+METRICS_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Seconds between two updates of the sampled gauges (e.g. pool sizes) by
+# each worker when METRICS_DIR is set; otherwise they are updated on scrape
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Content type of the Prometheus text format written by generate_latest
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Functions that update gauges (e.g. pool sizes) right before they are read
+_collectors: List[Callable[[], None]] = []
+
+def register_collector(collector: Callable[[], None]) -> None:
+    """Register a function setting gauges that are sampled rather than updated as things happen"""
+    _collectors.append(collector)
+
+def _collect() -> None:
+    for collector in _collectors:
+        collector()
+
+_collector_pid: Optional[int] = None
+
+def ensure_collector() -> None:
+    """
+    Start the thread updating the sampled gauges of this process, with METRICS_DIR
+
+    Another worker may answer the scrape, so each one keeps its own sampled
+    gauges up to date. Called on every request, so it also starts in
+    workers forked after the app was imported.
+    """
+    global _collector_pid
+    if _collector_pid == os.getpid() or not METRICS_DIR:
+        return
+    _collector_pid = os.getpid()
+
+    def run() -> None:
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                _collect()
+            except Exception:
+                pass
+
+    threading.Thread(target=run, name="metrics-collector", daemon=True).start()
+
+# Files of per-process gauges, e.g. gauge_livesum_1234.db
+_LIVE_GAUGE_FILE = re.compile(r"^gauge_live\w+_(\d+)\.db$")
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _forget_exited_workers() -> None:
+    """Drop the live gauges of workers that exited, since they no longer describe anything"""
+    pids = set()
+    for filename in os.listdir(METRICS_DIR):
+        match = _LIVE_GAUGE_FILE.match(filename)
+        if match:
+            pids.add(int(match.group(1)))
+    for pid in pids:
+        if not _process_alive(pid):
+            multiprocess.mark_process_dead(pid, METRICS_DIR)
+
+def render() -> bytes:
+    """Render the metrics of this process, or of all workers with METRICS_DIR, in the Prometheus text format"""
+    _collect()
+    if not METRICS_DIR:
+        return generate_latest(REGISTRY)
+    _forget_exited_workers()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, METRICS_DIR)
+    return generate_latest(registry)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route"), buckets=DEFAULT_BUCKETS
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests being served by route", ("method", "route"),
+    multiprocess_mode="livesum",
+)
+
+# Route label of requests that matched no route, so unknown paths do not
+# create new label values
+UNMATCHED_ROUTE = "<unmatched>"
+
+# Route templates remembered per method and path by each middleware, so the
+# routes are matched once per distinct request rather than on every one.
+# Paths with parameters (e.g. /items/1) each take an entry: the cache is
+# emptied when it reaches this size.
+ROUTE_CACHE_SIZE = int(os.getenv("METRICS_ROUTE_CACHE_SIZE", "1024"))
+
+def _route(scope: Dict[str, Any]) -> str:
+    """
+    Template of the route a request goes to (e.g. /items/{item_id})
+
+    The router only records it once it runs, so the routes are matched here
+    the same way: the first full match, else the first path match with
+    another method, which the router answers with a 405.
+    """
+    from starlette.routing import Match
+
+    app = scope.get("app")
+    partial: Optional[str] = None
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match is Match.FULL:
+            return route.path
+        if match is Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial if partial is not None else UNMATCHED_ROUTE
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request counts, latencies and requests in progress
+
+    Requests are labelled with their method and route template. Latency
+    covers the whole response, including streamed bodies.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+        self._routes: Dict[Tuple[str, str], str] = {}
+
+    def _route(self, scope: Dict[str, Any]) -> str:
+        """Route template of a request, from the cache (the routes only match on method and path)"""
+        key = (scope["method"], scope["path"])
+        route = self._routes.get(key)
+        if route is None:
+            route = _route(scope)
+            if len(self._routes) >= ROUTE_CACHE_SIZE:
+                self._routes.clear()
+            self._routes[key] = route
+        return route
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        ensure_collector()
+
+        labels: Tuple[str, str] = (scope["method"], self._route(scope))
+        status_code = 500
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(*labels)
+        in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            in_progress.dec()
+            HTTP_REQUESTS.labels(*labels, str(status_code)).inc()
+            HTTP_REQUEST_DURATION.labels(*labels).observe(duration)
@@ -0,0 +1,392 @@
+import asyncio
+import atexit
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+# Opt-in request tracing. A traced request records how long it spent in
+# each span (e.g. database queries, calls to Service A) and, once it has run
+# for TRACE_SLOW_MS, a stack sample every TRACE_PROFILE_INTERVAL_MS. The
+# trace ID is taken from the X-Trace-Id request header, or created for
+# TRACE_SAMPLE_RATE of the requests without one, and sent along with calls
+# to other services. Finished traces are kept in memory for /traces (the
+# last TRACE_BUFFER_SIZE) and, when TRACE_FILE is set, appended to it as
+# JSON lines by a background thread, so requests never wait for the disk.
+# With tracing off, spans cost a context variable lookup.
+TRACING = os.getenv("TRACING", "false").lower() in ("1", "true", "yes")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "250"))
+TRACE_PROFILE_INTERVAL_MS = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "5"))
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+
+TRACE_HEADER = "X-Trace-Id"
+
+# Traced responses to a request that carried a trace ID report their spans
+# in this header, so the caller can show them within its own trace
+SERVER_TIMING_HEADER = "Server-Timing"
+
+# Trace IDs accepted from callers; others are replaced by a new one
+_TRACE_ID = re.compile(r"^[0-9A-Za-z-]{1,64}$")
+
+# Frames kept per stack sample, counted from the innermost
+MAX_STACK_DEPTH = 64
+
+# Server-Timing description of spans whose duration is inferred rather than
+# timed (see Trace.add_phases)
+ESTIMATED = "estimated"
+
+class Trace:
+    """
+    Spans and stack samples of one request
+
+    Span starts are offsets from the start of the request, in seconds.
+    `estimated` holds the names of spans that were inferred rather than
+    timed. `threads` holds the threads running one of the trace's
+    synchronous spans and how many are open in each, for the profiler.
+    """
+
+    def __init__(self, trace_id: str, service: str, method: str, path: str):
+        self.trace_id = trace_id
+        self.service = service
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.estimated: Set[str] = set()
+        self.threads: Dict[int, int] = {}
+        self.task = asyncio.current_task()
+        self.samples: Counter = Counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def add_phases(self, response_start: float) -> None:
+        """
+        Add the spans before the first and after the last recorded span
+
+        The first stands for receiving and validating the request (`parse`),
+        the last for rendering the response (`serialize`). Neither is timed:
+        they are the gaps around the recorded spans, including whatever else
+        ran there (e.g. middlewares, waiting for the event loop), so they are
+        marked as estimates.
+        """
+        if not self.spans:
+            return
+        first = min(start for _, start, _ in self.spans)
+        last = max(start + duration for _, start, duration in self.spans)
+        self.spans.insert(0, ("parse", 0.0, first))
+        self.spans.append(("serialize", last, max(response_start - self.start - last, 0.0)))
+        self.estimated.update(("parse", "serialize"))
+
+    def server_timing(self) -> str:
+        """The spans' total durations by name, as a Server-Timing header value, estimates described as such"""
+        totals: Dict[str, float] = {}
+        for name, _, duration in self.spans:
+            totals[name] = totals.get(name, 0.0) + duration
+        totals["total"] = self.elapsed()
+        return ", ".join(
+            f'{name};desc="{ESTIMATED}";dur={duration * 1000:.3f}' if name in self.estimated
+            else f"{name};dur={duration * 1000:.3f}"
+            for name, duration in totals.items()
+        )
+
+class _Span:
+    """Context manager timing one span of a trace"""
+
+    __slots__ = ("trace", "name", "sync", "start", "thread")
+
+    def __init__(self, trace: Trace, name: str, sync: bool):
+        self.trace = trace
+        self.name = name
+        self.sync = sync
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+        if self.sync:
+            self.thread = threading.get_ident()
+            with _lock:
+                self.trace.threads[self.thread] = self.trace.threads.get(self.thread, 0) + 1
+
+    def __exit__(self, *exc_info: Any) -> None:
+        end = time.perf_counter()
+        if self.sync:
+            with _lock:
+                depth = self.trace.threads.pop(self.thread) - 1
+                if depth:
+                    self.trace.threads[self.thread] = depth
+        self.trace.spans.append((self.name, self.start - self.trace.start, end - self.start))
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_NOOP = nullcontext()
+_lock = threading.Lock()
+_active: Set[Trace] = set()
+_finished: Deque[Dict[str, Any]] = deque(maxlen=TRACE_BUFFER_SIZE)
+_sampler_pid: Optional[int] = None
+
+def current() -> Optional[Trace]:
+    """Trace of the current request, or None if it is not traced"""
+    return _current.get()
+
+def span(name: str, sync: bool = True) -> Any:
+    """
+    Time a block as a span of the current trace, if any
+
+    Args:
+        name: Span name, e.g. "query"
+        sync: Whether the block runs without awaiting, so the profiler samples
+            the thread running it rather than where the request's task waits
+    """
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, sync)
+
+T = TypeVar("T")
+
+def wrap(name: str, fn: Callable[..., T]) -> Callable[..., T]:
+    """Make `fn` a span of the current trace wherever it runs, e.g. in the threadpool"""
+    trace = _current.get()
+    if trace is None:
+        return fn
+
+    def run(*args: Any) -> T:
+        with _Span(trace, name, True):
+            return fn(*args)
+
+    return run
+
+def add_remote_spans(service: str, server_timing: Optional[str], start: float) -> None:
+    """
+    Add the spans another service reported in its Server-Timing header
+
+    They are named `<service>.<name>` and placed at `start` (a
+    perf_counter time), since the header only carries durations. Spans
+    described as estimates stay marked as such.
+    """
+    trace = _current.get()
+    if trace is None or not server_timing:
+        return
+    for metric in server_timing.split(","):
+        name, *params = (part.strip() for part in metric.split(";"))
+        values = dict(param.partition("=")[::2] for param in params)
+        if name == "total" or "dur" not in values:
+            continue
+        try:
+            duration = float(values["dur"]) / 1000
+        except ValueError:
+            continue
+        trace.spans.append((f"{service}.{name}", start - trace.start, duration))
+        if values.get("desc", "").strip('"') == ESTIMATED:
+            trace.estimated.add(f"{service}.{name}")
+
+def _fold(frames: List[Any]) -> str:
+    """A stack, outermost frame first, in the folded format of flame graph tools"""
+    return ";".join(
+        f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}" for frame in frames[-MAX_STACK_DEPTH:]
+    )
+
+def _thread_stack(frame: Any) -> List[Any]:
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+def _task_stack(task: asyncio.Task) -> List[Any]:
+    """Frames of a task's coroutine and of each coroutine it awaits, down to where it waits"""
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return frames
+
+def _sample(trace: Trace, frames: Dict[int, Any]) -> None:
+    """Record where a slow request is: in its synchronous spans' threads, else where its task waits"""
+    with _lock:
+        threads = list(trace.threads)
+    stacks = [_thread_stack(frames[thread]) for thread in threads if thread in frames]
+    if not stacks and trace.task is not None and not trace.task.done():
+        stacks = [_task_stack(trace.task)]
+    folded = [_fold(stack) for stack in stacks]
+    with _lock:
+        trace.samples.update(folded)
+
+def _run_sampler() -> None:
+    own = threading.get_ident()
+    while True:
+        time.sleep(TRACE_PROFILE_INTERVAL_MS / 1000)
+        with _lock:
+            slow = [trace for trace in _active if trace.elapsed() * 1000 >= TRACE_SLOW_MS]
+        if not slow:
+            continue
+        frames = sys._current_frames()
+        frames.pop(own, None)
+        for trace in slow:
+            _sample(trace, frames)
+
+def _ensure_sampler() -> None:
+    """Start the profiler thread, once per process (also in forked workers)"""
+    global _sampler_pid
+    if _sampler_pid == os.getpid() or TRACE_SLOW_MS <= 0 or TRACE_PROFILE_INTERVAL_MS <= 0:
+        return
+    _sampler_pid = os.getpid()
+    threading.Thread(target=_run_sampler, name="trace-sampler", daemon=True).start()
+
+def _record(trace: Trace, status_code: int) -> Dict[str, Any]:
+    duration = trace.elapsed()
+    record = {
+        "trace_id": trace.trace_id,
+        "service": trace.service,
+        "method": trace.method,
+        "path": trace.path,
+        "status": status_code,
+        "started_at": trace.started_at,
+        "duration_ms": duration * 1000,
+        "slow": TRACE_SLOW_MS > 0 and duration * 1000 >= TRACE_SLOW_MS,
+        "spans": [
+            {"name": name, "start_ms": start * 1000, "duration_ms": span_duration * 1000}
+            for name, start, span_duration in trace.spans
+        ],
+    }
+    for span_record in record["spans"]:
+        if span_record["name"] in trace.estimated:
+            span_record["estimated"] = True
+    with _lock:
+        profile = dict(trace.samples.most_common())
+    if profile:
+        record["profile"] = profile
+    return record
+
+# Records waiting to be appended to TRACE_FILE, and the process whose
+# writer thread reads them
+_writes: "Optional[queue.Queue[Optional[Dict[str, Any]]]]" = None
+_writer_pid: Optional[int] = None
+
+def _run_writer(writes: "queue.Queue[Optional[Dict[str, Any]]]") -> None:
+    """Append records to TRACE_FILE as they come, all those waiting at once, until told to stop with None"""
+    while True:
+        records = [writes.get()]
+        while True:
+            try:
+                records.append(writes.get_nowait())
+            except queue.Empty:
+                break
+        lines = [json.dumps(record) + "\n" for record in records if record is not None]
+        if lines:
+            try:
+                with open(TRACE_FILE, "a") as f:
+                    f.writelines(lines)
+            except OSError:
+                pass
+        if None in records:
+            return
+
+def _ensure_writer() -> "queue.Queue[Optional[Dict[str, Any]]]":
+    """Start the TRACE_FILE writer thread, once per process (also in forked workers)"""
+    global _writes, _writer_pid
+    if _writer_pid != os.getpid() or _writes is None:
+        _writes, _writer_pid = queue.Queue(), os.getpid()
+        writer = threading.Thread(target=_run_writer, args=(_writes,), name="trace-writer", daemon=True)
+        writer.start()
+        atexit.register(_stop_writer, _writes, writer)
+    return _writes
+
+def _stop_writer(writes: "queue.Queue[Optional[Dict[str, Any]]]", writer: threading.Thread) -> None:
+    """Write the records still waiting before the process exits"""
+    writes.put(None)
+    writer.join(timeout=5)
+
+def _store(record: Dict[str, Any]) -> None:
+    _finished.append(record)
+    if TRACE_FILE:
+        _ensure_writer().put(record)
+
+def recent(limit: int = 50, slow: bool = False, trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Finished traces of this process, newest first"""
+    traces = []
+    for record in reversed(_finished):
+        if (slow and not record["slow"]) or (trace_id is not None and record["trace_id"] != trace_id):
+            continue
+        traces.append(record)
+        if len(traces) >= limit:
+            break
+    return traces
+
+def clear() -> None:
+    """Forget the finished traces"""
+    _finished.clear()
+
+def _trace_id(scope: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+    """The caller's trace ID, or a new one for sampled requests, and whether it came from the caller"""
+    for name, value in scope.get("headers", ()):
+        if name == b"x-trace-id":
+            trace_id = value.decode("latin-1")
+            if _TRACE_ID.match(trace_id):
+                return trace_id, True
+    if random.random() < TRACE_SAMPLE_RATE:
+        return uuid.uuid4().hex, False
+    return None, False
+
+class TracingMiddleware:
+    """
+    Pure ASGI middleware tracing requests when TRACING is enabled
+
+    Traced responses carry the trace ID, and when the caller sent one, the
+    spans in a Server-Timing header.
+    """
+
+    def __init__(self, app: Any, service: str):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if not TRACING or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace_id, propagated = _trace_id(scope)
+        if trace_id is None:
+            await self.app(scope, receive, send)
+            return
+        _ensure_sampler()
+
+        trace = Trace(trace_id, self.service, scope["method"], scope["path"])
+        status_code = 500
+
+        async def send_with_trace(message: Dict[str, Any]) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                trace.add_phases(time.perf_counter())
+                headers = [*message.get("headers", []), (b"x-trace-id", trace_id.encode("latin-1"))]
+                if propagated:
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _current.set(trace)
+        with _lock:
+            _active.add(trace)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            with _lock:
+                _active.discard(trace)
+            _current.reset(token)
+            _store(_record(trace, status_code))
@@ -0,0 +1,10 @@
+from setuptools import setup, find_packages
+
+setup(
+    name="service_common",
+    version="0.1.0",
+    packages=find_packages(),
+    install_requires=[
+        "prometheus_client>=0.16.0",
+    ],
+)
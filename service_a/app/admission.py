@@ -0,0 +1,243 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+from fastapi.responses import JSONResponse
+
+from service_common import metrics
+
+from . import deadlines
+
+# Admission control (off unless ADMISSION_CONTROL is set) limits how many
+# requests each worker serves at once. Reads and writes have separate limits
+# that adapt to the observed latency: a request slower than
+# ADMISSION_LATENCY_TARGET_MS or failing with a 5XX shrinks the limit by
+# ADMISSION_BACKOFF (at most once per target interval), and requests served
+# on time while the limit is in use grow it by one per limit's worth of
+# requests. Requests cut short by their caller's deadline say nothing about
+# the worker and leave the limit alone. Requests over the limit wait in a
+# queue of at most ADMISSION_QUEUE_SIZE for a bounded time, then get a 503
+# with Retry-After. Reads give up sooner than writes, so they are shed first.
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "false").lower() in ("1", "true", "yes")
+ADMISSION_LATENCY_TARGET_MS = float(os.getenv("ADMISSION_LATENCY_TARGET_MS", "250"))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", "0.9"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "1"))
+ADMISSION_READ_LIMIT = int(os.getenv("ADMISSION_READ_LIMIT", "20"))
+ADMISSION_READ_MAX_LIMIT = int(os.getenv("ADMISSION_READ_MAX_LIMIT", "100"))
+ADMISSION_READ_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_READ_QUEUE_TIMEOUT_MS", "100"))
+ADMISSION_WRITE_LIMIT = int(os.getenv("ADMISSION_WRITE_LIMIT", "4"))
+ADMISSION_WRITE_MAX_LIMIT = int(os.getenv("ADMISSION_WRITE_MAX_LIMIT", "16"))
+ADMISSION_WRITE_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_WRITE_QUEUE_TIMEOUT_MS", "500"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "50"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# Never limited: probes and scrapes must answer even when the worker is
+# overloaded, and long polls of the change feed mostly sleep
+EXEMPT_PATHS = {"/health", "/ready", "/metrics", "/items/changes"}
+
+# Limited, but too long by nature to say anything about the worker's load
+UNTIMED_PATHS = {"/items/export"}
+
+# Requests with these methods, and these POSTs, only read
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+READ_POST_PATHS = {"/items/lookup"}
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit with a bounded FIFO queue, adjusted by AIMD on latency
+
+    The limit is kept as a float so additive increases can be fractional;
+    int(limit) requests are admitted at once.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        latency_target: float,
+        queue_size: int,
+        queue_timeout: float,
+        backoff: float = 0.9,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self._clock = clock
+        self.inflight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_decrease = float("-inf")
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for a slot, for at most `timeout` seconds (queue_timeout by default)
+
+        Returns:
+            True if the request was admitted and must call release, False if
+            the queue was full or the wait timed out
+        """
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter}, timeout=self.queue_timeout if timeout is None else timeout)
+        except BaseException:
+            # Cancelled while queued: give back the slot if it was handed over
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+        if waiter.done():
+            return True
+        waiter.cancel()
+        self._waiters.remove(waiter)
+        self.rejected += 1
+        return False
+
+    def release(self, latency: Optional[float] = None, failed: bool = False) -> None:
+        """
+        Free a slot and adapt the limit to how the request went
+
+        Args:
+            latency: Seconds the request took once admitted, or None to not
+                adapt the limit
+            failed: Whether the request failed with a server error
+        """
+        in_use = self.inflight
+        self.inflight -= 1
+        if latency is not None:
+            now = self._clock()
+            if failed or latency > self.latency_target:
+                if now - self._last_decrease >= self.latency_target:
+                    self.limit = max(float(self.minimum), self.limit * self.backoff)
+                    self._last_decrease = now
+            elif in_use * 2 >= self.limit:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+        while self._waiters and self.inflight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.inflight += 1
+            waiter.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "inflight": self.inflight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+        }
+
+# One limiter per request class in each worker
+limiters = {
+    "read": AdaptiveLimiter(
+        ADMISSION_READ_LIMIT, ADMISSION_MIN_LIMIT, ADMISSION_READ_MAX_LIMIT,
+        ADMISSION_LATENCY_TARGET_MS / 1000, ADMISSION_QUEUE_SIZE,
+        ADMISSION_READ_QUEUE_TIMEOUT_MS / 1000, ADMISSION_BACKOFF,
+    ),
+    "write": AdaptiveLimiter(
+        ADMISSION_WRITE_LIMIT, ADMISSION_MIN_LIMIT, ADMISSION_WRITE_MAX_LIMIT,
+        ADMISSION_LATENCY_TARGET_MS / 1000, ADMISSION_QUEUE_SIZE,
+        ADMISSION_WRITE_QUEUE_TIMEOUT_MS / 1000, ADMISSION_BACKOFF,
+    ),
+}
+
+# Limits are per worker, so every worker's are kept
+ADMISSION_STATE = metrics.Gauge(
+    "admission_requests", "Concurrency limit, requests in flight and queued by request class", ("class", "stat"),
+    multiprocess_mode="liveall",
+)
+ADMISSION_REJECTED_TOTAL = metrics.Counter(
+    "admission_rejected_total", "Requests shed with a 503 by request class", ("class",)
+)
+
+def _collect_admission_stats() -> None:
+    for name, limiter in limiters.items():
+        ADMISSION_STATE.labels(name, "limit").set(limiter.limit)
+        ADMISSION_STATE.labels(name, "inflight").set(limiter.inflight)
+        ADMISSION_STATE.labels(name, "queued").set(limiter.queued)
+
+metrics.register_collector(_collect_admission_stats)
+
+def request_class(method: str, path: str) -> Optional[str]:
+    """The limiter a request goes through, or None if it is exempt"""
+    if path in EXEMPT_PATHS:
+        return None
+    if method in READ_METHODS or (method == "POST" and path in READ_POST_PATHS):
+        return "read"
+    return "write"
+
+def overloaded_response() -> JSONResponse:
+    return JSONResponse(
+        {"detail": "Service overloaded, retry later"},
+        status_code=503,
+        headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+    )
+
+class AdmissionMiddleware:
+    """
+    Pure ASGI middleware admitting requests through the limiter of their class
+
+    The wait in the queue is also bounded by the request's deadline. The
+    latency fed back to the limiter runs from admission to the end of the
+    response; deadline 504s (with DEADLINE_EXCEEDED_HEADER) are not fed back.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        name = request_class(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if not ADMISSION_CONTROL or name is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = limiters[name]
+        timeout = limiter.queue_timeout
+        budget = deadlines.current()
+        if budget is not None and budget.deadline is not None:
+            timeout = min(timeout, max(budget.deadline - time.monotonic(), 0.0))
+        if not await limiter.acquire(timeout):
+            ADMISSION_REJECTED_TOTAL.labels(name).inc()
+            await overloaded_response()(scope, receive, send)
+            return
+
+        status_code = 500
+        deadline_exceeded = False
+        exceeded_header = deadlines.DEADLINE_EXCEEDED_HEADER.lower().encode()
+
+        async def send_with_status(message: Any) -> None:
+            nonlocal status_code, deadline_exceeded
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                deadline_exceeded = any(name.lower() == exceeded_header for name, _ in message.get("headers", ()))
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            latency = None
+            if scope["path"] not in UNTIMED_PATHS and not deadline_exceeded:
+                latency = time.perf_counter() - start
+            limiter.release(latency, failed=status_code >= 500)
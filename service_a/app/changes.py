@@ -0,0 +1,80 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import models, db, deadlines
+
+# How often a long poll checks the change log for new entries, and the
+# longest a client may ask it to wait
+CHANGES_POLL_INTERVAL_MS = float(os.getenv("CHANGES_POLL_INTERVAL_MS", "100"))
+CHANGES_MAX_WAIT = float(os.getenv("CHANGES_MAX_WAIT", "30"))
+
+def read_changes(db_session: Session, since: Optional[int], limit: int) -> Dict[str, Any]:
+    """
+    Get the changes logged after a sequence number
+
+    The read transaction is ended before returning, so the next poll on the
+    same session sees changes committed in the meantime.
+
+    Args:
+        db_session: Database session
+        since: Sequence number of the last change the client has applied, or
+            None to only get the current one
+        limit: Maximum number of changes to return
+
+    Returns:
+        Dict with the `changes` in sequence order and the `last_seq` to pass
+        as `since` next time
+
+    Raises:
+        HTTPException: 410 if changes after `since` were already pruned, or
+            `since` is ahead of the log (e.g. the database was replaced)
+    """
+    try:
+        head = db_session.query(func.max(models.ItemChange.seq)).scalar() or 0
+        if since is None:
+            return {"changes": [], "last_seq": head}
+        oldest = db_session.query(func.min(models.ItemChange.seq)).scalar()
+        if since > head or (oldest is not None and since < oldest - 1):
+            raise HTTPException(
+                status_code=status.HTTP_410_GONE,
+                detail="Changes since this sequence number are no longer available",
+            )
+        rows = (
+            db_session.query(models.ItemChange.seq, models.ItemChange.item_id, models.ItemChange.value)
+            .filter(models.ItemChange.seq > since)
+            .order_by(models.ItemChange.seq)
+            .limit(limit)
+            .all()
+        )
+        return {
+            "changes": [{"seq": seq, "id": item_id, "value": value} for seq, item_id, value in rows],
+            "last_seq": rows[-1].seq if rows else since,
+        }
+    finally:
+        db_session.rollback()
+
+async def wait_for_changes(db_session: Any, since: Optional[int], limit: int, wait: float) -> Dict[str, Any]:
+    """
+    Get the changes after `since`, waiting up to `wait` seconds for one
+
+    The log is polled every CHANGES_POLL_INTERVAL_MS, which also notices
+    writes made by other workers. The wait ends early enough for the last
+    poll to finish before the request's deadline.
+    """
+    interval = CHANGES_POLL_INTERVAL_MS / 1000
+    end = time.monotonic() + wait
+    budget = deadlines.current()
+    if budget is not None and budget.deadline is not None:
+        end = min(end, budget.deadline - interval)
+    while True:
+        result = await db.run(db_session, read_changes, since, limit)
+        remaining = end - time.monotonic()
+        if result["changes"] or since is None or remaining <= 0:
+            return result
+        await asyncio.sleep(min(interval, remaining))
@@ -0,0 +1,308 @@
+from fastapi import HTTPException
+from sqlalchemy import bindparam, delete, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import models, schemas, pagination, search, etags, result_cache, serialization, writes
+
+# Operations behind the endpoints in main.py. They take a sync Session so the
+# same code serves both the threadpool and the asyncio database paths (see
+# db.run). Conditional reads return (etag, result), with result None when
+# the client's If-None-Match matched.
+
+def create_item(db_session: Session, item: schemas.ItemCreate) -> Dict[str, Any]:
+    """Create a new item in the database with a single INSERT ... RETURNING"""
+    row = writes.create_item(db_session, item.value)
+    db_session.commit()
+    return row
+
+def create_items_bulk(db_session: Session, batch: schemas.BulkItemCreate) -> Dict[str, Any]:
+    """
+    Create many items in one transaction
+
+    Rows are inserted with a single multi-row INSERT. If it fails and the
+    batch is not atomic, rows are retried one by one and failures are
+    reported per row.
+    """
+    rows = [{"value": item.value} for item in batch.items]
+    try:
+        with db_session.begin_nested():
+            ids = _insert_items(db_session, rows)
+        errors = []
+    except IntegrityError as e:
+        if batch.atomic:
+            db_session.rollback()
+            raise HTTPException(status_code=409, detail=f"Could not create items: {e.orig}")
+        ids, errors = [], []
+        for index, row in enumerate(rows):
+            try:
+                with db_session.begin_nested():
+                    ids.extend(_insert_items(db_session, [row]))
+            except IntegrityError as row_error:
+                errors.append(schemas.BulkError(index=index, detail=str(row_error.orig)))
+    db_session.commit()
+    return {"ids": ids, "errors": errors}
+
+def _insert_items(db_session: Session, rows: List[Dict[str, Any]]) -> List[int]:
+    """
+    Insert rows with a multi-row INSERT and return their IDs
+
+    On a shard of a partitioned store, the first row takes the shard's next
+    ID, which also takes the write lock, and the others follow it in the
+    shard's class.
+    """
+    statement = insert(models.Item).returning(models.Item.id, sort_by_parameter_order=True)
+    shard = db_session.info.get("shard")
+    if shard is None or not rows:
+        return list(db_session.scalars(statement, rows))
+    first_id = db_session.scalars(
+        insert(models.Item).values(id=models.next_item_id(shard.modulus, shard.residue), **rows[0]).returning(models.Item.id)
+    ).one()
+    rows = [{**row, "id": first_id + offset * shard.modulus} for offset, row in enumerate(rows[1:], 1)]
+    return [first_id, *(db_session.scalars(statement, rows) if rows else [])]
+
+def update_items_bulk(db_session: Session, batch: schemas.BulkItemUpdate) -> Dict[str, Any]:
+    """
+    Update many items in one transaction
+
+    Each row is updated with UPDATE ... RETURNING, so only the items that
+    were actually updated are reported, even if some were deleted meanwhile.
+    Missing items fail the whole batch with a 404 unless it is not atomic,
+    in which case the other rows are updated and the missing ones reported.
+    """
+    items = models.Item.__table__
+    # SQLite cannot return rows from an executemany UPDATE, so the rows are
+    # sent one by one through the same compiled statement
+    statement = (
+        update(items)
+        .where(items.c.id == bindparam("item_id"))
+        .values(value=bindparam("new_value"), version=items.c.version + 1)
+        .returning(items.c.id)
+    )
+    updated_ids = set()
+    for item in batch.items:
+        updated_ids.update(db_session.scalars(statement, {"item_id": item.id, "new_value": item.value}))
+    errors = [
+        schemas.BulkError(index=index, id=item.id, detail="Item not found")
+        for index, item in enumerate(batch.items)
+        if item.id not in updated_ids
+    ]
+    if errors and batch.atomic:
+        db_session.rollback()
+        raise HTTPException(status_code=404, detail=[error.model_dump() for error in errors])
+    db_session.commit()
+    return {"ids": [item.id for item in batch.items if item.id in updated_ids], "errors": errors}
+
+def delete_items_bulk(db_session: Session, batch: schemas.BulkItemDelete) -> Dict[str, Any]:
+    """
+    Delete many items with a single DELETE statement
+
+    Missing items fail the whole batch with a 404 unless it is not atomic,
+    in which case the other rows are deleted and the missing ones reported.
+    """
+    deleted_ids = set(
+        db_session.scalars(
+            delete(models.Item).where(models.Item.id.in_(batch.ids)).returning(models.Item.id)
+        )
+    )
+    errors = [
+        schemas.BulkError(index=index, id=item_id, detail="Item not found")
+        for index, item_id in enumerate(batch.ids)
+        if item_id not in deleted_ids
+    ]
+    if errors and batch.atomic:
+        db_session.rollback()
+        raise HTTPException(status_code=404, detail=[error.model_dump() for error in errors])
+    db_session.commit()
+    return {"ids": [item_id for item_id in batch.ids if item_id in deleted_ids], "errors": errors}
+
+def read_items(
+    db_session: Session,
+    skip: int,
+    limit: int,
+    after_id: Optional[int],
+    if_none_match: Optional[str],
+    rows: bool = False,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Get a page of items ordered by ID, after `after_id` or else after `skip` rows
+
+    With `rows` the items are (id, value) rows instead of Item entities.
+    """
+    generation = etags.current_generation(db_session)
+    etag = etags.generation_etag(generation)
+    if etags.matches(if_none_match, etag):
+        return etag, None
+
+    if result_cache.enabled() and generation is not None:
+        position = ("after", after_id) if after_id is not None else ("skip", skip)
+        return etag, _cached_page(
+            db_session, generation, rows,
+            lambda: _read_page(db_session, skip, limit, after_id, True),
+            "items", limit, *position,
+        )
+    return etag, _read_page(db_session, skip, limit, after_id, rows)
+
+def _read_page(
+    db_session: Session, skip: int, limit: int, after_id: Optional[int], rows: bool
+) -> Dict[str, Any]:
+    if rows:
+        query = db_session.query(models.Item.id, models.Item.value)
+    else:
+        query = db_session.query(models.Item)
+    query = query.order_by(models.Item.id)
+    if after_id is not None:
+        query = query.filter(models.Item.id > after_id)
+    elif skip:
+        query = query.offset(skip)
+
+    # Fetch one extra row to know whether there is a next page
+    items = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = pagination.encode_cursor(items[-1].id)
+    return {"items": items, "next_cursor": next_cursor}
+
+def _cached_page(
+    db_session: Session,
+    generation: int,
+    rows: bool,
+    load: Callable[[], Dict[str, Any]],
+    kind: str,
+    *params: Any,
+) -> Dict[str, Any]:
+    """
+    Get a page from the shared result cache, or load it as (id, value) rows and cache it
+
+    Without `rows` the items are returned as dicts, which the response
+    model accepts like entities.
+    """
+    key, database = result_cache.key(db_session, kind, generation, *params)
+    cached = result_cache.cache.get(kind, key)
+    if cached is None:
+        page = load()
+        result_cache.cache.put(key, database, generation, {
+            "items": [list(item) for item in page["items"]], "next_cursor": page["next_cursor"],
+        })
+    else:
+        page = {"items": [tuple(item) for item in cached["items"]], "next_cursor": cached["next_cursor"]}
+    if not rows:
+        page["items"] = serialization.item_dicts(page["items"])
+    return page
+
+def count_items(
+    db_session: Session,
+    exact: bool,
+    if_none_match: Optional[str],
+) -> Tuple[Optional[str], Optional[int]]:
+    """Count all items, from the maintained counter unless `exact` is set"""
+    generation = etags.current_generation(db_session)
+    etag = etags.generation_etag(generation)
+    if etags.matches(if_none_match, etag):
+        return etag, None
+
+    if result_cache.enabled() and generation is not None:
+        key, database = result_cache.key(db_session, "count", generation, exact)
+        count = result_cache.cache.get("count", key)
+        if count is None:
+            count = _count(db_session, exact)
+            result_cache.cache.put(key, database, generation, count)
+        return etag, count
+    return etag, _count(db_session, exact)
+
+def _count(db_session: Session, exact: bool) -> int:
+    if not exact:
+        count = db_session.query(models.Counter.value).filter(
+            models.Counter.name == models.ITEM_COUNT
+        ).scalar()
+        if count is not None:
+            return count
+    return db_session.query(func.count()).select_from(models.Item).scalar()
+
+def search_items(
+    db_session: Session,
+    q: str,
+    mode: schemas.SearchMode,
+    limit: int,
+    after_id: Optional[int],
+    if_none_match: Optional[str],
+    rows: bool = False,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Get a page of items matching a search query, as (id, value) rows with `rows`"""
+    generation = etags.current_generation(db_session)
+    etag = etags.generation_etag(generation)
+    if etags.matches(if_none_match, etag):
+        return etag, None
+
+    if result_cache.enabled() and generation is not None:
+        return etag, _cached_page(
+            db_session, generation, rows,
+            lambda: _search_page(db_session, q, mode, limit, after_id, True),
+            "search", q, mode.value, limit, after_id,
+        )
+    return etag, _search_page(db_session, q, mode, limit, after_id, rows)
+
+def _search_page(
+    db_session: Session, q: str, mode: schemas.SearchMode, limit: int, after_id: Optional[int], rows: bool
+) -> Dict[str, Any]:
+    # Fetch one extra row to know whether there is a next page
+    items = search.search_items(db_session, q, mode, limit + 1, after_id, rows=rows)
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        if mode is not schemas.SearchMode.ranked:
+            next_cursor = pagination.encode_cursor(items[-1].id)
+    return {"items": items, "next_cursor": next_cursor}
+
+def lookup_items(db_session: Session, ids: List[int]) -> Dict[str, Any]:
+    """Get many items by ID with a single IN query, in the order requested"""
+    requested_ids = list(dict.fromkeys(ids))
+    found = {
+        item.id: item
+        for item in db_session.query(models.Item).filter(models.Item.id.in_(requested_ids))
+    }
+    return {
+        "items": [found[item_id] for item_id in requested_ids if item_id in found],
+        "missing": [item_id for item_id in requested_ids if item_id not in found],
+    }
+
+def read_item(
+    db_session: Session,
+    item_id: int,
+    if_none_match: Optional[str],
+) -> Tuple[str, Optional[models.Item]]:
+    """Get a specific item by ID"""
+    item = db_session.query(models.Item).filter(models.Item.id == item_id).first()
+    if item is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    etag = etags.item_etag(item)
+    if etags.matches(if_none_match, etag):
+        return etag, None
+    return etag, item
+
+def delete_item(db_session: Session, item_id: int, versions: Optional[List[int]] = None) -> None:
+    """
+    Delete an item by ID with a single DELETE
+
+    With `versions`, only an item at one of them is deleted (412 otherwise).
+    """
+    writes.delete_item(db_session, item_id, versions)
+    db_session.commit()
+
+def update_item(
+    db_session: Session,
+    item_id: int,
+    item: schemas.ItemCreate,
+    versions: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    """
+    Update an item by ID with a single UPDATE ... RETURNING
+
+    With `versions`, only an item at one of them is updated (412 otherwise).
+    The result includes the item's new version.
+    """
+    row = writes.update_item(db_session, item_id, item.value, versions)
+    db_session.commit()
+    return row
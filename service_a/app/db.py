@@ -1,25 +1,457 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.engine.interfaces import AdaptedConnection
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from fastapi.concurrency import run_in_threadpool
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+import asyncio
+import itertools
+import json
+import math
 import os
+import time
+
+from service_common import metrics, tracing
+
+from . import deadlines
 
 # Get database URL from environment variable or use default SQLite file
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./items.db")
 
+# Serve requests through SQLAlchemy's asyncio extension instead of the
+# threadpool. Needs an async driver, e.g. aiosqlite for SQLite.
+DATABASE_ASYNC = os.getenv("DATABASE_ASYNC", "false").lower() in ("1", "true", "yes")
+
+def _default_async_url(url: str) -> str:
+    """Use the async driver for the same database (aiosqlite for SQLite)"""
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite":
+        return parsed.set(drivername="sqlite+aiosqlite").render_as_string(hide_password=False)
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", _default_async_url(DATABASE_URL))
+
+# SQLite settings applied to every new connection. WAL lets readers run
+# alongside the writer, NORMAL only syncs at checkpoints in WAL mode, and the
+# busy timeout makes writers from other processes wait for the lock instead
+# of failing with "database is locked".
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "20000"))
+
+# SQLite virtual machine instructions between two checks of the request's
+# deadline while a statement runs (0 disables aborting statements)
+SQLITE_PROGRESS_INTERVAL = int(os.getenv("SQLITE_PROGRESS_INTERVAL", "1000"))
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+def _enforce_deadlines(sync_engine) -> None:
+    """
+    Abort statements of requests whose deadline passed or whose client left
+
+    A progress handler is installed on every connection. It reads the budget
+    from the connection's info, where it is stored before each statement,
+    since with aiosqlite the handler runs in the driver's thread rather than
+    in the request's context.
+    """
+    @event.listens_for(sync_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        info = connection_record.info
+
+        def progress() -> int:
+            budget = info.get("budget")
+            return 1 if budget is not None and budget.expired() else 0
+
+        if isinstance(dbapi_connection, AdaptedConnection):
+            dbapi_connection.run_async(
+                lambda connection: connection.set_progress_handler(progress, SQLITE_PROGRESS_INTERVAL)
+            )
+        else:
+            dbapi_connection.set_progress_handler(progress, SQLITE_PROGRESS_INTERVAL)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["budget"] = deadlines.current()
+
+    @event.listens_for(sync_engine, "reset")
+    def reset(dbapi_connection, connection_record, reset_state):
+        # Never abort the rollback of a connection going back to the pool
+        connection_record.info.pop("budget", None)
+
+DB_STATEMENT_DURATION = metrics.Histogram(
+    "db_statement_duration_seconds",
+    "Database statement latency by engine and operation",
+    ("engine", "operation"),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+DB_POOL_CONNECTIONS = metrics.Gauge(
+    "db_pool_connections", "Database connections by engine and state", ("engine", "state"),
+    multiprocess_mode="livesum",
+)
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+def _instrument_statements(sync_engine, name: str) -> None:
+    """Time every statement of an engine, labelled by its first keyword"""
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_start", None)
+        if start is None:
+            return
+        operation = statement.lstrip()[:6].upper()
+        if operation not in _OPERATIONS:
+            operation = "OTHER"
+        DB_STATEMENT_DURATION.labels(name, operation).observe(time.perf_counter() - start)
+
+    def collect_pool() -> None:
+        # Only queue pools (the default for file databases) track their size
+        pool = sync_engine.pool
+        if hasattr(pool, "checkedout"):
+            DB_POOL_CONNECTIONS.labels(name, "checked_out").set(pool.checkedout())
+            DB_POOL_CONNECTIONS.labels(name, "idle").set(pool.checkedin())
+            DB_POOL_CONNECTIONS.labels(name, "overflow").set(max(pool.overflow(), 0))
+
+    metrics.register_collector(collect_pool)
+
+# Execution option naming the statement that begins a transaction on SQLite,
+# e.g. "BEGIN IMMEDIATE" to take the write lock from the start
+SQLITE_BEGIN = "sqlite_begin"
+
+def _begin_transactions(sync_engine) -> None:
+    """
+    Emit BEGIN for every transaction instead of leaving it to the driver
+
+    The sqlite3 driver (and aiosqlite) only begins a transaction before
+    INSERT, UPDATE and DELETE, not before SAVEPOINT. A savepoint opened
+    first then runs outside any transaction and releasing it commits, so
+    writes meant to share one transaction (and one fsync) would each be
+    committed on their own. This is SQLAlchemy's recipe for SQLite: the
+    driver's own transaction handling is turned off and SQLAlchemy's begin
+    event emits BEGIN, so savepoints nest in a real transaction.
+    """
+    @event.listens_for(sync_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(sync_engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql(conn.get_execution_options().get(SQLITE_BEGIN, "BEGIN"))
+
+def configure_engine(sync_engine, name: str = "sync") -> None:
+    """Apply the SQLite pragmas and transaction handling to every connection of an engine and record its metrics"""
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+        _begin_transactions(sync_engine)
+        if SQLITE_PROGRESS_INTERVAL > 0:
+            _enforce_deadlines(sync_engine)
+    _instrument_statements(sync_engine, name)
+
+def _connect_args(url: str) -> dict:
+    """Driver arguments for a database URL"""
+    if make_url(url).get_backend_name() == "sqlite":
+        # Sessions are used from several threadpool threads
+        return {"check_same_thread": False}
+    return {}
+
 # Create SQLAlchemy engine
 engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
+    DATABASE_URL, connect_args=_connect_args(DATABASE_URL)
 )
+configure_engine(engine)
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine and session factory, only created when enabled so the async
+# driver is not required otherwise
+async_engine = None
+AsyncSessionLocal = None
+if DATABASE_ASYNC:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
+    configure_engine(async_engine.sync_engine, "async")
+    AsyncSessionLocal = async_sessionmaker(
+        async_engine, autoflush=False, expire_on_commit=False
+    )
+
+# Partitioned storage. With SHARD_MAP set to a JSON file listing SQLite
+# databases, items are spread over them by ID: the shard with modulus m and
+# residue r holds the items whose ID % m == r, and generates the IDs of new
+# items in that class. New items go to the shards in turn, point operations
+# to the shard holding the item, and lists, searches and counts query every
+# shard in parallel. Without the file, the map is one shard on DATABASE_URL.
+# The map is read at import, so Service A must be restarted after a shard is
+# split with `python -m app.maintenance split-shard`.
+SHARD_MAP = os.getenv("SHARD_MAP")
+
+class Shard:
+    """One database of the partitioned item store, with its engines and session factories"""
+
+    def __init__(self, url: str, modulus: int, residue: int, name: str = "shard"):
+        if make_url(url).get_backend_name() != "sqlite":
+            raise ValueError(f"Shards must be SQLite databases: {url}")
+        self.url = url
+        self.modulus = modulus
+        self.residue = residue
+        self.engine = create_engine(url, connect_args=_connect_args(url))
+        configure_engine(self.engine, name)
+        self.SessionLocal = sessionmaker(autoflush=False, bind=self.engine, info={"shard": self})
+        self.async_engine = None
+        self.AsyncSessionLocal = None
+        if DATABASE_ASYNC:
+            from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+            self.async_engine = create_async_engine(_default_async_url(url))
+            configure_engine(self.async_engine.sync_engine, f"{name}_async")
+            self.AsyncSessionLocal = async_sessionmaker(
+                self.async_engine, autoflush=False, expire_on_commit=False, info={"shard": self}
+            )
+
+    def owns(self, item_id: int) -> bool:
+        """Whether an item with this ID belongs to the shard"""
+        return item_id % self.modulus == self.residue
+
+    def dispose(self, close: bool = True) -> None:
+        self.engine.dispose(close=close)
+        if self.async_engine is not None:
+            self.async_engine.sync_engine.dispose(close=close)
+
+class ShardMap:
+    """
+    The shards of the partitioned item store
+
+    Their residue classes must cover every ID exactly once, which holds for
+    a single shard and for any map obtained from it by splits.
+    """
+
+    def __init__(self, shards: List[Shard]):
+        period = math.lcm(*(shard.modulus for shard in shards)) if shards else 0
+        owners = [sum(1 for shard in shards if shard.owns(residue)) for residue in range(period)]
+        if not owners or owners != [1] * period:
+            raise ValueError("Shards must hold every item ID exactly once")
+        self.shards = shards
+        self._turns = itertools.count()
+
+    @classmethod
+    def load(cls, path: str, default_url: str) -> "ShardMap":
+        """Read a map file, or use a single shard on `default_url` if it does not exist"""
+        try:
+            with open(path) as f:
+                entries = json.load(f)["shards"]
+        except FileNotFoundError:
+            entries = [{"url": default_url, "modulus": 1, "residue": 0}]
+        return cls([
+            Shard(entry["url"], entry["modulus"], entry["residue"], f"shard{index}")
+            for index, entry in enumerate(entries)
+        ])
+
+    def save(self, path: str) -> None:
+        """Write the map file, replacing the previous one atomically"""
+        entries = [{"url": shard.url, "modulus": shard.modulus, "residue": shard.residue} for shard in self.shards]
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({"shards": entries}, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def for_item(self, item_id: int) -> Shard:
+        """The shard holding an item"""
+        for shard in self.shards:
+            if shard.owns(item_id):
+                return shard
+        raise AssertionError("unreachable: the map covers every ID")
+
+    def for_new_item(self) -> Shard:
+        """The shard receiving the next new item, taking turns"""
+        return self.shards[next(self._turns) % len(self.shards)]
+
+    def dispose(self, close: bool = True) -> None:
+        for shard in self.shards:
+            shard.dispose(close)
+
+shard_map: Optional[ShardMap] = ShardMap.load(SHARD_MAP, DATABASE_URL) if SHARD_MAP else None
+
+def _dispose_after_fork() -> None:
+    """Forget pooled connections inherited from the parent process, without closing them for it"""
+    engine.dispose(close=False)
+    if async_engine is not None:
+        async_engine.sync_engine.dispose(close=False)
+    if shard_map is not None:
+        shard_map.dispose(close=False)
+
+# Engines may be created before gunicorn forks its workers (--preload); every
+# worker then opens its own connections
+os.register_at_fork(after_in_child=_dispose_after_fork)
+
 # Create base class for SQLAlchemy models
 Base = declarative_base()
 
+class ShardedSession:
+    """
+    A request's sessions on the shards of a partitioned store, opened on first use
+
+    Each is a Session, or an AsyncSession with DATABASE_ASYNC, whose `info`
+    holds its Shard. Endpoints pass it to route() or gather() rather than
+    querying it directly.
+    """
+
+    def __init__(self, shards: ShardMap, use_async: bool = False):
+        self.map = shards
+        self.use_async = use_async
+        self._sessions: Dict[Shard, Any] = {}
+
+    def session(self, shard: Shard) -> Any:
+        """The session on one shard"""
+        db_session = self._sessions.get(shard)
+        if db_session is None:
+            factory = shard.AsyncSessionLocal if self.use_async else shard.SessionLocal
+            db_session = self._sessions[shard] = factory()
+        return db_session
+
+    def sessions(self) -> List[Any]:
+        """The sessions on every shard"""
+        return [self.session(shard) for shard in self.map.shards]
+
+    def close(self) -> None:
+        for db_session in self._sessions.values():
+            db_session.close()
+
+    async def aclose(self) -> None:
+        for db_session in self._sessions.values():
+            await db_session.close()
+
 # Dependency to get DB session
 def get_db():
-    db = SessionLocal()
+    db = ShardedSession(shard_map) if shard_map is not None else SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+# Dependency to get an async DB session
+async def get_async_db():
+    if shard_map is not None:
+        db = ShardedSession(shard_map, use_async=True)
+        try:
+            yield db
+        finally:
+            await db.aclose()
+        return
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Dependency used by the endpoints, chosen by DATABASE_ASYNC
+get_session = get_async_db if DATABASE_ASYNC else get_db
+
+def new_session(db_session: Any) -> Any:
+    """Open a new session of the same kind and on the same database (or shard) as another"""
+    if isinstance(db_session, Session):
+        return Session(bind=db_session.get_bind(), autoflush=False, info=dict(db_session.info))
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    return AsyncSession(bind=db_session.bind, autoflush=False, expire_on_commit=False, info=dict(db_session.info))
+
+def is_sharded(db_session: Any) -> bool:
+    """Whether a request's session is on a partitioned store"""
+    return isinstance(db_session, ShardedSession)
+
+def route(db_session: Any, item_id: Optional[int] = None) -> Any:
+    """
+    The session for one item of a partitioned store: on the shard holding
+    it, or the shard taking the next new item if `item_id` is None
+
+    Other sessions are returned as they are.
+    """
+    if not isinstance(db_session, ShardedSession):
+        return db_session
+    shard = db_session.map.for_new_item() if item_id is None else db_session.map.for_item(item_id)
+    return db_session.session(shard)
+
+def sessions_by_shard(db_session: Any, item_ids: List[int]) -> List[Tuple[Any, List[int]]]:
+    """
+    Group positions in `item_ids` by the session of the shard holding each item
+
+    Returns:
+        (session, positions) pairs; a single pair for other sessions
+    """
+    if not isinstance(db_session, ShardedSession):
+        return [(db_session, list(range(len(item_ids))))]
+    groups: Dict[Shard, List[int]] = {}
+    for position, item_id in enumerate(item_ids):
+        groups.setdefault(db_session.map.for_item(item_id), []).append(position)
+    return [(db_session.session(shard), positions) for shard, positions in groups.items()]
+
+T = TypeVar("T")
+
+async def run(db_session: Any, fn: Callable[..., T], *args: Any) -> T:
+    """
+    Run a function taking a sync Session with either kind of session
+
+    With an AsyncSession the function runs on the event loop through
+    `run_sync`, so its queries are awaited by the async driver. With a sync
+    Session it runs in the threadpool.
+
+    Statements aborted because the request's deadline passed or its client
+    disconnected raise deadlines.DeadlineExceeded instead of a database
+    error. The function is a `query` span of the request's trace.
+
+    Args:
+        db_session: Session or AsyncSession from get_session
+        fn: Function called as fn(session, *args)
+
+    Returns:
+        The function's return value
+    """
+    deadlines.check()
+    fn = tracing.wrap("query", fn)
+    try:
+        if isinstance(db_session, Session):
+            return await run_in_threadpool(fn, db_session, *args)
+        return await db_session.run_sync(fn, *args)
+    except OperationalError:
+        deadlines.check()
+        raise
+
+async def gather(db_session: Any, fn: Callable[..., T], *args: Any) -> List[T]:
+    """
+    Run a function on every shard of a partitioned store in parallel
+
+    Each call runs as with run(); with other sessions there is one call.
+
+    Returns:
+        The function's return values, in shard order
+    """
+    if not isinstance(db_session, ShardedSession):
+        return [await run(db_session, fn, *args)]
+    return list(await asyncio.gather(*(run(shard_session, fn, *args) for shard_session in db_session.sessions())))
+
+def engines() -> List[Any]:
+    """The sync engines serving requests: one per shard, or the DATABASE_URL one"""
+    if shard_map is not None:
+        return [shard.engine for shard in shard_map.shards]
+    return [engine]
+
+def session_factories() -> List[Tuple[Any, Any]]:
+    """(engine, session factory) of each database serving requests, async ones with DATABASE_ASYNC"""
+    if shard_map is not None:
+        if DATABASE_ASYNC:
+            return [(shard.async_engine, shard.AsyncSessionLocal) for shard in shard_map.shards]
+        return [(shard.engine, shard.SessionLocal) for shard in shard_map.shards]
+    if DATABASE_ASYNC:
+        return [(async_engine, AsyncSessionLocal)]
+    return [(engine, SessionLocal)]
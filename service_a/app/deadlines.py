@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import os
+import time
+from typing import Any, Optional
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+# Remaining time budget of a request in milliseconds, sent by callers such as
+# Service B. Statements still running when it is spent are aborted.
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+# Set on responses to requests whose deadline passed, so callers can tell
+# them from other 504s and do not retry them
+DEADLINE_EXCEEDED_HEADER = "X-Deadline-Exceeded"
+
+# Budget for requests without the header, in milliseconds (0 means none)
+REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", "0"))
+
+# Status recorded for requests abandoned by their client (nginx's convention)
+CLIENT_CLOSED_REQUEST = 499
+
+class Budget:
+    """Time budget of a request, also spent when its client disconnects"""
+
+    __slots__ = ("deadline", "cancelled")
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline  # time.monotonic() value, or None for no limit
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def expired(self) -> bool:
+        return self.cancelled or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+class DeadlineExceeded(Exception):
+    """Raised instead of a database error when the request's budget ran out"""
+
+    def __init__(self, budget: Budget):
+        super().__init__("Client disconnected" if budget.cancelled else "Deadline exceeded")
+        self.cancelled = budget.cancelled
+
+_budget: contextvars.ContextVar[Optional[Budget]] = contextvars.ContextVar("budget", default=None)
+
+def current() -> Optional[Budget]:
+    """The budget of the request being served, if any"""
+    return _budget.get()
+
+def detach() -> None:
+    """Stop the current context from using the request's budget, for work shared with other requests"""
+    _budget.set(None)
+
+def check() -> None:
+    """Raise DeadlineExceeded if the current request's budget is spent"""
+    budget = _budget.get()
+    if budget is not None and budget.expired():
+        raise DeadlineExceeded(budget)
+
+def parse(value: Optional[str]) -> Budget:
+    """Build the budget of a request from its deadline header, ignoring malformed values"""
+    milliseconds = REQUEST_DEADLINE_MS or None
+    if value is not None:
+        try:
+            milliseconds = max(float(value), 0.0)
+        except ValueError:
+            pass
+    if milliseconds is None:
+        return Budget()
+    return Budget(time.monotonic() + milliseconds / 1000)
+
+def error_response(error: DeadlineExceeded) -> JSONResponse:
+    """504 with DEADLINE_EXCEEDED_HEADER, or 499 if the client is gone"""
+    if error.cancelled:
+        return JSONResponse({"detail": str(error)}, status_code=CLIENT_CLOSED_REQUEST)
+    return JSONResponse(
+        {"detail": str(error)}, status_code=504, headers={DEADLINE_EXCEEDED_HEADER: "true"}
+    )
+
+async def deadline_exceeded_handler(request: Request, error: DeadlineExceeded) -> JSONResponse:
+    return error_response(error)
+
+class DeadlineMiddleware:
+    """
+    Pure ASGI middleware giving every request a Budget
+
+    The budget comes from DEADLINE_HEADER or REQUEST_DEADLINE_MS. Requests
+    arriving with their budget already spent are answered with a 504
+    straight away. The request's messages are read by a background task so
+    a client disconnect is noticed while the endpoint runs, and cancels the
+    budget, which aborts the request's database statements.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        header = DEADLINE_HEADER.lower().encode()
+        value = next((v.decode("latin-1") for k, v in scope["headers"] if k == header), None)
+        budget = parse(value)
+        if budget.expired():
+            await error_response(DeadlineExceeded(budget))(scope, receive, send)
+            return
+
+        messages: asyncio.Queue = asyncio.Queue()
+
+        async def pump() -> None:
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    budget.cancel()
+                    return
+
+        async def receive_message() -> Any:
+            message = await messages.get()
+            if message["type"] == "http.disconnect":
+                # Every later call gets the disconnect too
+                messages.put_nowait(message)
+            return message
+
+        reader = asyncio.ensure_future(pump())
+        token = _budget.set(budget)
+        try:
+            await self.app(scope, receive_message, send)
+        finally:
+            _budget.reset(token)
+            reader.cancel()
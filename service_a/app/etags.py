@@ -0,0 +1,97 @@
+from typing import Any, List, Optional
+
+from fastapi import Response, status
+from sqlalchemy.orm import Session
+
+from . import models
+
+def current_generation(db_session: Session) -> Optional[int]:
+    """Get the items table generation, or None if the database does not maintain one"""
+    return db_session.query(models.Counter.value).filter(
+        models.Counter.name == models.GENERATION
+    ).scalar()
+
+def collection_etag(db_session: Session) -> Optional[str]:
+    """
+    Get the ETag for a response computed from the whole items table
+
+    Every write bumps the generation, so an unchanged generation means an
+    unchanged response for the same URL.
+    """
+    return generation_etag(current_generation(db_session))
+
+def generation_etag(generation: Optional[int]) -> Optional[str]:
+    """Get the collection ETag for a generation of the items table"""
+    if generation is None:
+        return None
+    return f'"g{generation}"'
+
+def combine(etags: List[Optional[str]]) -> Optional[str]:
+    """
+    Get the collection ETag of a partitioned store from those of its shards
+
+    It changes whenever the generation of any shard does.
+    """
+    if not etags or None in etags:
+        return None
+    return '"' + ".".join(etag.strip('"') for etag in etags) + '"'
+
+def item_etag(item: models.Item) -> str:
+    """Get the ETag for a single item"""
+    return version_etag(item.version)
+
+def version_etag(version: int) -> str:
+    """Get the ETag for a version of an item"""
+    return f'"v{version}"'
+
+def expected_versions(if_match: Optional[str]) -> Optional[List[int]]:
+    """
+    Get the item versions an If-Match header accepts
+
+    Returns:
+        None if any version is accepted (no header, or `*`), else the
+        versions of the header's item ETags, which may be empty. Weak ETags
+        never match, as If-Match uses strong comparison.
+    """
+    if not if_match:
+        return None
+    versions = []
+    for candidate in (candidate.strip() for candidate in if_match.split(",")):
+        if candidate == "*":
+            return None
+        if candidate.startswith('"v') and candidate.endswith('"') and candidate[2:-1].isdigit():
+            versions.append(int(candidate[2:-1]))
+    return versions
+
+def matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Check whether an If-None-Match header matches an ETag (weak comparison)"""
+    if not if_none_match or not etag:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in (
+        candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates
+    )
+
+def not_modified(etag: str) -> Response:
+    """Build a 304 response for an ETag"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+def respond(response: Response, etag: Optional[str], body: Optional[Any]) -> Any:
+    """
+    Finish a conditional read
+
+    Args:
+        response: The endpoint's response, which gets the ETag header
+        etag: ETag of the current representation, if any
+        body: Response body (or a complete Response, which then gets the
+            ETag header instead), or None if the client's copy is current
+
+    Returns:
+        A 304 response if body is None, else the body
+    """
+    if body is None:
+        return not_modified(etag)
+    if etag:
+        target = body if isinstance(body, Response) else response
+        target.headers["ETag"] = etag
+    return body
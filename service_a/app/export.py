@@ -0,0 +1,140 @@
+import heapq
+import json
+from itertools import islice
+from operator import itemgetter
+from typing import Any, AsyncIterator, Iterator, List, Union
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from . import models, db, serialization
+
+# Number of rows fetched from the database cursor at a time
+EXPORT_BATCH_SIZE = 1000
+
+def _ndjson_chunk(rows: Any, columns: bool) -> Union[str, bytes]:
+    """Encode a batch of (id, value) rows as NDJSON lines, or as one line of columns"""
+    if columns:
+        return serialization.dumps(serialization.item_columns(rows)) + b"\n"
+    return "".join(json.dumps({"id": item_id, "value": value}) + "\n" for item_id, value in rows)
+
+def _batches(rows: Iterator[Any]) -> Iterator[List[Any]]:
+    """Group rows into lists of EXPORT_BATCH_SIZE"""
+    while True:
+        batch = list(islice(rows, EXPORT_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+def _statement() -> Any:
+    return (
+        select(models.Item.id, models.Item.value)
+        .order_by(models.Item.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+def _iter_rows(bind: Union[Engine, Connection]) -> Iterator[Any]:
+    with Session(bind=bind) as db_session:
+        for rows in db_session.execute(_statement()).partitions():
+            yield from rows
+
+def iter_items_ndjson(
+    bind: Union[Engine, Connection, List[Engine]], columns: bool = False
+) -> Iterator[Union[str, bytes]]:
+    """
+    Stream all items as newline-delimited JSON in ID order
+
+    Rows are read as (id, value) tuples in batches of EXPORT_BATCH_SIZE, so
+    memory use does not depend on the size of the table. The generator uses
+    its own session because the request's session may be closed before the
+    response has been streamed.
+
+    Args:
+        bind: Engine or connection to read from, or the engines of the
+            shards of a partitioned store, whose rows are merged
+        columns: Encode each batch as one line of `ids` and `values` arrays
+
+    Yields:
+        One chunk of NDJSON lines per batch
+    """
+    if isinstance(bind, list):
+        merged = heapq.merge(*(_iter_rows(shard_bind) for shard_bind in bind), key=itemgetter(0))
+        for rows in _batches(merged):
+            yield _ndjson_chunk(rows, columns)
+        return
+    with Session(bind=bind) as db_session:
+        for rows in db_session.execute(_statement()).partitions():
+            yield _ndjson_chunk(rows, columns)
+
+async def _aiter_rows(bind: Any) -> AsyncIterator[Any]:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    statement = select(models.Item.id, models.Item.value).order_by(models.Item.id)
+    async with AsyncSession(bind=bind) as db_session:
+        result = await db_session.stream(statement)
+        async for rows in result.partitions(EXPORT_BATCH_SIZE):
+            for row in rows:
+                yield row
+
+async def _amerge(iterators: List[AsyncIterator[Any]]) -> AsyncIterator[Any]:
+    """Merge async iterators of rows in ID order, like heapq.merge"""
+    heap = []
+    for index, iterator in enumerate(iterators):
+        try:
+            row = await iterator.__anext__()
+        except StopAsyncIteration:
+            continue
+        heap.append((row[0], index, row))
+    heapq.heapify(heap)
+    while heap:
+        _, index, row = heap[0]
+        yield row
+        try:
+            row = await iterators[index].__anext__()
+        except StopAsyncIteration:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (row[0], index, row))
+
+async def aiter_items_ndjson(bind: Any, columns: bool = False) -> AsyncIterator[Union[str, bytes]]:
+    """
+    Async version of iter_items_ndjson for the asyncio database path
+
+    Args:
+        bind: AsyncEngine or AsyncConnection to read from, or the async
+            engines of the shards of a partitioned store
+        columns: Encode each batch as one line of `ids` and `values` arrays
+
+    Yields:
+        One chunk of NDJSON lines per batch
+    """
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    if isinstance(bind, list):
+        batch = []
+        async for row in _amerge([_aiter_rows(shard_bind) for shard_bind in bind]):
+            batch.append(row)
+            if len(batch) == EXPORT_BATCH_SIZE:
+                yield _ndjson_chunk(batch, columns)
+                batch = []
+        if batch:
+            yield _ndjson_chunk(batch, columns)
+        return
+    statement = select(models.Item.id, models.Item.value).order_by(models.Item.id)
+    async with AsyncSession(bind=bind) as db_session:
+        result = await db_session.stream(statement)
+        async for rows in result.partitions(EXPORT_BATCH_SIZE):
+            yield _ndjson_chunk(rows, columns)
+
+def stream_items_ndjson(
+    db_session: Any, columns: bool = False
+) -> Union[Iterator[Union[str, bytes]], AsyncIterator[Union[str, bytes]]]:
+    """Stream all items as NDJSON from the database (or shards) behind a request's session"""
+    if db.is_sharded(db_session):
+        if db_session.use_async:
+            return aiter_items_ndjson([shard.async_engine for shard in db_session.map.shards], columns)
+        return iter_items_ndjson([shard.engine for shard in db_session.map.shards], columns)
+    if isinstance(db_session, Session):
+        return iter_items_ndjson(db_session.get_bind(), columns)
+    return aiter_items_ndjson(db_session.bind, columns)
@@ -1,71 +1,337 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import Any, Optional
 
-from . import models, schemas, db
+from service_common import metrics, tracing
+
+from . import models, schemas, db, pagination, export, etags, crud, writes, serialization, deadlines, changes, admission, startup, result_cache, partitions
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm the worker up in the background; /ready answers 200 once it is done"""
+    warm_up = asyncio.create_task(startup.warm_up())
+    try:
+        yield
+    finally:
+        warm_up.cancel()
+        try:
+            await warm_up
+        except asyncio.CancelledError:
+            pass
 
 # Create FastAPI app
-app = FastAPI(title="Service A - Item API")
+app = FastAPI(title="Service A - Item API", lifespan=lifespan)
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(deadlines.DeadlineMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(tracing.TracingMiddleware, service="service_a")
+app.add_exception_handler(deadlines.DeadlineExceeded, deadlines.deadline_exceeded_handler)
+
+# Create or upgrade the schema (of every shard) once: at import, which
+# gunicorn --preload runs in the master process only. Its connections are
+# not handed to the workers.
+for engine in db.engines():
+    models.prepare_schema(engine)
+    engine.dispose()
+
+# Results cached by a previous server may come from another database file
+# with the same generation, so the shared cache starts empty
+if result_cache.enabled():
+    result_cache.cache.clear()
 
-# Create tables in the database
-models.Base.metadata.create_all(bind=db.engine)
+def _render_page(response: Response, page: Optional[dict], columns: bool) -> Any:
+    """
+    Return a list page as is, or encode it directly in the columns format or
+    with fast serialization
+
+    A Response returned by an endpoint skips the response model, so the page
+    is not validated again. `page` holds (id, value) rows in those two cases.
+    """
+    response.headers["Vary"] = "Accept"
+    if page is None:
+        return None
+    if columns:
+        body = {**serialization.item_columns(page["items"]), "next_cursor": page["next_cursor"]}
+        return serialization.FastJSONResponse(
+            body, media_type=serialization.COLUMNS_MEDIA_TYPE, headers={"Vary": "Accept"}
+        )
+    if serialization.enabled():
+        body = {"items": serialization.item_dicts(page["items"]), "next_cursor": page["next_cursor"]}
+        return serialization.FastJSONResponse(body, headers={"Vary": "Accept"})
+    return page
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    """Decode a cursor query parameter, rejecting malformed ones with a 400"""
+    if cursor is None:
+        return None
+    try:
+        return pagination.decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 @app.post("/items", response_model=schemas.Item, status_code=status.HTTP_201_CREATED)
-def create_item(item: schemas.ItemCreate, db_session: Session = Depends(db.get_db)):
-    """Create a new item in the database"""
-    db_item = models.Item(value=item.value)
-    db_session.add(db_item)
-    db_session.commit()
-    db_session.refresh(db_item)
-    return db_item
+async def create_item(response: Response, item: schemas.ItemCreate, db_session: Any = Depends(db.get_session)):
+    """Create a new item in the database; the response's ETag can be sent as If-Match to update it"""
+    db_session = db.route(db_session)
+    if writes.enabled():
+        created = await writes.submit(db_session, writes.create_item, item.value)
+    else:
+        created = await db.run(db_session, crud.create_item, item)
+    response.headers["ETag"] = etags.version_etag(created["version"])
+    return created
+
+@app.post("/items/bulk", response_model=schemas.BulkResult, status_code=status.HTTP_201_CREATED)
+async def create_items_bulk(batch: schemas.BulkItemCreate, db_session: Any = Depends(db.get_session)):
+    """
+    Create many items in one transaction
+
+    Rows are inserted with a single multi-row INSERT. If it fails and the
+    batch is not atomic, rows are retried one by one and failures are
+    reported per row. On a partitioned store the batch goes to one shard.
+    """
+    return await db.run(db.route(db_session), crud.create_items_bulk, batch)
+
+@app.put("/items/bulk", response_model=schemas.BulkResult)
+async def update_items_bulk(batch: schemas.BulkItemUpdate, db_session: Any = Depends(db.get_session)):
+    """
+    Update many items in one transaction
+
+    Missing items fail the whole batch with a 404 unless it is not atomic,
+    in which case the other rows are updated and the missing ones reported.
+    """
+    if db.is_sharded(db_session):
+        return await partitions.update_items_bulk(db_session, batch)
+    return await db.run(db_session, crud.update_items_bulk, batch)
+
+@app.delete("/items/bulk", response_model=schemas.BulkResult)
+async def delete_items_bulk(batch: schemas.BulkItemDelete, db_session: Any = Depends(db.get_session)):
+    """
+    Delete many items with a single DELETE statement
+
+    Missing items fail the whole batch with a 404 unless it is not atomic,
+    in which case the other rows are deleted and the missing ones reported.
+    """
+    if db.is_sharded(db_session):
+        return await partitions.delete_items_bulk(db_session, batch)
+    return await db.run(db_session, crud.delete_items_bulk, batch)
+
+@app.post("/items/lookup", response_model=schemas.ItemLookupResult)
+async def lookup_items(lookup: schemas.ItemLookup, db_session: Any = Depends(db.get_session)):
+    """
+    Get many items by ID in one query
+
+    Items are returned in the order requested; IDs that do not exist are
+    listed in `missing` instead of failing the request.
+    """
+    if db.is_sharded(db_session):
+        return await partitions.lookup_items(db_session, lookup.ids)
+    return await db.run(db_session, crud.lookup_items, lookup.ids)
 
 @app.get("/items", response_model=schemas.ItemList)
-def read_items(skip: int = 0, limit: int = 100, db_session: Session = Depends(db.get_db)):
-    """Get all items from the database"""
-    items = db_session.query(models.Item).offset(skip).limit(limit).all()
-    return {"items": items}
+async def read_items(
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    db_session: Any = Depends(db.get_session),
+):
+    """
+    Get a page of items ordered by ID
+
+    Pass the `next_cursor` of a page as `cursor` to get the next page; this is
+    a range scan on the primary key, so every page costs the same. `skip` is
+    only kept for backward compatibility and is ignored when `cursor` is set.
+    Clients that accept `application/vnd.items.columns+json` get the items
+    as parallel `ids` and `values` arrays.
+    """
+    after_id = _decode_cursor(cursor)
+    columns = serialization.accepts(accept, serialization.COLUMNS_MEDIA_TYPE)
+    if db.is_sharded(db_session):
+        etag, page = await partitions.read_items(
+            db_session, skip, limit, after_id, if_none_match, columns or serialization.enabled()
+        )
+    else:
+        etag, page = await db.run(
+            db_session, crud.read_items, skip, limit, after_id, if_none_match,
+            columns or serialization.enabled(),
+        )
+    return etags.respond(response, etag, _render_page(response, page, columns))
 
 @app.get("/items/count", response_model=int)
-def count_items(db_session: Session = Depends(db.get_db)):
-    """Count all items in the database"""
-    count = db_session.query(models.Item).count()
-    return count
+async def count_items(
+    response: Response,
+    exact: bool = False,
+    if_none_match: Optional[str] = Header(None),
+    db_session: Any = Depends(db.get_session),
+):
+    """
+    Count all items in the database
+
+    Returns the counter maintained by the items triggers. Pass `exact=true`
+    to count the rows instead, which scans the whole table.
+    """
+    if db.is_sharded(db_session):
+        etag, count = await partitions.count_items(db_session, exact, if_none_match)
+    else:
+        etag, count = await db.run(db_session, crud.count_items, exact, if_none_match)
+    return etags.respond(response, etag, count)
+
+@app.get("/items/changes", response_model=schemas.ItemChangeList)
+async def read_changes(
+    since: Optional[int] = Query(None, ge=0),
+    limit: int = Query(1000, ge=1, le=10000),
+    wait: float = Query(0, ge=0, le=changes.CHANGES_MAX_WAIT),
+    db_session: Any = Depends(db.get_session),
+):
+    """
+    Get the creates, updates and deletes of items after sequence number `since`
+
+    Deleted items have a null `value`. Without `since`, only the current
+    `last_seq` is returned, to follow the changes made after a full read.
+    With `wait`, the request is held for up to that many seconds until there
+    is a change (long polling). Answers 410 when the changes were pruned
+    from the log, in which case the client must read all items again. Not
+    available on a partitioned store, whose shards each log their own changes.
+    """
+    if db.is_sharded(db_session):
+        raise HTTPException(status_code=501, detail="The change feed is not available with partitioned storage")
+    return await changes.wait_for_changes(db_session, since, limit, wait)
+
+@app.get("/items/export")
+async def export_items(accept: Optional[str] = Header(None), db_session: Any = Depends(db.get_session)):
+    """
+    Stream all items as newline-delimited JSON, one `{"id", "value"}` object per line
+
+    Clients that accept `application/vnd.items.columns+x-ndjson` get one
+    `{"ids", "values"}` object per batch of rows instead.
+    """
+    columns = serialization.accepts(accept, serialization.COLUMNS_NDJSON_MEDIA_TYPE)
+    media_type = serialization.COLUMNS_NDJSON_MEDIA_TYPE if columns else "application/x-ndjson"
+    return StreamingResponse(
+        export.stream_items_ndjson(db_session, columns),
+        media_type=media_type,
+        headers={"Vary": "Accept"},
+    )
 
 @app.get("/items/search", response_model=schemas.ItemList)
-def search_items(q: str, db_session: Session = Depends(db.get_db)):
-    """Search items by value"""
-    items = db_session.query(models.Item).filter(models.Item.value.contains(q)).all()
-    return {"items": items}
+async def search_items(
+    response: Response,
+    q: str,
+    limit: int = Query(100, ge=1),
+    cursor: Optional[str] = None,
+    mode: schemas.SearchMode = schemas.SearchMode.substring,
+    if_none_match: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    db_session: Any = Depends(db.get_session),
+):
+    """
+    Search items by value
+
+    Uses the full-text index where possible. Results are paged and
+    negotiated like `GET /items`, except in `ranked` mode which only returns
+    the best `limit` matches.
+    """
+    if cursor is not None and mode is schemas.SearchMode.ranked:
+        raise HTTPException(status_code=400, detail="Ranked search does not support cursors")
+    after_id = _decode_cursor(cursor)
+    columns = serialization.accepts(accept, serialization.COLUMNS_MEDIA_TYPE)
+    if db.is_sharded(db_session):
+        etag, page = await partitions.search_items(
+            db_session, q, mode, limit, after_id, if_none_match, columns or serialization.enabled()
+        )
+    else:
+        etag, page = await db.run(
+            db_session, crud.search_items, q, mode, limit, after_id, if_none_match,
+            columns or serialization.enabled(),
+        )
+    return etags.respond(response, etag, _render_page(response, page, columns))
 
 @app.get("/items/{item_id}", response_model=schemas.Item)
-def read_item(item_id: int, db_session: Session = Depends(db.get_db)):
+async def read_item(
+    item_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    db_session: Any = Depends(db.get_session),
+):
     """Get a specific item by ID"""
-    item = db_session.query(models.Item).filter(models.Item.id == item_id).first()
-    if item is None:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+    db_session = db.route(db_session, item_id)
+    etag, item = await db.run(db_session, crud.read_item, item_id, if_none_match)
+    return etags.respond(response, etag, item)
 
 @app.delete("/items/{item_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_item(item_id: int, db_session: Session = Depends(db.get_db)):
-    """Delete an item by ID"""
-    item = db_session.query(models.Item).filter(models.Item.id == item_id).first()
-    if item is None:
-        raise HTTPException(status_code=404, detail="Item not found")
-    db_session.delete(item)
-    db_session.commit()
+async def delete_item(item_id: int, if_match: Optional[str] = Header(None), db_session: Any = Depends(db.get_session)):
+    """
+    Delete an item by ID
+
+    With If-Match, the item is only deleted if its ETag matches, else the
+    request fails with 412 Precondition Failed.
+    """
+    versions = etags.expected_versions(if_match)
+    db_session = db.route(db_session, item_id)
+    if writes.enabled():
+        await writes.submit(db_session, writes.delete_item, item_id, versions)
+    else:
+        await db.run(db_session, crud.delete_item, item_id, versions)
     return None
 
 @app.put("/items/{item_id}", response_model=schemas.Item)
-def update_item(item_id: int, item: schemas.ItemCreate, db_session: Session = Depends(db.get_db)):
-    """Update an item by ID"""
-    db_item = db_session.query(models.Item).filter(models.Item.id == item_id).first()
-    if db_item is None:
-        raise HTTPException(status_code=404, detail="Item not found")
-    db_item.value = item.value
-    db_session.commit()
-    db_session.refresh(db_item)
-    return db_item
+async def update_item(
+    item_id: int,
+    item: schemas.ItemCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db_session: Any = Depends(db.get_session),
+):
+    """
+    Update an item by ID
+
+    With If-Match, the item is only updated if its ETag matches, else the
+    request fails with 412 Precondition Failed, so concurrent edits do not
+    overwrite each other. The response's ETag is the item's new one.
+    """
+    versions = etags.expected_versions(if_match)
+    db_session = db.route(db_session, item_id)
+    if writes.enabled():
+        updated = await writes.submit(db_session, writes.update_item, item_id, item.value, versions)
+    else:
+        updated = await db.run(db_session, crud.update_item, item_id, item, versions)
+    response.headers["ETag"] = etags.version_etag(updated["version"])
+    return updated
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Request, database and pool metrics of all workers in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/traces")
+def read_traces(
+    limit: int = Query(50, ge=1, le=1000),
+    slow: bool = False,
+    trace_id: Optional[str] = None,
+):
+    """
+    Recent traces of the worker answering, newest first
+
+    Only recorded when TRACING is enabled. `slow=true` keeps the traces
+    over TRACE_SLOW_MS, which include a stack profile.
+    """
+    return {"enabled": tracing.TRACING, "traces": tracing.recent(limit, slow, trace_id)}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Size and evictions of the result cache shared by all workers (hit ratios are in /metrics)"""
+    return {"enabled": result_cache.enabled(), **result_cache.cache.stats()}
 
+@app.get("/ready")
+def readiness_check():
+    """Readiness endpoint: 503 until the worker has warmed up its connections and queries"""
+    if not startup.is_ready():
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    return {"status": "ready"}
 
 @app.get("/health")
 def health_check():
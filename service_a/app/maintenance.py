@@ -0,0 +1,135 @@
+import argparse
+from typing import Any, Dict, List
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from . import models, db
+
+def reconcile_item_count(db_session: Session) -> int:
+    """
+    Recompute the maintained item count from the items table
+
+    The generation is bumped too, so ETags and cached counts change with it.
+
+    Args:
+        db_session: Database session
+
+    Returns:
+        The exact number of items
+    """
+    count = db_session.query(func.count()).select_from(models.Item).scalar()
+    counter = db_session.get(models.Counter, models.ITEM_COUNT)
+    if counter is None:
+        db_session.add(models.Counter(name=models.ITEM_COUNT, value=count))
+    else:
+        counter.value = count
+    db_session.query(models.Counter).filter(models.Counter.name == models.GENERATION).update(
+        {models.Counter.value: models.Counter.value + 1}
+    )
+    db_session.commit()
+    return count
+
+def split_shard(map_path: str, index: int, url: str) -> db.ShardMap:
+    """
+    Split a shard of a partitioned store in two, moving half of its items to a new database
+
+    The shard with modulus m and residue r keeps the items whose ID % 2m == r,
+    and the new one at `url` gets those whose ID % 2m == r + m. The items are
+    copied first, then the map is saved, then they are deleted from the
+    shard, so every item stays reachable if the split is interrupted. Both
+    shards continue the shard's ID sequence, so no ID is ever reused. Run it
+    while Service A is stopped, since workers read the map when they start.
+
+    Args:
+        map_path: The SHARD_MAP file; a missing file is a single shard on
+            DATABASE_URL
+        index: Position of the shard in the map
+        url: SQLAlchemy URL of the new, empty SQLite database
+
+    Returns:
+        The new map
+    """
+    shard_map = db.ShardMap.load(map_path, db.DATABASE_URL)
+    shard = shard_map.shards[index]
+    modulus, moved_residue = shard.modulus * 2, shard.residue + shard.modulus
+    kept = db.Shard(shard.url, modulus, shard.residue)
+    new = db.Shard(url, modulus, moved_residue)
+    models.prepare_schema(shard.engine)
+    models.prepare_schema(new.engine)
+
+    items = models.Item.__table__
+    sequence = models.sqlite_sequence
+    with shard.engine.connect() as source, new.engine.connect() as target:
+        if target.scalar(select(func.count()).select_from(items)):
+            raise ValueError(f"The new shard's database already has items: {url}")
+        rows = source.execution_options(yield_per=1000).execute(
+            select(items.c.id, items.c.value, items.c.version).where(items.c.id % modulus == moved_residue)
+        )
+        for batch in rows.partitions():
+            target.execute(insert(items), [dict(row._mapping) for row in batch])
+        # Databases created before items had AUTOINCREMENT have no sequence row
+        last_id = max(
+            source.scalar(select(sequence.c.seq).where(sequence.c.name == items.name)) or 0,
+            source.scalar(select(func.max(items.c.id))) or 0,
+        )
+        target.execute(delete(sequence).where(sequence.c.name == items.name))
+        target.execute(insert(sequence).values(name=items.name, seq=last_id))
+        target.commit()
+        source.rollback()
+
+    shards = list(shard_map.shards)
+    shards[index:index + 1] = [kept, new]
+    new_map = db.ShardMap(shards)
+    new_map.save(map_path)
+
+    with shard.engine.connect() as source:
+        source.execute(delete(items).where(items.c.id % modulus == moved_residue))
+        source.commit()
+        # VACUUM cannot run in a transaction, and the engine begins one for every statement
+        source.connection.driver_connection.execute("VACUUM")
+    shard_map.dispose()
+    return new_map
+
+def shard_stats(shard_map: db.ShardMap) -> List[Dict[str, Any]]:
+    """Item count of each shard, to find the one to split"""
+    stats = []
+    for shard in shard_map.shards:
+        with Session(bind=shard.engine) as db_session:
+            counter = db_session.get(models.Counter, models.ITEM_COUNT)
+        stats.append({
+            "url": shard.url,
+            "modulus": shard.modulus,
+            "residue": shard.residue,
+            "items": counter.value if counter is not None else None,
+        })
+    return stats
+
+def main() -> None:
+    """Run a maintenance command against DATABASE_URL, or every shard with SHARD_MAP"""
+    parser = argparse.ArgumentParser(description="Service A maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("reconcile-count", help="Recompute the maintained item count")
+    subparsers.add_parser("shards", help="List the shards of SHARD_MAP and their item counts")
+    split = subparsers.add_parser("split-shard", help="Move half of a shard's items to a new database")
+    split.add_argument("index", type=int, help="position of the shard in the map")
+    split.add_argument("url", help="SQLAlchemy URL of the new SQLite database")
+    args = parser.parse_args()
+
+    if args.command == "reconcile-count":
+        factories = [shard.SessionLocal for shard in db.shard_map.shards] if db.shard_map else [db.SessionLocal]
+        for session_factory in factories:
+            with session_factory() as db_session:
+                count = reconcile_item_count(db_session)
+            print(f"Item count reconciled: {count}")
+    elif not db.SHARD_MAP:
+        parser.error("SHARD_MAP must be set to the shard map file")
+    elif args.command == "shards":
+        for index, stats in enumerate(shard_stats(db.shard_map)):
+            print(f"{index}: {stats['url']} (ID % {stats['modulus']} == {stats['residue']}) {stats['items']} items")
+    elif args.command == "split-shard":
+        new_map = split_shard(db.SHARD_MAP, args.index, args.url)
+        print(f"Shard {args.index} split; the map now has {len(new_map.shards)} shards")
+
+if __name__ == "__main__":
+    main()
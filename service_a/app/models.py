@@ -1,9 +1,249 @@
-from sqlalchemy import Column, Integer, String
-from .db import Base
+from sqlalchemy import Column, Integer, String, column, event, func, select, table
+from sqlalchemy.exc import OperationalError
+from typing import Any
+
+from .db import Base, SQLITE_BEGIN
 
 class Item(Base):
     """SQLAlchemy model for the items table"""
     __tablename__ = "items"
+    # Never reuse the IDs of deleted items, so an ID and version always
+    # identify the same content
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
-    value = Column(String, nullable=False)
\ No newline at end of file
+    value = Column(String, nullable=False)
+    # Incremented by every update of the row; used for its ETag
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+class Counter(Base):
+    """SQLAlchemy model for named counters maintained by database triggers"""
+    __tablename__ = "counters"
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+class ItemChange(Base):
+    """SQLAlchemy model for the log of writes to the items table, filled by database triggers"""
+    __tablename__ = "item_changes"
+    # Sequence numbers only ever increase, even after old entries are pruned
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    item_id = Column(Integer, nullable=False)
+    value = Column(String, nullable=True)  # None when the item was deleted
+
+# SQLite's table of AUTOINCREMENT sequences: the largest ID ever used per table
+sqlite_sequence = table("sqlite_sequence", column("name"), column("seq"))
+
+def next_item_id(modulus: int, residue: int) -> Any:
+    """
+    SQL expression for the ID of an item inserted into a shard
+
+    It is the smallest ID with ID % modulus == residue above any the shard
+    ever used. Inserting it advances the shard's AUTOINCREMENT sequence, so
+    the IDs of deleted items are not reused either. Items tables created
+    before they had AUTOINCREMENT have no sequence, so the largest ID in
+    the table counts too.
+    """
+    seq = func.max(
+        func.coalesce(
+            select(sqlite_sequence.c.seq).where(sqlite_sequence.c.name == Item.__tablename__).scalar_subquery(), 0
+        ),
+        func.coalesce(select(func.max(Item.id)).scalar_subquery(), 0),
+    )
+    return seq + 1 + ((residue - seq - 1) % modulus + modulus) % modulus
+
+# Name of the counter holding the number of rows in the items table
+ITEM_COUNT = "items"
+
+# Name of the counter bumped by every write to the items table
+GENERATION = "generation"
+
+def add_missing_columns(connection) -> None:
+    """Add columns introduced after a database was created"""
+    if connection.dialect.name != "sqlite":
+        return
+    columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(items)")}
+    if "version" not in columns:
+        connection.exec_driver_sql(
+            "ALTER TABLE items ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+        )
+
+# SQLite FTS5 trigram index over items.value. It is an external content table,
+# so it stores only the index and is kept in sync with items by triggers.
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5("
+    "value, content='items', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN "
+    "INSERT INTO items_fts(rowid, value) VALUES (new.id, new.value); END",
+    "CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN "
+    "INSERT INTO items_fts(items_fts, rowid, value) VALUES ('delete', old.id, old.value); END",
+    "CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF value ON items BEGIN "
+    "INSERT INTO items_fts(items_fts, rowid, value) VALUES ('delete', old.id, old.value); "
+    "INSERT INTO items_fts(rowid, value) VALUES (new.id, new.value); END",
+]
+
+def install_search_index(connection) -> bool:
+    """
+    Create the search index and its triggers if they do not exist yet
+
+    An index created for an already populated items table is rebuilt from it.
+
+    Returns:
+        True if the index is available, False if the database does not
+        support it (not SQLite, or SQLite built without FTS5)
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'items_fts'"
+    ).first()
+    try:
+        for statement in SEARCH_INDEX_DDL:
+            connection.exec_driver_sql(statement)
+    except OperationalError:
+        return False
+    if not exists:
+        connection.exec_driver_sql("INSERT INTO items_fts(items_fts) VALUES ('rebuild')")
+    return True
+
+# Triggers keeping the ITEM_COUNT counter equal to the number of items, so
+# counting is a primary key lookup instead of a table scan.
+ITEM_COUNT_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS items_count_insert AFTER INSERT ON items BEGIN "
+    f"UPDATE counters SET value = value + 1 WHERE name = '{ITEM_COUNT}'; END",
+    "CREATE TRIGGER IF NOT EXISTS items_count_delete AFTER DELETE ON items BEGIN "
+    f"UPDATE counters SET value = value - 1 WHERE name = '{ITEM_COUNT}'; END",
+]
+
+def install_item_count(connection) -> bool:
+    """
+    Create the item count triggers and counter row if they do not exist yet
+
+    A new counter row starts at the current number of items.
+
+    Returns:
+        True if the counter is maintained, False if the database is not SQLite
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    for statement in ITEM_COUNT_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(
+        "INSERT OR IGNORE INTO counters (name, value) "
+        f"SELECT '{ITEM_COUNT}', COUNT(*) FROM items"
+    )
+    return True
+
+# Triggers bumping the GENERATION counter on every write, so a client can
+# tell whether anything in the table changed with a primary key lookup. It
+# starts at the creation time in microseconds, so a database created again
+# does not reuse the generations (and ETags) of the one it replaced.
+GENERATION_DDL = [
+    f"CREATE TRIGGER IF NOT EXISTS items_generation_{event} AFTER {event.upper()} ON items BEGIN "
+    f"UPDATE counters SET value = value + 1 WHERE name = '{GENERATION}'; END"
+    for event in ("insert", "update", "delete")
+]
+
+def install_generation(connection) -> bool:
+    """
+    Create the generation triggers and counter row if they do not exist yet
+
+    Returns:
+        True if the generation is maintained, False if the database is not SQLite
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    for statement in GENERATION_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(
+        "INSERT OR IGNORE INTO counters (name, value) "
+        f"VALUES ('{GENERATION}', CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER))"
+    )
+    return True
+
+# Number of most recent changes kept in the change log. Older entries are
+# pruned a thousand at a time; clients further behind must start over.
+CHANGE_LOG_RETENTION = 100000
+
+# Triggers appending every create, update and delete of an item to the
+# change log, and pruning the log.
+CHANGE_LOG_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS items_changes_insert AFTER INSERT ON items BEGIN "
+    "INSERT INTO item_changes (item_id, value) VALUES (new.id, new.value); END",
+    "CREATE TRIGGER IF NOT EXISTS items_changes_update AFTER UPDATE OF value ON items BEGIN "
+    "INSERT INTO item_changes (item_id, value) VALUES (new.id, new.value); END",
+    "CREATE TRIGGER IF NOT EXISTS items_changes_delete AFTER DELETE ON items BEGIN "
+    "INSERT INTO item_changes (item_id, value) VALUES (old.id, NULL); END",
+    "CREATE TRIGGER IF NOT EXISTS item_changes_prune AFTER INSERT ON item_changes "
+    "WHEN new.seq % 1000 = 0 BEGIN "
+    f"DELETE FROM item_changes WHERE seq <= new.seq - {CHANGE_LOG_RETENTION}; END",
+]
+
+def install_change_log(connection) -> bool:
+    """
+    Create the change log triggers if they do not exist yet
+
+    Returns:
+        True if the change log is maintained, False if the database is not SQLite
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    for statement in CHANGE_LOG_DDL:
+        connection.exec_driver_sql(statement)
+    return True
+
+def install_triggers(connection) -> None:
+    """Create the search index, item count, generation and change log if they do not exist yet"""
+    install_search_index(connection)
+    install_item_count(connection)
+    install_generation(connection)
+    install_change_log(connection)
+
+# Bump whenever the tables, add_missing_columns or install_triggers change,
+# so existing databases are upgraded once by the next start
+SCHEMA_VERSION = 1
+
+def prepare_schema(engine) -> bool:
+    """
+    Create or upgrade the schema unless the database is already up to date
+
+    SQLite databases record SCHEMA_VERSION in PRAGMA user_version, so an up
+    to date database costs a single PRAGMA read. The upgrade holds the write
+    lock from the start, so workers starting together wait for the first
+    one and then find nothing left to do.
+
+    Returns:
+        True if the schema was created or upgraded
+    """
+    if engine.dialect.name != "sqlite":
+        with engine.begin() as connection:
+            Base.metadata.create_all(bind=connection)
+            add_missing_columns(connection)
+            install_triggers(connection)
+        return True
+    with engine.connect() as connection:
+        if connection.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            return False
+        connection.rollback()
+        connection.execution_options(**{SQLITE_BEGIN: "BEGIN IMMEDIATE"})
+        if connection.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            connection.rollback()
+            return False
+        Base.metadata.create_all(bind=connection)
+        # Databases created before the current columns and triggers existed
+        add_missing_columns(connection)
+        install_triggers(connection)
+        connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.commit()
+    return True
+
+@event.listens_for(Base.metadata, "after_create")
+def _install_triggers(target, connection, **kw):
+    install_triggers(connection)
+
+@event.listens_for(Base.metadata, "after_drop")
+def _drop_search_index(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("DROP TABLE IF EXISTS items_fts")
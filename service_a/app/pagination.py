@@ -0,0 +1,24 @@
+import base64
+import json
+
+def encode_cursor(last_id: int) -> str:
+    """Encode the ID of the last item on a page as an opaque cursor"""
+    payload = json.dumps({"id": last_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    """
+    Decode a cursor created by encode_cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        last_id = payload["id"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError("Invalid cursor")
+    return last_id
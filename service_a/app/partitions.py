@@ -0,0 +1,177 @@
+import asyncio
+import heapq
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from . import crud, db, etags, pagination, schemas, search, serialization
+
+# Scatter-gather versions of the reads and bulk writes in crud.py for a
+# partitioned store (see db.ShardMap). The crud function runs on every shard
+# involved in parallel, and the results are merged in ID order. Collection
+# ETags combine the generations of all shards.
+
+def _merge_pages(pages: List[Dict[str, Any]], skip: int, limit: int, rows: bool) -> Dict[str, Any]:
+    """
+    Merge pages of (id, value) rows read from each shard into one
+
+    Each shard page holds the first `skip + limit` matching rows of its shard
+    and a next cursor if it has more, so the merged page is complete.
+    """
+    merged = list(islice(heapq.merge(*(page["items"] for page in pages), key=itemgetter(0)), skip, skip + limit + 1))
+    items = merged[:limit]
+    next_cursor = None
+    if items and (len(merged) > limit or any(page["next_cursor"] for page in pages)):
+        next_cursor = pagination.encode_cursor(items[-1][0])
+    if not rows:
+        items = serialization.item_dicts(items)
+    return {"items": items, "next_cursor": next_cursor}
+
+async def read_items(
+    db_session: db.ShardedSession,
+    skip: int,
+    limit: int,
+    after_id: Optional[int],
+    if_none_match: Optional[str],
+    rows: bool = False,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Get a page of items ordered by ID from every shard, like crud.read_items"""
+    if after_id is not None:
+        skip = 0
+    results = await db.gather(db_session, crud.read_items, 0, skip + limit, after_id, None, True)
+    etag = etags.combine([shard_etag for shard_etag, _ in results])
+    if etags.matches(if_none_match, etag):
+        return etag, None
+    return etag, _merge_pages([page for _, page in results], skip, limit, rows)
+
+def _ranked_search(db_session: Session, q: str, limit: int) -> Tuple[Optional[str], List[Any]]:
+    """Best matches of a shard as (id, value, rank) rows, with the shard's collection ETag"""
+    etag = etags.collection_etag(db_session)
+    return etag, search.search_items(db_session, q, schemas.SearchMode.ranked, limit, rank=True)
+
+async def search_items(
+    db_session: db.ShardedSession,
+    q: str,
+    mode: schemas.SearchMode,
+    limit: int,
+    after_id: Optional[int],
+    if_none_match: Optional[str],
+    rows: bool = False,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Search every shard, like crud.search_items
+
+    Ranked results are merged by the rank each shard's index gives them,
+    which is computed from that shard's own term statistics.
+    """
+    if mode is not schemas.SearchMode.ranked:
+        results = await db.gather(db_session, crud.search_items, q, mode, limit, after_id, None, True)
+        etag = etags.combine([shard_etag for shard_etag, _ in results])
+        if etags.matches(if_none_match, etag):
+            return etag, None
+        return etag, _merge_pages([page for _, page in results], 0, limit, rows)
+
+    results = await db.gather(db_session, _ranked_search, q, limit)
+    etag = etags.combine([shard_etag for shard_etag, _ in results])
+    if etags.matches(if_none_match, etag):
+        return etag, None
+    # Without the index, shards return matches in ID order and no rank
+    merged = heapq.merge(*(shard_rows for _, shard_rows in results), key=lambda row: (row[2] or 0, row[0]))
+    items = [(item_id, value) for item_id, value, _ in islice(merged, limit)]
+    return etag, {"items": items if rows else serialization.item_dicts(items), "next_cursor": None}
+
+async def count_items(
+    db_session: db.ShardedSession,
+    exact: bool,
+    if_none_match: Optional[str],
+) -> Tuple[Optional[str], Optional[int]]:
+    """Count the items of every shard, like crud.count_items"""
+    results = await db.gather(db_session, crud.count_items, exact, None)
+    etag = etags.combine([shard_etag for shard_etag, _ in results])
+    if etags.matches(if_none_match, etag):
+        return etag, None
+    return etag, sum(count for _, count in results)
+
+async def lookup_items(db_session: db.ShardedSession, ids: List[int]) -> Dict[str, Any]:
+    """Get many items by ID from the shards holding them, in the order requested"""
+    requested_ids = list(dict.fromkeys(ids))
+    groups = db.sessions_by_shard(db_session, requested_ids)
+    results = await asyncio.gather(*(
+        db.run(shard_session, crud.lookup_items, [requested_ids[position] for position in positions])
+        for shard_session, positions in groups
+    ))
+    found = {item.id: item for result in results for item in result["items"]}
+    return {
+        "items": [found[item_id] for item_id in requested_ids if item_id in found],
+        "missing": [item_id for item_id in requested_ids if item_id not in found],
+    }
+
+async def _write_by_shard(
+    db_session: db.ShardedSession,
+    item_ids: List[int],
+    atomic: bool,
+    fn: Callable[..., Dict[str, Any]],
+    sub_batch: Callable[[List[int]], Any],
+) -> Dict[str, Any]:
+    """
+    Apply a bulk write on each shard holding some of its items, in parallel
+
+    Each shard applies its part in one transaction, but the shards cannot
+    commit together, so an atomic batch spanning several shards is only
+    atomic per shard. Its items are looked up first and the batch fails
+    with a 404 if any is missing; an item deleted by a concurrent write
+    after that check still fails its shard's part while the other shards
+    apply theirs.
+
+    Args:
+        item_ids: IDs of the batch's rows
+        fn: crud bulk write, called as fn(session, sub_batch(positions))
+        sub_batch: Builds the batch of the rows at these positions
+
+    Returns:
+        The `ids` written and `errors`, indexed in the whole batch
+    """
+    groups = db.sessions_by_shard(db_session, item_ids)
+    if atomic and len(groups) > 1:
+        missing = set((await lookup_items(db_session, item_ids))["missing"])
+        if missing:
+            errors = [
+                schemas.BulkError(index=index, id=item_id, detail="Item not found")
+                for index, item_id in enumerate(item_ids)
+                if item_id in missing
+            ]
+            raise HTTPException(status_code=404, detail=[error.model_dump() for error in errors])
+
+    results = await asyncio.gather(*(
+        db.run(shard_session, fn, sub_batch(positions)) for shard_session, positions in groups
+    ))
+    written: Dict[int, int] = {}
+    errors = []
+    for (_, positions), result in zip(groups, results):
+        failed = {error.index for error in result["errors"]}
+        succeeded = [position for index, position in enumerate(positions) if index not in failed]
+        written.update(zip(succeeded, result["ids"]))
+        errors.extend(error.model_copy(update={"index": positions[error.index]}) for error in result["errors"])
+    return {
+        "ids": [written[position] for position in sorted(written)],
+        "errors": sorted(errors, key=lambda error: error.index),
+    }
+
+async def update_items_bulk(db_session: db.ShardedSession, batch: schemas.BulkItemUpdate) -> Dict[str, Any]:
+    """Update many items on the shards holding them, like crud.update_items_bulk"""
+    return await _write_by_shard(
+        db_session, [item.id for item in batch.items], batch.atomic, crud.update_items_bulk,
+        lambda positions: schemas.BulkItemUpdate(
+            items=[batch.items[position] for position in positions], atomic=batch.atomic
+        ),
+    )
+
+async def delete_items_bulk(db_session: db.ShardedSession, batch: schemas.BulkItemDelete) -> Dict[str, Any]:
+    """Delete many items on the shards holding them, like crud.delete_items_bulk"""
+    return await _write_by_shard(
+        db_session, batch.ids, batch.atomic, crud.delete_items_bulk,
+        lambda positions: schemas.BulkItemDelete(ids=[batch.ids[position] for position in positions], atomic=batch.atomic),
+    )
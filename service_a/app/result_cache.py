@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from service_common import metrics
+
+from . import serialization
+
+# Cache read results in an SQLite file shared by every worker on the host,
+# in /dev/shm (memory) where it exists. Entries are keyed by the database,
+# the items table generation and the normalized query, so every write, from
+# any worker, makes the entries of older generations unreachable; they are
+# deleted by the next insertion. The least recently used entries are evicted
+# to keep the cached results under RESULT_CACHE_MAX_BYTES. Single items are
+# not cached: their primary key lookup is cheaper than reading the generation
+# and the cache.
+#
+# Lookups only read. An entry used again is marked recently used at most once
+# per RESULT_CACHE_TOUCH_INTERVAL seconds, and those marks are written in
+# batches of RESULT_CACHE_TOUCH_BATCH or with the next insertion, so the LRU
+# order is approximate. Writes never wait for the file's write lock: while
+# another worker holds it, the result is simply not stored, since they may
+# run on the event loop and a miss is cheap.
+RESULT_CACHE = os.getenv("RESULT_CACHE", "false").lower() in ("1", "true", "yes")
+RESULT_CACHE_PATH = os.getenv(
+    "RESULT_CACHE_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "service-a-result-cache.db"),
+)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TOUCH_INTERVAL = float(os.getenv("RESULT_CACHE_TOUCH_INTERVAL", "1"))
+RESULT_CACHE_TOUCH_BATCH = int(os.getenv("RESULT_CACHE_TOUCH_BATCH", "64"))
+
+logger = logging.getLogger(__name__)
+
+# Totals kept by triggers, in the style of the items count, so the byte
+# budget is checked without summing the entries
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS entries ("
+    " key TEXT PRIMARY KEY, database TEXT NOT NULL, generation INTEGER NOT NULL,"
+    " value BLOB NOT NULL, size INTEGER NOT NULL, used INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)",
+    "CREATE INDEX IF NOT EXISTS entries_generation ON entries (database, generation)",
+    "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO stats (name, value) VALUES ('bytes', 0), ('entries', 0), ('evictions', 0)",
+    "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN"
+    " UPDATE stats SET value = value + NEW.size WHERE name = 'bytes';"
+    " UPDATE stats SET value = value + 1 WHERE name = 'entries'; END",
+    "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN"
+    " UPDATE stats SET value = value - OLD.size WHERE name = 'bytes';"
+    " UPDATE stats SET value = value - 1 WHERE name = 'entries'; END",
+]
+
+RESULT_CACHE_REQUESTS_TOTAL = metrics.Counter(
+    "result_cache_requests_total", "Shared result cache lookups by kind and result", ("kind", "result")
+)
+
+RESULT_CACHE_WRITES_SKIPPED_TOTAL = metrics.Counter(
+    "result_cache_writes_skipped_total", "Shared result cache writes skipped because another worker was writing"
+)
+
+def _locked(error: sqlite3.OperationalError) -> bool:
+    """Whether an error is SQLITE_BUSY, i.e. another connection holds the lock"""
+    return "database is locked" in str(error)
+
+class SharedCache:
+    """
+    LRU cache of JSON values in an SQLite file, shared by processes
+
+    Each process opens its own connection on first use (also after a fork),
+    used by one thread at a time. Lookups are plain reads, which never wait
+    for writers in WAL mode; hits and misses are counted by the
+    RESULT_CACHE_REQUESTS_TOTAL metric. Any SQLite error is logged and
+    treated as a miss: the cache never fails a request.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        # Recently used entries not yet marked as such in the file, by key
+        self._touched: Dict[str, int] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            # Workers starting together wait for the first one to create the schema
+            connection.execute("PRAGMA busy_timeout=1000")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("PRAGMA busy_timeout=0")
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def _transaction(self, fn, *args, wait: bool = False) -> Any:
+        """
+        Run fn(connection, *args) in a write transaction, with the recently used marks
+
+        Unless `wait` is set, it is skipped (returning None) while another
+        process holds the write lock, instead of waiting for it.
+        """
+        with self._lock:
+            try:
+                connection = self._connect()
+                if wait:
+                    connection.execute("PRAGMA busy_timeout=1000")
+                try:
+                    connection.execute("BEGIN IMMEDIATE")
+                finally:
+                    if wait:
+                        connection.execute("PRAGMA busy_timeout=0")
+                try:
+                    self._write_touches(connection)
+                    result = fn(connection, *args)
+                    connection.execute("COMMIT")
+                    return result
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+            except sqlite3.OperationalError as error:
+                if _locked(error):
+                    RESULT_CACHE_WRITES_SKIPPED_TOTAL.inc()
+                    return None
+                logger.warning("Result cache unavailable: %s", error)
+                return None
+            except sqlite3.Error as error:
+                logger.warning("Result cache unavailable: %s", error)
+                return None
+
+    def _read(self, sql: str, *params: Any) -> Optional[list]:
+        """Rows of a query run outside of any transaction, or None if the cache is unavailable"""
+        with self._lock:
+            try:
+                return self._connect().execute(sql, params).fetchall()
+            except sqlite3.Error as error:
+                logger.warning("Result cache unavailable: %s", error)
+                return None
+
+    def _write_touches(self, connection: sqlite3.Connection) -> None:
+        if self._touched:
+            touched, self._touched = self._touched, {}
+            connection.executemany(
+                "UPDATE entries SET used = ? WHERE key = ?", [(used, key) for key, used in touched.items()]
+            )
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """Get a value, or None on a miss"""
+        rows = self._read("SELECT value, used FROM entries WHERE key = ?", key)
+        RESULT_CACHE_REQUESTS_TOTAL.labels(kind, "hit" if rows else "miss").inc()
+        if not rows:
+            return None
+        value, used = rows[0]
+        now = time.time_ns()
+        if now - used >= RESULT_CACHE_TOUCH_INTERVAL * 1e9:
+            with self._lock:
+                self._touched[key] = now
+                pending = len(self._touched)
+            if pending >= RESULT_CACHE_TOUCH_BATCH:
+                self._transaction(lambda connection: None)
+        return json.loads(value)
+
+    def put(self, key: str, database: str, generation: int, value: Any) -> None:
+        """
+        Store a value computed at a generation of a database
+
+        Entries of older generations of the same database are deleted first,
+        then the least recently used ones until the cache fits its budget.
+        Values larger than the whole budget are not stored.
+        """
+        data = serialization.dumps(value)
+        if len(data) > self.max_bytes:
+            return
+
+        def store(connection: sqlite3.Connection) -> None:
+            connection.execute(
+                "DELETE FROM entries WHERE key = ? OR (database = ? AND generation < ?)", (key, database, generation)
+            )
+            # Not INSERT OR REPLACE, which would skip the delete trigger
+            connection.execute(
+                "INSERT INTO entries (key, database, generation, value, size, used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, database, generation, data, len(data), time.time_ns()),
+            )
+            excess = connection.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0] - self.max_bytes
+            if excess <= 0:
+                return
+            evicted = []
+            for evicted_key, size in connection.execute("SELECT key, size FROM entries ORDER BY used"):
+                evicted.append((evicted_key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            if evicted:
+                connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+                connection.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (len(evicted),))
+
+        self._transaction(store)
+
+    def clear(self) -> None:
+        """Delete every entry and reset the eviction counter"""
+
+        def delete(connection: sqlite3.Connection) -> None:
+            connection.execute("DELETE FROM entries")
+            connection.execute("UPDATE stats SET value = 0 WHERE name = 'evictions'")
+
+        self._transaction(delete, wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Size of the cache and evictions, for every process together"""
+        counters = dict(self._read("SELECT name, value FROM stats") or ())
+        return {
+            "entries": counters.get("entries", 0),
+            "bytes": counters.get("bytes", 0),
+            "max_bytes": self.max_bytes,
+            "evictions": counters.get("evictions", 0),
+        }
+
+cache = SharedCache(RESULT_CACHE_PATH, RESULT_CACHE_MAX_BYTES)
+
+def enabled() -> bool:
+    """Whether reads go through the shared result cache"""
+    return RESULT_CACHE
+
+def key(db_session: Session, kind: str, generation: int, *params: Any) -> Tuple[str, str]:
+    """
+    Key of a result, with the database it was read from
+
+    Params are the normalized query: only what changes the result, in a
+    fixed order, independent of the response format.
+    """
+    database = str(db_session.get_bind().url)
+    return f"{database}|{generation}|{kind}|{json.dumps(params)}", database
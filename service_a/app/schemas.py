@@ -1,4 +1,5 @@
-from pydantic import BaseModel, ConfigDict
+from enum import Enum
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional
 
 class ItemBase(BaseModel):
@@ -18,3 +19,63 @@ class Item(ItemBase):
 class ItemList(BaseModel):
     """Pydantic model for returning a list of Items"""
     items: List[Item]
+    next_cursor: Optional[str] = None
+
+# Maximum number of rows accepted by one bulk request
+MAX_BULK_ITEMS = 10000
+
+class BulkItemCreate(BaseModel):
+    """Pydantic model for creating many Items in one request"""
+    items: List[ItemCreate] = Field(..., max_length=MAX_BULK_ITEMS)
+    atomic: bool = True  # False applies the rows that succeed and reports the rest
+
+class BulkItemUpdate(BaseModel):
+    """Pydantic model for updating many Items in one request"""
+    items: List[Item] = Field(..., max_length=MAX_BULK_ITEMS)
+    atomic: bool = True
+
+class BulkItemDelete(BaseModel):
+    """Pydantic model for deleting many Items in one request"""
+    ids: List[int] = Field(..., max_length=MAX_BULK_ITEMS)
+    atomic: bool = True
+
+class BulkError(BaseModel):
+    """Pydantic model for a row of a bulk request that could not be applied"""
+    index: int
+    id: Optional[int] = None
+    detail: str
+
+class BulkResult(BaseModel):
+    """Pydantic model for the result of a bulk request"""
+    ids: List[int]
+    errors: List[BulkError] = []
+
+# Maximum number of IDs accepted by one lookup request
+MAX_LOOKUP_IDS = 1000
+
+class ItemLookup(BaseModel):
+    """Pydantic model for getting many Items by ID"""
+    ids: List[int] = Field(..., max_length=MAX_LOOKUP_IDS)
+
+class ItemLookupResult(BaseModel):
+    """Pydantic model for returning the Items found by a lookup"""
+    items: List[Item]
+    missing: List[int]
+
+class ItemChange(BaseModel):
+    """Pydantic model for an entry of the items change log"""
+    seq: int
+    id: int
+    value: Optional[str] = None  # None when the item was deleted
+
+class ItemChangeList(BaseModel):
+    """Pydantic model for returning the changes after a sequence number"""
+    changes: List[ItemChange]
+    last_seq: int  # Pass as `since` to get the next changes
+
+class SearchMode(str, Enum):
+    """How /items/search matches and orders items"""
+    substring = "substring"  # value contains the query, ordered by ID
+    prefix = "prefix"  # value starts with the query, ordered by ID
+    ranked = "ranked"  # value contains the query, best matches first
+    scan = "scan"  # unindexed LIKE scan, for exact substring semantics
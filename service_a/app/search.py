@@ -0,0 +1,93 @@
+import weakref
+from typing import Any, List, Optional
+
+from sqlalchemy import column, null, table, text
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+
+# The trigram tokenizer cannot match queries shorter than three characters
+MIN_INDEXED_QUERY_LENGTH = 3
+
+items_fts = table("items_fts", column("rowid"), column("rank"))
+
+# Whether the search index exists, cached per engine
+_index_available = weakref.WeakKeyDictionary()
+
+def index_available(db_session: Session) -> bool:
+    """Check whether the database behind the session has the search index"""
+    bind = db_session.get_bind()
+    available = _index_available.get(bind)
+    if available is None:
+        available = bind.dialect.name == "sqlite" and db_session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'items_fts'")
+        ).first() is not None
+        _index_available[bind] = available
+    return available
+
+def _match_phrase(q: str) -> str:
+    """Quote a query as an FTS5 phrase so its characters are matched literally"""
+    return '"' + q.replace('"', '""') + '"'
+
+def search_items(
+    db_session: Session,
+    q: str,
+    mode: schemas.SearchMode,
+    limit: int,
+    after_id: Optional[int] = None,
+    rows: bool = False,
+    rank: bool = False,
+) -> List[Any]:
+    """
+    Find items whose value matches a query
+
+    Queries of at least three characters use the trigram index; shorter ones,
+    and `mode=scan`, fall back to a LIKE scan. Matching is case-insensitive.
+
+    Args:
+        db_session: Database session
+        q: Search query
+        mode: How to match and order results
+        limit: Maximum number of items to return
+        after_id: Only return items with a greater ID (ignored for ranked search)
+        rows: Return (id, value) rows instead of Item entities
+        rank: Return (id, value, rank) rows, with the full-text rank of
+            ranked searches (lower is better) or else None
+
+    Returns:
+        Matching items, in ID order or by relevance for ranked search
+    """
+    use_index = (
+        mode is not schemas.SearchMode.scan
+        and len(q) >= MIN_INDEXED_QUERY_LENGTH
+        and index_available(db_session)
+    )
+    if rank:
+        rank_column = items_fts.c.rank if mode is schemas.SearchMode.ranked and use_index else null()
+        query = db_session.query(models.Item.id, models.Item.value, rank_column)
+    elif rows:
+        query = db_session.query(models.Item.id, models.Item.value)
+    else:
+        query = db_session.query(models.Item)
+
+    if mode is schemas.SearchMode.prefix:
+        query = query.filter(models.Item.value.startswith(q, autoescape=True))
+    elif not use_index:
+        query = query.filter(models.Item.value.contains(q, autoescape=True))
+
+    if use_index:
+        query = query.join(items_fts, items_fts.c.rowid == models.Item.id).filter(
+            text("items_fts MATCH :match").bindparams(match=_match_phrase(q))
+        )
+        id_column = items_fts.c.rowid
+    else:
+        id_column = models.Item.id
+
+    if mode is schemas.SearchMode.ranked and use_index:
+        query = query.order_by(items_fts.c.rank, id_column)
+    else:
+        if after_id is not None:
+            query = query.filter(id_column > after_id)
+        query = query.order_by(id_column)
+
+    return query.limit(limit).all()
@@ -0,0 +1,68 @@
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Optional, the stdlib encoder is used without it
+    orjson = None
+
+# Serve list responses from (id, value) rows encoded straight to JSON,
+# skipping the ORM entities and the response model validation. The rows come
+# from the database, so they already have the shape of schemas.Item.
+FAST_SERIALIZATION = os.getenv("FAST_SERIALIZATION", "false").lower() in ("1", "true", "yes")
+
+# Compact list format for clients that ask for it with Accept: parallel
+# arrays of IDs and values instead of one object per item. Exports in this
+# format are NDJSON with one such object per batch of rows.
+COLUMNS_MEDIA_TYPE = "application/vnd.items.columns+json"
+COLUMNS_NDJSON_MEDIA_TYPE = "application/vnd.items.columns+x-ndjson"
+
+def enabled() -> bool:
+    """Whether list responses use the fast serialization path"""
+    return FAST_SERIALIZATION
+
+def dumps(content: Any) -> bytes:
+    """Encode a value as compact JSON, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with `dumps`"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def item_dicts(rows: Iterable[Any]) -> List[Dict[str, Any]]:
+    """Turn (id, value) rows into item dicts"""
+    return [{"id": item_id, "value": value} for item_id, value in rows]
+
+def item_columns(rows: Iterable[Any]) -> Dict[str, List[Any]]:
+    """Turn (id, value) rows into parallel `ids` and `values` arrays"""
+    ids = []
+    values = []
+    for item_id, value in rows:
+        ids.append(item_id)
+        values.append(value)
+    return {"ids": ids, "values": values}
+
+def accepts(accept: Optional[str], media_type: str) -> bool:
+    """Check whether an Accept header explicitly lists a media type (with a non-zero q)"""
+    if not accept:
+        return False
+    for part in accept.split(","):
+        name, *params = (piece.strip() for piece in part.split(";"))
+        if name.lower() != media_type:
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
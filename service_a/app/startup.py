@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import os
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from . import db, crud, changes, schemas
+
+# Warm each worker up before /ready reports it ready: open the pool's
+# connections and run every kind of read once, so SQLAlchemy has compiled
+# and cached their statements and SQLite has loaded the pages they touch
+# (on every shard of a partitioned store).
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true", "yes")
+
+# Seconds between attempts when the warm-up fails, e.g. while the database
+# is locked by another worker's schema upgrade
+WARMUP_RETRY_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+_ready = not STARTUP_WARMUP
+
+def is_ready() -> bool:
+    """Whether this worker finished warming up"""
+    return _ready
+
+def warm_up_queries(db_session: Session) -> None:
+    """Run each read the endpoints make once, with both row formats"""
+    for rows in (False, True):
+        crud.read_items(db_session, 0, 1, None, None, rows)
+        crud.search_items(db_session, "warm", schemas.SearchMode.substring, 1, None, None, rows)
+    crud.count_items(db_session, False, None)
+    crud.lookup_items(db_session, [0])
+    changes.read_changes(db_session, None, 1)
+    db_session.rollback()
+
+def _pool_size(sync_engine) -> int:
+    # Only queue pools (the default for file databases) keep several connections
+    pool = sync_engine.pool
+    return pool.size() if hasattr(pool, "size") else 1
+
+def _warm_up_sync() -> None:
+    for engine, session_factory in db.session_factories():
+        connections = [engine.connect() for _ in range(_pool_size(engine))]
+        for connection in connections:
+            connection.close()
+        with session_factory() as db_session:
+            warm_up_queries(db_session)
+
+async def _warm_up_async() -> None:
+    for engine, session_factory in db.session_factories():
+        connections = [await engine.connect() for _ in range(_pool_size(engine.sync_engine))]
+        for connection in connections:
+            await connection.close()
+        async with session_factory() as db_session:
+            await db_session.run_sync(warm_up_queries)
+
+async def warm_up() -> None:
+    """Warm this worker up, retrying until it succeeds, then mark it ready"""
+    global _ready
+    while not _ready:
+        try:
+            if db.DATABASE_ASYNC:
+                await _warm_up_async()
+            else:
+                await run_in_threadpool(_warm_up_sync)
+            _ready = True
+        except Exception:
+            logger.exception("Warm-up failed, retrying in %s seconds", WARMUP_RETRY_INTERVAL)
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
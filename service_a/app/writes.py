@@ -0,0 +1,196 @@
+import asyncio
+import os
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+
+from . import models, db, deadlines
+
+# Group commit for single-item writes. Writes arriving within
+# WRITE_BATCH_WINDOW_MS of each other are applied in one transaction, so
+# concurrent requests share one commit (and one fsync). 0 disables it.
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "0"))
+# A batch is flushed early once it holds this many writes
+WRITE_BATCH_MAX_SIZE = int(os.getenv("WRITE_BATCH_MAX_SIZE", "256"))
+
+def enabled() -> bool:
+    """Whether single-item writes go through the write queue"""
+    return WRITE_BATCH_WINDOW_MS > 0
+
+# Write operations. Each applies one write with a single statement, without
+# committing, and returns the response body, or raises HTTPException. Writes
+# given the versions an If-Match header accepts (see
+# etags.expected_versions) only apply to an item at one of them.
+
+def create_item(db_session: Session, value: str) -> Dict[str, Any]:
+    """Insert an item, with an ID of its shard's class on a partitioned store"""
+    values: Dict[str, Any] = {"value": value}
+    shard = db_session.info.get("shard")
+    if shard is not None:
+        values["id"] = models.next_item_id(shard.modulus, shard.residue)
+    row = db_session.execute(
+        insert(models.Item).values(**values).returning(models.Item.id, models.Item.value, models.Item.version)
+    ).one()
+    return dict(row._mapping)
+
+def update_item(db_session: Session, item_id: int, value: str, versions: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Update an item's value"""
+    statement = update(models.Item).where(models.Item.id == item_id)
+    if versions is not None:
+        statement = statement.where(models.Item.version.in_(versions))
+    row = db_session.execute(
+        statement
+        .values(value=value, version=models.Item.version + 1)
+        .returning(models.Item.id, models.Item.value, models.Item.version)
+    ).first()
+    if row is None:
+        _not_written(db_session, item_id, versions)
+    return dict(row._mapping)
+
+def delete_item(db_session: Session, item_id: int, versions: Optional[List[int]] = None) -> None:
+    """Delete an item"""
+    statement = delete(models.Item).where(models.Item.id == item_id)
+    if versions is not None:
+        statement = statement.where(models.Item.version.in_(versions))
+    if db_session.execute(statement).rowcount == 0:
+        _not_written(db_session, item_id, versions)
+
+def _not_written(db_session: Session, item_id: int, versions: Optional[List[int]]) -> None:
+    """
+    Raise the error for a write that matched no row
+
+    Only a conditional write needs a second query, to tell a missing item
+    from one at another version.
+    """
+    if versions is not None and db_session.execute(
+        select(models.Item.id).where(models.Item.id == item_id)
+    ).first() is not None:
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Item was modified")
+    raise HTTPException(status_code=404, detail="Item not found")
+
+Operation = Tuple[Callable[..., Any], Tuple[Any, ...]]
+
+def _apply_batch(db_session: Session, operations: List[Operation]) -> List[Tuple[bool, Any]]:
+    """
+    Apply writes in one transaction
+
+    Each write runs in its own savepoint, so a failing write is rolled back
+    and reported without affecting the others.
+
+    Returns:
+        (True, result) or (False, exception) for each write, in order
+    """
+    outcomes = []
+    for fn, args in operations:
+        try:
+            with db_session.begin_nested():
+                outcomes.append((True, fn(db_session, *args)))
+        except Exception as e:
+            outcomes.append((False, e))
+    db_session.commit()
+    return outcomes
+
+class WriteQueue:
+    """
+    Collects writes from concurrent requests and commits them together
+
+    Batches are applied one at a time; writes submitted while a batch is
+    being committed form the next batch.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._pending: List[Tuple[Callable[..., Any], Tuple[Any, ...], asyncio.Future]] = []
+        self._source_session: Any = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._lock = asyncio.Lock()
+        # The loop only keeps weak references to tasks, so commits in
+        # progress are kept here until they are done
+        self._commits: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.operations = 0
+
+    async def submit(self, db_session: Any, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        Queue a write and wait for the batch containing it to be committed
+
+        Args:
+            db_session: The request's session; the batch runs in a new session
+                of the same kind on the same database
+            fn: Write operation, called as fn(session, *args)
+
+        Returns:
+            The operation's result
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((fn, args, future))
+        if self._source_session is None:
+            self._source_session = db_session
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        # Shield the batch so a cancelled request does not cancel it for the others
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        source_session, self._source_session = self._source_session, None
+        if batch:
+            task = asyncio.ensure_future(self._commit(batch, source_session))
+            self._commits.add(task)
+            task.add_done_callback(self._commits.discard)
+
+    async def _commit(self, batch: List[Tuple[Callable[..., Any], Tuple[Any, ...], asyncio.Future]], source_session: Any) -> None:
+        # The batch serves several requests, so none of their deadlines apply
+        deadlines.detach()
+        async with self._lock:
+            db_session = db.new_session(source_session)
+            try:
+                outcomes = await db.run(db_session, _apply_batch, [(fn, args) for fn, args, _ in batch])
+            except Exception as e:
+                outcomes = [(False, e)] * len(batch)
+            finally:
+                closed = db_session.close()
+                if asyncio.iscoroutine(closed):
+                    await closed
+            self.batches += 1
+            self.operations += len(batch)
+
+        for (_, _, future), (ok, result) in zip(batch, outcomes):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of batches and writes committed so far"""
+        return {"batches": self.batches, "operations": self.operations}
+
+# One queue per event loop, since its futures and lock belong to the loop,
+# and per shard of a partitioned store, since a batch is one transaction
+_queues: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Any, WriteQueue]]" = weakref.WeakKeyDictionary()
+
+def get_queue(shard: Any = None) -> WriteQueue:
+    """Get the write queue of the running event loop (for a shard of a partitioned store)"""
+    loop = asyncio.get_running_loop()
+    queues = _queues.setdefault(loop, {})
+    queue = queues.get(shard)
+    if queue is None:
+        queue = queues[shard] = WriteQueue(WRITE_BATCH_WINDOW_MS / 1000, WRITE_BATCH_MAX_SIZE)
+    return queue
+
+async def submit(db_session: Any, fn: Callable[..., Any], *args: Any) -> Any:
+    """Queue a write on the queue of the running loop and the session's shard, and wait for its result"""
+    return await get_queue(db_session.info.get("shard")).submit(db_session, fn, *args)
@@ -7,6 +7,6 @@ setup(
     install_requires=[
         "fastapi>=0.68.0",
         "uvicorn>=0.15.0",
-        "sqlalchemy>=1.4.0",
+        "sqlalchemy>=2.0.0",
     ],
 )
\ No newline at end of file
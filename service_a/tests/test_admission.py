@@ -0,0 +1,157 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import httpx
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import admission, db, deadlines
+from app.admission import AdaptiveLimiter
+from app.main import app
+
+class FakeClock:
+    """Clock that only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def limiter(**kwargs):
+    settings = dict(initial=2, minimum=1, maximum=4, latency_target=0.1, queue_size=1, queue_timeout=0.05)
+    settings.update(kwargs)
+    return AdaptiveLimiter(**settings)
+
+def test_requests_over_the_limit_queue_then_get_rejected():
+    """Test that a full limiter queues a bounded number of requests for a bounded time"""
+    async def main():
+        requests = limiter()
+        assert await requests.acquire()
+        assert await requests.acquire()
+
+        # One waiter is admitted as soon as a slot frees
+        waiting = asyncio.ensure_future(requests.acquire())
+        await asyncio.sleep(0)
+        assert requests.queued == 1
+        # The queue is full
+        assert not await requests.acquire()
+        requests.release()
+        assert await waiting
+        assert requests.inflight == 2
+
+        # Nobody leaves: the wait times out
+        start = time.monotonic()
+        assert not await requests.acquire()
+        assert time.monotonic() - start >= 0.05
+        assert requests.queued == 0
+        assert requests.rejected == 2
+
+    asyncio.run(main())
+
+def test_limit_adapts_to_latency():
+    """Test that the limit grows while requests are fast and shrinks when they are slow"""
+    async def main():
+        clock = FakeClock()
+        requests = limiter(initial=2, clock=clock)
+        for _ in range(4):
+            assert await requests.acquire()
+            requests.release(0.01)
+        assert requests.limit > 2
+
+        grown = requests.limit
+        await requests.acquire()
+        requests.release(1.0)
+        assert requests.limit == grown * 0.9
+        # At most one decrease per target interval
+        await requests.acquire()
+        requests.release(1.0, failed=True)
+        assert requests.limit == grown * 0.9
+        clock.now = 1
+        await requests.acquire()
+        requests.release(0.01, failed=True)
+        assert requests.limit == pytest.approx(grown * 0.81)
+
+        for _ in range(50):
+            clock.now += 1
+            await requests.acquire()
+            requests.release(1.0)
+        assert requests.limit == 1
+
+    asyncio.run(main())
+
+def test_overloaded_requests_are_shed_but_health_is_not():
+    """Test that requests waiting too long get a fast 503 with Retry-After while /health answers"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    db.Base.metadata.create_all(bind=engine)
+
+    def slow_count(db_session, exact, if_none_match):
+        time.sleep(0.3)
+        return None, 0
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            counts = [asyncio.ensure_future(http.get("/items/count")) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            health = await http.get("/health")
+            return health, await asyncio.gather(*counts)
+
+    app.dependency_overrides[db.get_db] = lambda: Session(bind=engine)
+    limiters = {"read": limiter(initial=1), "write": limiter()}
+    try:
+        with patch("app.crud.count_items", slow_count), patch.dict(admission.limiters, limiters), \
+                patch("app.admission.ADMISSION_CONTROL", True):
+            health, counts = asyncio.run(main())
+    finally:
+        app.dependency_overrides.clear()
+
+    assert health.status_code == 200
+    statuses = sorted(response.status_code for response in counts)
+    assert statuses == [200, 503, 503]
+    shed = [response for response in counts if response.status_code == 503]
+    assert all(response.headers["Retry-After"] == "1" for response in shed)
+
+def test_deadline_504s_do_not_shrink_the_limit():
+    """Test that requests failing because their caller's deadline passed leave the limit alone"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    db.Base.metadata.create_all(bind=engine)
+
+    def slow_count(db_session, exact, if_none_match):
+        time.sleep(0.2)
+        deadlines.check()
+        return None, 0
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await http.get("/items/count", headers={deadlines.DEADLINE_HEADER: "50"})
+
+    app.dependency_overrides[db.get_db] = lambda: Session(bind=engine)
+    limiters = {"read": limiter(initial=2), "write": limiter()}
+    try:
+        with patch("app.crud.count_items", slow_count), patch.dict(admission.limiters, limiters), \
+                patch("app.admission.ADMISSION_CONTROL", True):
+            response = asyncio.run(main())
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == 504
+    assert response.headers[deadlines.DEADLINE_EXCEEDED_HEADER] == "true"
+    assert limiters["read"].limit == 2
+
+def test_request_classes():
+    """Test that reads and writes go through separate limiters and probes through none"""
+    assert admission.request_class("GET", "/items") == "read"
+    assert admission.request_class("POST", "/items/lookup") == "read"
+    assert admission.request_class("POST", "/items") == "write"
+    assert admission.request_class("DELETE", "/items/1") == "write"
+    assert admission.request_class("GET", "/health") is None
+    assert admission.request_class("GET", "/metrics") is None
@@ -0,0 +1,85 @@
+import json
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.main import app
+from app.db import Base, get_session
+
+# Create in-memory SQLite database served through aiosqlite
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+engine = create_async_engine(SQLALCHEMY_DATABASE_URL, poolclass=StaticPool)
+TestingAsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+async def create_tables():
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+async def drop_tables():
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+
+@pytest.fixture
+def client():
+    # Serve the endpoints with async sessions
+    async def override_get_session():
+        async with TestingAsyncSessionLocal() as db_session:
+            yield db_session
+
+    app.dependency_overrides[get_session] = override_get_session
+
+    # Keep one event loop for the whole test, since the engine is bound to it
+    with TestClient(app) as c:
+        c.portal.call(create_tables)
+        yield c
+        c.portal.call(drop_tables)
+
+    app.dependency_overrides = {}
+
+def test_crud_with_async_session(client):
+    """Test creating, reading, updating and deleting an item"""
+    response = client.post("/items", json={"value": "test item"})
+    assert response.status_code == 201
+    item_id = response.json()["id"]
+
+    response = client.put(f"/items/{item_id}", json={"value": "updated item"})
+    assert response.status_code == 200
+    assert response.json()["value"] == "updated item"
+
+    response = client.get(f"/items/{item_id}")
+    assert response.json() == {"id": item_id, "value": "updated item"}
+
+    assert client.delete(f"/items/{item_id}").status_code == 204
+    assert client.get(f"/items/{item_id}").status_code == 404
+
+def test_queries_with_async_session(client):
+    """Test listing, searching, counting and conditional GETs"""
+    client.post("/items/bulk", json={"items": [{"value": "apple"}, {"value": "banana"}]})
+
+    response = client.get("/items", params={"limit": 1})
+    data = response.json()
+    assert [item["value"] for item in data["items"]] == ["apple"]
+    response = client.get("/items", params={"limit": 1, "cursor": data["next_cursor"]})
+    assert [item["value"] for item in response.json()["items"]] == ["banana"]
+
+    response = client.get("/items/search", params={"q": "nana"})
+    assert [item["value"] for item in response.json()["items"]] == ["banana"]
+
+    response = client.get("/items/count")
+    assert response.json() == 2
+    response = client.get("/items/count", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+def test_export_with_async_session(client):
+    """Test streaming the export from an async session"""
+    client.post("/items/bulk", json={"items": [{"value": "apple"}, {"value": "banana"}]})
+
+    response = client.get("/items/export")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [item["value"] for item in lines] == ["apple", "banana"]
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import db, deadlines
+from app.main import app
+
+# A query that never ends on its own
+ENDLESS = text("WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT count(*) FROM n")
+
+engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+db.configure_engine(engine, "deadlines")
+db.Base.metadata.create_all(bind=engine)
+
+def endless_count(db_session, exact, if_none_match):
+    return None, db_session.execute(ENDLESS).scalar()
+
+@pytest.fixture
+def client():
+    def override_get_db():
+        db_session = Session(bind=engine)
+        try:
+            yield db_session
+        finally:
+            db_session.close()
+
+    app.dependency_overrides[db.get_db] = override_get_db
+    with TestClient(app) as c:
+        yield c
+    app.dependency_overrides.clear()
+
+def run_with_budget(budget, coroutine_fn):
+    async def main():
+        deadlines._budget.set(budget)
+        return await coroutine_fn()
+    return asyncio.run(main())
+
+def test_statement_is_aborted_at_the_deadline():
+    """Test that a running statement is interrupted once the budget is spent"""
+    budget = deadlines.Budget(time.monotonic() + 0.05)
+    with Session(bind=engine) as db_session:
+        with pytest.raises(deadlines.DeadlineExceeded):
+            run_with_budget(budget, lambda: db.run(db_session, lambda s: s.execute(ENDLESS).scalar()))
+
+        # The connection is still usable afterwards
+        assert db_session.execute(text("SELECT 1")).scalar() == 1
+
+def test_async_statement_is_aborted_at_the_deadline():
+    """Test that statements run by aiosqlite are interrupted too"""
+    async def query():
+        async_engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        db.configure_engine(async_engine.sync_engine, "deadlines-async")
+        try:
+            async with async_engine.connect() as connection:
+                async with AsyncSession(bind=connection) as db_session:
+                    return await db.run(db_session, lambda s: s.execute(ENDLESS).scalar())
+        finally:
+            await async_engine.dispose()
+
+    with pytest.raises(deadlines.DeadlineExceeded):
+        run_with_budget(deadlines.Budget(time.monotonic() + 0.05), query)
+
+def test_requests_without_a_deadline_are_not_aborted():
+    """Test that statements run to completion without a budget"""
+    with Session(bind=engine) as db_session:
+        result = run_with_budget(None, lambda: db.run(db_session, lambda s: s.execute(text("SELECT 42")).scalar()))
+    assert result == 42
+
+def test_expired_deadline_header(client):
+    """Test that a request arriving with no budget left is answered with a 504 straight away"""
+    with patch("app.crud.count_items") as count_items:
+        response = client.get("/items/count", headers={deadlines.DEADLINE_HEADER: "0"})
+
+    assert response.status_code == 504
+    assert response.headers[deadlines.DEADLINE_EXCEEDED_HEADER] == "true"
+    count_items.assert_not_called()
+
+def test_deadline_exceeded_while_querying(client):
+    """Test that a query outliving the request's budget is aborted with a 504"""
+    start = time.monotonic()
+    with patch("app.crud.count_items", endless_count):
+        response = client.get("/items/count", headers={deadlines.DEADLINE_HEADER: "50"})
+
+    assert response.status_code == 504
+    assert response.headers[deadlines.DEADLINE_EXCEEDED_HEADER] == "true"
+    assert time.monotonic() - start < 5
+
+def test_malformed_deadline_header_is_ignored(client):
+    """Test that an unparseable header leaves the request without a deadline"""
+    response = client.get("/items/count", headers={deadlines.DEADLINE_HEADER: "soon"})
+    assert response.status_code == 200
+    assert response.json() == 0
+
+def test_client_disconnect_cancels_query():
+    """Test that the database work of a request stops when its client disconnects"""
+    app.dependency_overrides[db.get_db] = lambda: Session(bind=engine)
+    sent = []
+
+    async def main():
+        messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(0.05)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": "/items/count", "raw_path": b"/items/count", "root_path": "",
+            "query_string": b"", "headers": [], "client": ("test", 1), "server": ("test", 80),
+        }
+        await asyncio.wait_for(app(scope, receive, send), timeout=5)
+
+    try:
+        with patch("app.crud.count_items", endless_count):
+            asyncio.run(main())
+    finally:
+        app.dependency_overrides.clear()
+
+    assert sent[0]["status"] == deadlines.CLIENT_CLOSED_REQUEST
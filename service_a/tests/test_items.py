@@ -1,6 +1,12 @@
+import asyncio
+import json
+import sqlite3
+from contextlib import contextmanager
+import httpx
 import pytest
+from unittest.mock import patch
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 import sys
@@ -10,8 +16,10 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app.main import app
-from app.db import Base, get_db
-from app.models import Item
+from app.db import Base, configure_engine, get_db
+from app.models import Item, ItemChange, Counter, ITEM_COUNT
+from app import crud, search, maintenance, writes, serialization
+from app.schemas import BulkItemCreate, SearchMode
 
 # Create in-memory SQLite database for testing
 SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
@@ -56,6 +64,20 @@ def client(test_db):
     # Reset the dependency override
     app.dependency_overrides = {}
 
+@contextmanager
+def count_statements():
+    """Collect the SQL statements run on the test database"""
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
 def test_create_item(client):
     """Test creating an item"""
     response = client.post("/items", json={"value": "test item"})
@@ -64,6 +86,78 @@ def test_create_item(client):
     assert data["value"] == "test item"
     assert "id" in data
 
+def test_create_items_bulk(client, test_db):
+    """Test creating many items in one request"""
+    response = client.post("/items/bulk", json={"items": [{"value": f"item {i}"} for i in range(5)]})
+    assert response.status_code == 201
+    data = response.json()
+    assert len(data["ids"]) == 5
+    assert data["errors"] == []
+
+    values = [client.get(f"/items/{item_id}").json()["value"] for item_id in data["ids"]]
+    assert values == [f"item {i}" for i in range(5)]
+    assert client.get("/items/count").json() == 5
+
+def test_partial_bulk_create_is_one_transaction(tmp_path):
+    """Test that rows retried one by one after a failure are still committed together"""
+    file_engine = create_engine(f"sqlite:///{tmp_path / 'items.db'}")
+    configure_engine(file_engine, "bulk")
+    Base.metadata.create_all(bind=file_engine)
+    with file_engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TRIGGER reject_bad BEFORE INSERT ON items WHEN NEW.value = 'bad' "
+            "BEGIN SELECT RAISE(ABORT, 'bad value'); END"
+        )
+    open_after_release = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith("RELEASE SAVEPOINT"):
+            open_after_release.append(connection.connection.driver_connection.in_transaction)
+
+    event.listen(file_engine, "after_cursor_execute", record)
+    batch = BulkItemCreate(items=[{"value": "a"}, {"value": "bad"}, {"value": "b"}], atomic=False)
+    with TestingSessionLocal(bind=file_engine) as db_session:
+        result = crud.create_items_bulk(db_session, batch)
+    file_engine.dispose()
+
+    assert len(result["ids"]) == 2
+    assert [error.index for error in result["errors"]] == [1]
+    # Releasing a row's savepoint never committed it on its own
+    assert open_after_release and all(open_after_release)
+
+def test_update_items_bulk(client, test_db):
+    """Test updating many items, atomically and partially"""
+    ids = client.post("/items/bulk", json={"items": [{"value": "a"}, {"value": "b"}]}).json()["ids"]
+    batch = [{"id": ids[0], "value": "a2"}, {"id": 999, "value": "x"}, {"id": ids[1], "value": "b2"}]
+
+    response = client.put("/items/bulk", json={"items": batch})
+    assert response.status_code == 404
+    assert response.json()["detail"][0]["id"] == 999
+    assert client.get(f"/items/{ids[0]}").json()["value"] == "a"
+
+    response = client.put("/items/bulk", json={"items": batch, "atomic": False})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ids"] == ids
+    assert data["errors"] == [{"index": 1, "id": 999, "detail": "Item not found"}]
+    assert client.get(f"/items/{ids[0]}").json()["value"] == "a2"
+    assert client.get(f"/items/{ids[1]}").json()["value"] == "b2"
+
+def test_delete_items_bulk(client, test_db):
+    """Test deleting many items, atomically and partially"""
+    ids = client.post("/items/bulk", json={"items": [{"value": "a"}, {"value": "b"}]}).json()["ids"]
+
+    response = client.request("DELETE", "/items/bulk", json={"ids": ids + [999]})
+    assert response.status_code == 404
+    assert client.get("/items/count").json() == 2
+
+    response = client.request("DELETE", "/items/bulk", json={"ids": ids + [999], "atomic": False})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ids"] == ids
+    assert data["errors"] == [{"index": 2, "id": 999, "detail": "Item not found"}]
+    assert client.get("/items/count").json() == 0
+
 def test_read_items(client, test_db):
     """Test reading all items"""
     # Add some test items
@@ -78,6 +172,88 @@ def test_read_items(client, test_db):
     assert data["items"][0]["value"] == "test item 1"
     assert data["items"][1]["value"] == "test item 2"
 
+def test_read_items_cursor_pagination(client, test_db):
+    """Test paging through items with cursors"""
+    for i in range(5):
+        test_db.add(Item(value=f"item {i}"))
+    test_db.commit()
+
+    values = []
+    cursor = None
+    pages = 0
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/items", params=params)
+        assert response.status_code == 200
+        data = response.json()
+        values.extend(item["value"] for item in data["items"])
+        pages += 1
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert values == [f"item {i}" for i in range(5)]
+
+def test_read_items_cursor_is_stable(client, test_db):
+    """Test that deleting earlier rows does not shift the next page"""
+    items = [Item(value=f"item {i}") for i in range(4)]
+    test_db.add_all(items)
+    test_db.commit()
+
+    response = client.get("/items", params={"limit": 2})
+    cursor = response.json()["next_cursor"]
+
+    client.delete(f"/items/{items[0].id}")
+
+    response = client.get("/items", params={"limit": 2, "cursor": cursor})
+    data = response.json()
+    assert [item["value"] for item in data["items"]] == ["item 2", "item 3"]
+    assert data["next_cursor"] is None
+
+def test_read_items_skip(client, test_db):
+    """Test the backward compatible skip parameter"""
+    for i in range(3):
+        test_db.add(Item(value=f"item {i}"))
+    test_db.commit()
+
+    response = client.get("/items", params={"skip": 1, "limit": 1})
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["value"] for item in data["items"]] == ["item 1"]
+    assert data["next_cursor"] is not None
+
+def test_read_items_invalid_cursor(client):
+    """Test that a malformed cursor is rejected"""
+    response = client.get("/items", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+def test_export_items(client, test_db):
+    """Test streaming all items as NDJSON"""
+    for i in range(3):
+        test_db.add(Item(value=f"item {i}"))
+    test_db.commit()
+
+    with client.stream("GET", "/items/export") as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.iter_lines() if line]
+
+    assert [item["value"] for item in lines] == ["item 0", "item 1", "item 2"]
+    assert set(lines[0]) == {"id", "value"}
+
+def test_lookup_items(client, test_db):
+    """Test getting many items by ID"""
+    ids = client.post("/items/bulk", json={"items": [{"value": "a"}, {"value": "b"}, {"value": "c"}]}).json()["ids"]
+
+    response = client.post("/items/lookup", json={"ids": [ids[2], 999, ids[0], ids[2]]})
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["value"] for item in data["items"]] == ["c", "a"]
+    assert data["missing"] == [999]
+
 def test_read_item(client, test_db):
     """Test reading a specific item"""
     # Add a test item
@@ -125,6 +301,43 @@ def test_update_item(client, test_db):
     data = response.json()
     assert data["value"] == "updated item"
 
+def test_single_statement_writes(client, test_db):
+    """Test that each single-item write is one statement, including its 404"""
+    with count_statements() as statements:
+        item_id = client.post("/items", json={"value": "apple"}).json()["id"]
+    assert len(statements) == 1
+
+    for method, url, kwargs, status_code in [
+        ("put", f"/items/{item_id}", {"json": {"value": "apricot"}}, 200),
+        ("put", "/items/999", {"json": {"value": "apricot"}}, 404),
+        ("put", f"/items/{item_id}", {"json": {"value": "avocado"}, "headers": {"If-Match": '"v2"'}}, 200),
+        ("delete", "/items/999", {}, 404),
+        ("delete", f"/items/{item_id}", {}, 204),
+    ]:
+        with count_statements() as statements:
+            assert client.request(method, url, **kwargs).status_code == status_code
+        assert len(statements) == 1, (method, url, statements)
+
+def test_conditional_update(client, test_db):
+    """Test that If-Match only lets a write through for the item's current ETag"""
+    response = client.post("/items", json={"value": "apple"})
+    item_id, etag = response.json()["id"], response.headers["ETag"]
+    assert etag == client.get(f"/items/{item_id}").headers["ETag"]
+
+    response = client.put(f"/items/{item_id}", json={"value": "apricot"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"v2"'
+
+    # A client still holding the first version cannot overwrite or delete the item
+    response = client.put(f"/items/{item_id}", json={"value": "avocado"}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert client.delete(f"/items/{item_id}", headers={"If-Match": f'"v0", W/"v2", {etag}'}).status_code == 412
+    assert client.get(f"/items/{item_id}").json()["value"] == "apricot"
+
+    assert client.put("/items/999", json={"value": "x"}, headers={"If-Match": etag}).status_code == 404
+    assert client.put(f"/items/{item_id}", json={"value": "avocado"}, headers={"If-Match": "*"}).status_code == 200
+    assert client.delete(f"/items/{item_id}", headers={"If-Match": '"v3"'}).status_code == 204
+
 def test_search_items(client, test_db):
     """Test searching items"""
     # Add some test items
@@ -148,6 +361,62 @@ def test_search_items(client, test_db):
     assert len(data["items"]) == 1
     assert data["items"][0]["value"] == "apple"
 
+def test_search_index_stays_in_sync(client, test_db):
+    """Test that indexed search sees creates, updates and deletes"""
+    assert search.index_available(test_db)
+
+    item_id = client.post("/items", json={"value": "Pineapple"}).json()["id"]
+    response = client.get("/items/search?q=apple")
+    assert [item["id"] for item in response.json()["items"]] == [item_id]
+
+    client.put(f"/items/{item_id}", json={"value": "Coconut"})
+    assert client.get("/items/search?q=apple").json()["items"] == []
+    assert len(client.get("/items/search?q=conu").json()["items"]) == 1
+
+    client.delete(f"/items/{item_id}")
+    assert client.get("/items/search?q=conu").json()["items"] == []
+
+def test_search_items_modes(client, test_db):
+    """Test prefix, ranked and unindexed search modes"""
+    test_db.add(Item(value="apple pie"))
+    test_db.add(Item(value="pineapple"))
+    test_db.add(Item(value="apple apple"))
+    test_db.add(Item(value="100% juice"))
+    test_db.commit()
+
+    response = client.get("/items/search", params={"q": "apple", "mode": "prefix"})
+    assert [item["value"] for item in response.json()["items"]] == ["apple pie", "apple apple"]
+
+    response = client.get("/items/search", params={"q": "apple", "mode": "ranked", "limit": 1})
+    data = response.json()
+    assert [item["value"] for item in data["items"]] == ["apple apple"]
+    assert data["next_cursor"] is None
+
+    response = client.get("/items/search", params={"q": "0%", "mode": "scan"})
+    assert [item["value"] for item in response.json()["items"]] == ["100% juice"]
+
+    # LIKE wildcards in the query are matched literally
+    response = client.get("/items/search", params={"q": "%"})
+    assert [item["value"] for item in response.json()["items"]] == ["100% juice"]
+
+def test_search_items_pagination(client, test_db):
+    """Test paging through search results with cursors"""
+    for i in range(5):
+        test_db.add(Item(value=f"match {i}"))
+    test_db.add(Item(value="other"))
+    test_db.commit()
+
+    response = client.get("/items/search", params={"q": "match", "limit": 3})
+    data = response.json()
+    assert [item["value"] for item in data["items"]] == ["match 0", "match 1", "match 2"]
+
+    response = client.get(
+        "/items/search", params={"q": "match", "limit": 3, "cursor": data["next_cursor"]}
+    )
+    data = response.json()
+    assert [item["value"] for item in data["items"]] == ["match 3", "match 4"]
+    assert data["next_cursor"] is None
+
 def test_count_items(client, test_db):
     """Test counting items"""
     # Add some test items
@@ -162,6 +431,218 @@ def test_count_items(client, test_db):
     count = response.json()
     assert count == 3
 
+def test_count_items_is_maintained(client, test_db):
+    """Test that the maintained count follows creates and deletes"""
+    item_id = client.post("/items", json={"value": "item 1"}).json()["id"]
+    client.post("/items", json={"value": "item 2"})
+    assert client.get("/items/count").json() == 2
+
+    client.delete(f"/items/{item_id}")
+    assert client.get("/items/count").json() == 1
+    assert client.get("/items/count?exact=true").json() == 1
+
+def test_reconcile_item_count(client, test_db):
+    """Test that reconciliation repairs a drifted counter"""
+    test_db.add(Item(value="item 1"))
+    test_db.commit()
+    test_db.get(Counter, ITEM_COUNT).value = 42
+    test_db.commit()
+
+    assert client.get("/items/count").json() == 42
+    assert client.get("/items/count?exact=true").json() == 1
+
+    assert maintenance.reconcile_item_count(test_db) == 1
+    assert client.get("/items/count").json() == 1
+
+def test_collection_etags(client, test_db):
+    """Test conditional GETs on list, search and count endpoints"""
+    client.post("/items", json={"value": "apple"})
+
+    for url in ("/items", "/items/search?q=apple", "/items/count"):
+        response = client.get(url)
+        etag = response.headers["ETag"]
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+    # Any write changes the ETag
+    client.post("/items", json={"value": "banana"})
+    response = client.get("/items", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()["items"]) == 2
+
+def test_item_etag_follows_version(client, test_db):
+    """Test that an item's ETag only changes when the item is updated"""
+    item_id = client.post("/items", json={"value": "apple"}).json()["id"]
+    etag = client.get(f"/items/{item_id}").headers["ETag"]
+
+    # Writes to other items do not change it
+    client.post("/items", json={"value": "banana"})
+    response = client.get(f"/items/{item_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    client.put(f"/items/{item_id}", json={"value": "apricot"})
+    client.put("/items/bulk", json={"items": [{"id": item_id, "value": "avocado"}]})
+    response = client.get(f"/items/{item_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["value"] == "avocado"
+    assert response.headers["ETag"] == '"v3"'
+
+def test_upgrade_existing_database():
+    """Test that a database created before versions and triggers is upgraded"""
+    from app import models
+
+    old_engine = create_engine("sqlite:///:memory:", poolclass=StaticPool)
+    with old_engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE items (id INTEGER PRIMARY KEY, value VARCHAR NOT NULL)")
+        connection.exec_driver_sql("INSERT INTO items (value) VALUES ('apple'), ('banana')")
+    Base.metadata.create_all(bind=old_engine)
+
+    with old_engine.begin() as connection:
+        models.add_missing_columns(connection)
+        models.install_triggers(connection)
+
+    with TestingSessionLocal(bind=old_engine) as db_session:
+        assert [item.version for item in db_session.query(Item)] == [1, 1]
+        assert db_session.get(Counter, ITEM_COUNT).value == 2
+        assert len(search.search_items(db_session, "banana", SearchMode.substring, 10)) == 1
+
+def test_group_commit(client, test_db):
+    """Test that concurrent writes are committed in shared batches"""
+    existing_id = client.post("/items", json={"value": "existing"}).json()["id"]
+
+    async def write_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            creates = [async_client.post("/items", json={"value": f"item {i}"}) for i in range(20)]
+            others = [
+                async_client.put(f"/items/{existing_id}", json={"value": "updated"}),
+                async_client.delete("/items/999"),
+            ]
+            responses = await asyncio.gather(*creates, *others)
+        # Finished commit tasks are no longer referenced by the queue
+        assert not writes.get_queue()._commits
+        return responses, writes.get_queue().stats()
+
+    with patch("app.writes.WRITE_BATCH_WINDOW_MS", 20):
+        responses, stats = asyncio.run(write_concurrently())
+
+    created, (updated, missing) = responses[:20], responses[20:]
+    assert all(response.status_code == 201 for response in created)
+    assert sorted(response.json()["value"] for response in created) == sorted(f"item {i}" for i in range(20))
+    assert updated.json() == {"id": existing_id, "value": "updated"}
+    # A failing write is reported to its caller without affecting the batch
+    assert missing.status_code == 404
+
+    assert stats["operations"] == 22
+    assert stats["batches"] < 22
+    assert client.get("/items/count").json() == 21
+
+def test_group_commit_is_one_transaction(tmp_path):
+    """Test that a batch's writes only become visible together, at its single commit"""
+    path = tmp_path / "items.db"
+    file_engine = create_engine(f"sqlite:///{path}")
+    configure_engine(file_engine, "group-commit")
+    Base.metadata.create_all(bind=file_engine)
+    seen = []
+
+    def count_from_another_connection(db_session):
+        with sqlite3.connect(path) as other:
+            seen.append(other.execute("SELECT COUNT(*) FROM items").fetchone()[0])
+
+    operations = [
+        (writes.create_item, ("a",)),
+        (count_from_another_connection, ()),
+        (writes.create_item, ("b",)),
+        (writes.delete_item, (999,)),
+        (count_from_another_connection, ()),
+    ]
+    with TestingSessionLocal(bind=file_engine) as db_session:
+        outcomes = writes._apply_batch(db_session, operations)
+    with sqlite3.connect(path) as other:
+        seen.append(other.execute("SELECT COUNT(*) FROM items").fetchone()[0])
+    file_engine.dispose()
+
+    assert [ok for ok, _ in outcomes] == [True, True, True, False, True]
+    assert seen == [0, 0, 2]
+
+def test_fast_serialization(client, test_db):
+    """Test that the fast path returns the same pages and ETags as the default one"""
+    test_db.add_all([Item(value=f"fast item {i}") for i in range(5)])
+    test_db.commit()
+
+    urls = ["/items?limit=2", "/items/search?q=item&limit=2", "/items/search?q=it&mode=ranked"]
+    default = [client.get(url) for url in urls]
+    with patch("app.serialization.FAST_SERIALIZATION", True):
+        fast = [client.get(url) for url in urls]
+        not_modified = client.get(urls[0], headers={"If-None-Match": fast[0].headers["ETag"]})
+
+    for expected, response in zip(default, fast):
+        assert response.status_code == 200
+        assert response.json() == expected.json()
+        assert response.headers["ETag"] == expected.headers["ETag"]
+    assert not_modified.status_code == 304
+
+def test_columns_format(client, test_db):
+    """Test that list, search and export negotiate the columns format"""
+    test_db.add_all([Item(value=f"item {i}") for i in range(3)])
+    test_db.commit()
+    columns = {"Accept": "application/vnd.items.columns+json"}
+
+    response = client.get("/items?limit=2", headers=columns)
+    assert response.headers["content-type"] == "application/vnd.items.columns+json"
+    assert response.headers["Vary"] == "Accept"
+    page = response.json()
+    assert page["values"] == ["item 0", "item 1"]
+    next_page = client.get("/items", params={"cursor": page["next_cursor"]}, headers=columns).json()
+    assert next_page == {"ids": [page["ids"][1] + 1], "values": ["item 2"], "next_cursor": None}
+
+    search = client.get("/items/search?q=item 2", headers=columns).json()
+    assert search["values"] == ["item 2"]
+
+    export = client.get("/items/export", headers={"Accept": "application/vnd.items.columns+x-ndjson"})
+    assert export.headers["content-type"] == "application/vnd.items.columns+x-ndjson"
+    assert [json.loads(line)["values"] for line in export.text.splitlines()] == [["item 0", "item 1", "item 2"]]
+
+    # JSON stays the default, including for clients that refuse the columns format
+    refused = client.get("/items", headers={"Accept": "application/vnd.items.columns+json;q=0, */*"})
+    assert "items" in refused.json()
+    assert "items" in client.get("/items").json()
+
+def test_change_feed(client, test_db):
+    """Test that creates, updates and deletes are logged in order and can be followed"""
+    head = client.get("/items/changes").json()
+    assert head == {"changes": [], "last_seq": 0}
+
+    ids = client.post("/items/bulk", json={"items": [{"value": "a"}, {"value": "b"}]}).json()["ids"]
+    client.put(f"/items/{ids[0]}", json={"value": "a2"})
+    client.delete(f"/items/{ids[1]}")
+
+    response = client.get("/items/changes", params={"since": 0})
+    assert response.status_code == 200
+    feed = response.json()
+    assert [(change["id"], change["value"]) for change in feed["changes"]] == [
+        (ids[0], "a"), (ids[1], "b"), (ids[0], "a2"), (ids[1], None),
+    ]
+    assert [change["seq"] for change in feed["changes"]] == [1, 2, 3, 4]
+    assert feed["last_seq"] == 4
+    assert client.get("/items/changes").json()["last_seq"] == 4
+
+    # Paged with limit, and waiting without changes returns an empty page
+    assert client.get("/items/changes", params={"since": 1, "limit": 2}).json()["last_seq"] == 3
+    assert client.get("/items/changes", params={"since": 4, "wait": 0.05}).json() == {"changes": [], "last_seq": 4}
+
+def test_change_feed_gone(client, test_db):
+    """Test that clients behind the pruned part of the log, or ahead of it, get a 410"""
+    client.post("/items/bulk", json={"items": [{"value": f"item {i}"} for i in range(3)]})
+    test_db.query(ItemChange).filter(ItemChange.seq <= 2).delete()
+    test_db.commit()
+
+    assert client.get("/items/changes", params={"since": 0}).status_code == 410
+    assert client.get("/items/changes", params={"since": 2}).json()["last_seq"] == 3
+    assert client.get("/items/changes", params={"since": 9}).status_code == 410
+
 def test_health_check(client):
     """Test health check endpoint"""
     response = client.get("/health")
@@ -0,0 +1,114 @@
+import os
+import re
+import subprocess
+import sys
+import textwrap
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from service_common import metrics
+from app import db
+from app.main import app
+
+client = TestClient(app)
+
+def _series(name_and_labels):
+    """A sample's name and labels, in a form that does not depend on the order of the labels"""
+    name, _, labels = name_and_labels.partition("{")
+    return name, frozenset(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels))
+
+def sample(text_format, series):
+    """Value of the sample of a series, e.g. 'name{label="value"}', in any label order"""
+    if isinstance(text_format, bytes):
+        text_format = text_format.decode()
+    wanted = _series(series)
+    for line in text_format.splitlines():
+        if not line.startswith("#") and _series(line.rsplit(" ", 1)[0]) == wanted:
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+def test_request_metrics():
+    """Test that requests are counted and timed per route template"""
+    before = client.get("/metrics").text
+    client.get("/health")
+    client.get("/no-such-route")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    after = response.text
+    health = 'http_requests_total{method="GET",route="/health",status="200"}'
+    assert sample(after, health) == (sample(before, health) or 0) + 1
+    assert sample(after, 'http_requests_total{method="GET",route="<unmatched>",status="404"}') >= 1
+    assert sample(after, 'http_request_duration_seconds_bucket{method="GET",route="/health",le="+Inf"}') >= 1
+    # Only the /metrics request itself is in progress
+    assert sample(after, 'http_requests_in_progress{method="GET",route="/metrics"}') == 1
+    assert sample(after, 'http_requests_in_progress{method="GET",route="/health"}') == 0
+
+def test_routes_are_matched_once_per_path():
+    """Test that the route template of a method and path is remembered, within ROUTE_CACHE_SIZE"""
+    with patch("service_common.metrics._route", wraps=metrics._route) as match:
+        for _ in range(3):
+            client.get("/health")
+        assert match.call_count <= 1
+        client.post("/health")
+        assert match.call_count <= 2
+        with patch("service_common.metrics.ROUTE_CACHE_SIZE", 1):
+            match.reset_mock()
+            # Each path evicts the one before it
+            for path in ("/route-cache-size", "/health", "/metrics", "/health"):
+                client.get(path)
+        assert match.call_count == 4
+
+def test_statement_and_pool_metrics():
+    """Test that statements are timed per operation and pool sizes are reported"""
+    engine = create_engine("sqlite://")
+    db.configure_engine(engine, "test")
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        rendered = metrics.render()
+
+    assert sample(rendered, 'db_statement_duration_seconds_count{engine="test",operation="SELECT"}') == 1
+
+# A worker recording a request, one in progress and its admission limit,
+# then waiting for its stdin to close when `stay` is set
+WORKER = textwrap.dedent("""
+    import sys
+    from service_common import metrics
+    from prometheus_client import Gauge
+
+    limit = Gauge("admission_requests", "", ("class", "stat"), multiprocess_mode="liveall")
+    metrics.HTTP_REQUESTS.labels("GET", "/health", "200").inc(5)
+    metrics.HTTP_REQUESTS_IN_PROGRESS.labels("GET", "/items").inc(3)
+    limit.labels("read", "limit").set(20)
+    print("ready", flush=True)
+    if sys.argv[1] == "stay":
+        sys.stdin.read()
+""")
+
+def test_metrics_are_aggregated_across_workers(tmp_path):
+    """Test that counters are added up and gauges combined per their mode over all workers"""
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    subprocess.run([sys.executable, "-c", WORKER, "exit"], env=env, check=True, capture_output=True)
+    live = subprocess.Popen(
+        [sys.executable, "-c", WORKER, "stay"], env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    try:
+        assert live.stdout.readline().strip() == "ready"
+        with patch("service_common.metrics.METRICS_DIR", str(tmp_path)):
+            rendered = metrics.render().decode()
+    finally:
+        live.communicate()
+
+    assert sample(rendered, 'http_requests_total{method="GET",route="/health",status="200"}') == 10
+    # Gauges of exited workers are dropped; requests in progress add up
+    assert sample(rendered, 'http_requests_in_progress{method="GET",route="/items"}') == 3
+    # Limits are not added up but reported per worker
+    limits = [line for line in rendered.splitlines() if line.startswith("admission_requests{")]
+    assert len(limits) == 1
+    assert sample(rendered, f'admission_requests{{class="read",pid="{live.pid}",stat="limit"}}') == 20
@@ -0,0 +1,192 @@
+import json
+import sqlite3
+from unittest.mock import patch
+import pytest
+from fastapi.testclient import TestClient
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import db, maintenance, models, writes
+from app.main import app
+
+def _make_map(tmp_path, count: int) -> db.ShardMap:
+    shard_map = db.ShardMap([
+        db.Shard(f"sqlite:///{tmp_path / f'shard{residue}.db'}", count, residue) for residue in range(count)
+    ])
+    for shard in shard_map.shards:
+        models.prepare_schema(shard.engine)
+    return shard_map
+
+@pytest.fixture
+def shard_map(tmp_path):
+    shard_map = _make_map(tmp_path, 2)
+    yield shard_map
+    shard_map.dispose()
+
+@pytest.fixture
+def client(shard_map):
+    def override_get_db():
+        db_session = db.ShardedSession(shard_map)
+        try:
+            yield db_session
+        finally:
+            db_session.close()
+
+    app.dependency_overrides[db.get_db] = override_get_db
+    with TestClient(app) as c:
+        yield c
+    app.dependency_overrides = {}
+
+def _shard_ids(shard: db.Shard):
+    with shard.SessionLocal() as db_session:
+        return sorted(item.id for item in db_session.query(models.Item))
+
+def test_shard_map_must_cover_every_id(tmp_path):
+    with pytest.raises(ValueError):
+        db.ShardMap([db.Shard(f"sqlite:///{tmp_path / 'a.db'}", 2, 0)])
+    with pytest.raises(ValueError):
+        db.ShardMap([
+            db.Shard(f"sqlite:///{tmp_path / 'a.db'}", 1, 0),
+            db.Shard(f"sqlite:///{tmp_path / 'b.db'}", 2, 1),
+        ])
+
+def test_point_operations_route_to_one_shard(client, shard_map):
+    """New items take turns over the shards, and get IDs of their shard's class"""
+    ids = [client.post("/items", json={"value": f"item {i}"}).json()["id"] for i in range(4)]
+    assert len(set(ids)) == 4
+    for shard in shard_map.shards:
+        assert len(_shard_ids(shard)) == 2
+        assert all(shard.owns(item_id) for item_id in _shard_ids(shard))
+
+    for item_id in ids:
+        assert client.get(f"/items/{item_id}").status_code == 200
+    response = client.put(f"/items/{ids[1]}", json={"value": "updated"})
+    assert response.json()["value"] == "updated"
+    assert client.delete(f"/items/{ids[2]}").status_code == 204
+    assert client.get(f"/items/{ids[2]}").status_code == 404
+
+def test_bulk_create_goes_to_one_shard(client, shard_map):
+    response = client.post("/items/bulk", json={"items": [{"value": "a"}, {"value": "b"}, {"value": "c"}]})
+    ids = response.json()["ids"]
+    assert len(ids) == 3
+    assert [shard for shard in shard_map.shards if _shard_ids(shard)] == [shard_map.for_item(ids[0])]
+    assert all(shard_map.for_item(item_id) is shard_map.for_item(ids[0]) for item_id in ids)
+
+def test_list_items_merges_shards(client):
+    ids = [client.post("/items", json={"value": f"item {i}"}).json()["id"] for i in range(5)]
+
+    response = client.get("/items?skip=1&limit=3")
+    assert [item["id"] for item in response.json()["items"]] == sorted(ids)[1:4]
+
+    seen = []
+    cursor = None
+    while True:
+        page = client.get("/items", params={"limit": 2, **({"cursor": cursor} if cursor else {})}).json()
+        seen.extend(item["id"] for item in page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == sorted(ids)
+
+def test_count_and_search_gather_shards(client):
+    for value in ("apple pie", "apple tart", "pear", "apple juice"):
+        client.post("/items", json={"value": value})
+
+    assert client.get("/items/count").json() == 4
+    assert client.get("/items/count?exact=true").json() == 4
+    found = client.get("/items/search?q=apple").json()["items"]
+    assert [item["id"] for item in found] == sorted(item["id"] for item in found)
+    assert len(found) == 3
+    assert len(client.get("/items/search?q=apple&mode=ranked").json()["items"]) == 3
+
+def test_collection_etag_covers_every_shard(client):
+    first = client.post("/items", json={"value": "one"}).json()["id"]
+    response = client.get("/items")
+    etag = response.headers["etag"]
+    assert client.get("/items", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/items", json={"value": "two"})
+    assert client.get("/items", headers={"If-None-Match": etag}).status_code == 200
+    client.delete(f"/items/{first}")
+    assert client.get("/items", headers={"If-None-Match": etag}).status_code == 200
+
+def test_bulk_writes_span_shards(client):
+    ids = [client.post("/items", json={"value": f"item {i}"}).json()["id"] for i in range(4)]
+
+    response = client.put("/items/bulk", json={"items": [{"id": item_id, "value": "new"} for item_id in ids]})
+    assert response.status_code == 200
+    assert response.json()["ids"] == ids
+    assert {item["value"] for item in client.get("/items").json()["items"]} == {"new"}
+
+    # An atomic batch with a missing item changes no shard
+    response = client.request("DELETE", "/items/bulk", json={"ids": [ids[0], ids[1], 999]})
+    assert response.status_code == 404
+    assert client.get("/items/count").json() == 4
+
+    response = client.request("DELETE", "/items/bulk", json={"ids": [ids[0], 999, ids[1]], "atomic": False})
+    assert response.json()["ids"] == [ids[0], ids[1]]
+    assert [error["index"] for error in response.json()["errors"]] == [1]
+    assert client.get("/items/count").json() == 2
+
+def test_lookup_and_export_span_shards(client):
+    ids = [client.post("/items", json={"value": f"item {i}"}).json()["id"] for i in range(4)]
+
+    response = client.post("/items/lookup", json={"ids": [ids[3], 999, ids[0]]})
+    assert [item["id"] for item in response.json()["items"]] == [ids[3], ids[0]]
+    assert response.json()["missing"] == [999]
+
+    lines = client.get("/items/export").text.splitlines()
+    assert [json.loads(line)["id"] for line in lines] == sorted(ids)
+
+def test_split_shard(tmp_path):
+    map_path = str(tmp_path / "shards.json")
+    shard_map = db.ShardMap([db.Shard(f"sqlite:///{tmp_path / 'shard0.db'}", 1, 0)])
+    models.prepare_schema(shard_map.shards[0].engine)
+    shard_map.save(map_path)
+    with shard_map.shards[0].SessionLocal() as db_session:
+        for i in range(6):
+            db_session.add(models.Item(value=f"item {i}"))
+        db_session.commit()
+    shard_map.dispose()
+
+    new_map = maintenance.split_shard(map_path, 0, f"sqlite:///{tmp_path / 'shard1.db'}")
+    try:
+        assert [(shard.modulus, shard.residue) for shard in new_map.shards] == [(2, 0), (2, 1)]
+        assert _shard_ids(new_map.shards[0]) == [2, 4, 6]
+        assert _shard_ids(new_map.shards[1]) == [1, 3, 5]
+        assert [stats["items"] for stats in maintenance.shard_stats(new_map)] == [3, 3]
+
+        # Both shards continue the sequence of the one split
+        for shard, expected_id in zip(new_map.shards, (8, 7)):
+            with shard.SessionLocal() as db_session:
+                assert writes.create_item(db_session, "new")["id"] == expected_id
+                db_session.commit()
+    finally:
+        new_map.dispose()
+
+    reloaded = db.ShardMap.load(map_path, db.DATABASE_URL)
+    assert [shard.url for shard in reloaded.shards] == [shard.url for shard in new_map.shards]
+    reloaded.dispose()
+
+def test_split_database_without_autoincrement(tmp_path):
+    """Test that a database whose items table predates AUTOINCREMENT splits into shards that can still create items"""
+    path = tmp_path / "items.db"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE items (id INTEGER NOT NULL PRIMARY KEY, value VARCHAR NOT NULL)")
+        connection.executemany("INSERT INTO items (value) VALUES (?)", [(f"item {i}",) for i in range(5)])
+
+    with patch("app.db.DATABASE_URL", f"sqlite:///{path}"):
+        new_map = maintenance.split_shard(str(tmp_path / "shards.json"), 0, f"sqlite:///{tmp_path / 'shard1.db'}")
+    try:
+        assert _shard_ids(new_map.shards[0]) == [2, 4]
+        assert _shard_ids(new_map.shards[1]) == [1, 3, 5]
+        for shard, expected_ids in zip(new_map.shards, ((6, 8), (7, 9))):
+            with shard.SessionLocal() as db_session:
+                for expected_id in expected_ids:
+                    assert writes.create_item(db_session, "new")["id"] == expected_id
+                    db_session.commit()
+    finally:
+        new_map.dispose()
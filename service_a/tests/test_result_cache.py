@@ -0,0 +1,182 @@
+import multiprocessing
+import sqlite3
+import time
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from prometheus_client import REGISTRY
+
+from app import db, result_cache
+from app.main import app
+
+@pytest.fixture
+def cache(tmp_path):
+    shared = result_cache.SharedCache(str(tmp_path / "cache.db"), max_bytes=1024 * 1024)
+    # The warm-up is skipped, since its reads would count as lookups
+    with patch("app.result_cache.RESULT_CACHE", True), patch("app.result_cache.cache", shared), \
+            patch("app.startup._ready", True):
+        yield shared
+
+@pytest.fixture
+def client(cache):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    db.Base.metadata.create_all(bind=engine)
+
+    def override_get_db():
+        db_session = Session(bind=engine)
+        try:
+            yield db_session
+        finally:
+            db_session.close()
+
+    app.dependency_overrides[db.get_db] = override_get_db
+    with TestClient(app) as c:
+        yield c
+    app.dependency_overrides.clear()
+    engine.dispose()
+
+def lookups(kind):
+    """Hits and misses of a kind of result counted so far by this process"""
+    return {
+        result: REGISTRY.get_sample_value("result_cache_requests_total", {"kind": kind, "result": result}) or 0
+        for result in ("hit", "miss")
+    }
+
+def test_evicts_least_recently_used_over_budget(tmp_path):
+    """Test that the cache stays under its byte budget by evicting the least recently used entries"""
+    cache = result_cache.SharedCache(str(tmp_path / "cache.db"), max_bytes=250)
+    value = "x" * 98  # 100 bytes once encoded
+    before = lookups("items")
+    with patch("app.result_cache.RESULT_CACHE_TOUCH_INTERVAL", 0):
+        cache.put("a", "db", 1, value)
+        cache.put("b", "db", 1, value)
+        assert cache.get("items", "a") == value
+
+        cache.put("c", "db", 1, value)
+        assert cache.get("items", "b") is None
+        assert cache.get("items", "a") == value
+        assert cache.get("items", "c") == value
+
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["bytes"] == 200
+    assert stats["evictions"] == 1
+    after = lookups("items")
+    assert after["hit"] - before["hit"] == 3
+    assert after["miss"] - before["miss"] == 1
+
+def test_lookups_only_read(tmp_path):
+    """Test that hits are marked recently used in batches rather than written by every lookup"""
+    cache = result_cache.SharedCache(str(tmp_path / "cache.db"), max_bytes=1024)
+    cache.put("a", "db", 1, 1)
+    cache.put("b", "db", 1, 2)
+    used = dict(cache._read("SELECT key, used FROM entries"))
+
+    with patch("app.result_cache.RESULT_CACHE_TOUCH_INTERVAL", 0), \
+            patch("app.result_cache.RESULT_CACHE_TOUCH_BATCH", 2):
+        assert cache.get("count", "a") == 1
+        assert cache.get("count", "a") == 1
+        assert dict(cache._read("SELECT key, used FROM entries")) == used
+        assert cache.get("count", "b") == 2
+
+    touched = dict(cache._read("SELECT key, used FROM entries"))
+    assert touched["a"] > used["a"] and touched["b"] > used["b"]
+
+def test_older_generations_are_dropped(tmp_path):
+    """Test that storing a result deletes the entries of older generations of the same database"""
+    cache = result_cache.SharedCache(str(tmp_path / "cache.db"), max_bytes=1024)
+    cache.put("old", "db", 1, 1)
+    cache.put("other", "other db", 1, 1)
+    cache.put("new", "db", 2, 2)
+
+    assert cache.get("count", "old") is None
+    assert cache.get("count", "other") == 1
+    assert cache.stats()["entries"] == 2
+
+    cache.put("new", "db", 2, 22)
+    assert cache.get("count", "new") == 22
+    assert cache.stats()["bytes"] == 3
+
+def test_writes_do_not_wait_for_other_writers(tmp_path):
+    """Test that a result is not stored, without waiting, while another process holds the write lock"""
+    path = str(tmp_path / "cache.db")
+    cache = result_cache.SharedCache(path, max_bytes=1024)
+    cache.put("a", "db", 1, 1)
+    skipped = REGISTRY.get_sample_value("result_cache_writes_skipped_total") or 0
+
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        start = time.perf_counter()
+        cache.put("b", "db", 1, 2)
+        assert time.perf_counter() - start < 0.5
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    assert cache.get("count", "b") is None
+    assert cache.get("count", "a") == 1
+    assert REGISTRY.get_sample_value("result_cache_writes_skipped_total") == skipped + 1
+
+def _put_in_child(path):
+    result_cache.SharedCache(path, max_bytes=1024).put("key", "db", 1, {"from": "child"})
+
+def test_shared_between_processes(tmp_path):
+    """Test that a result cached by one worker process is a hit in another"""
+    path = str(tmp_path / "cache.db")
+    cache = result_cache.SharedCache(path, max_bytes=1024)
+    assert cache.get("item", "key") is None
+
+    child = multiprocessing.get_context("fork").Process(target=_put_in_child, args=(path,))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+
+    assert cache.get("item", "key") == {"from": "child"}
+    assert cache.stats()["entries"] == 1
+
+def test_reads_are_cached_until_a_write(client, cache):
+    """Test that repeated reads hit the cache and any write invalidates them"""
+    item_id = client.post("/items", json={"value": "apple"}).json()["id"]
+
+    before = {kind: lookups(kind)["hit"] for kind in ("items", "search", "count")}
+    for _ in range(2):
+        assert client.get("/items").json()["items"] == [{"id": item_id, "value": "apple"}]
+        assert client.get("/items/search", params={"q": "app"}).json()["items"] == [{"id": item_id, "value": "apple"}]
+        assert client.get("/items/count").json() == 1
+
+    hits = {kind: lookups(kind)["hit"] - before[kind] for kind in before}
+    assert hits == {"items": 1, "search": 1, "count": 1}
+    assert client.get("/cache/stats").json()["entries"] == 3
+
+    client.put(f"/items/{item_id}", json={"value": "applesauce"})
+    assert client.get("/items").json()["items"] == [{"id": item_id, "value": "applesauce"}]
+    assert client.get("/items/search", params={"q": "sauce"}).json()["items"] == [{"id": item_id, "value": "applesauce"}]
+
+    client.delete(f"/items/{item_id}")
+    assert client.get("/items/count").json() == 0
+    assert client.get("/items/search", params={"q": "app"}).json()["items"] == []
+
+def test_response_formats_share_entries(client, cache):
+    """Test that JSON and columns responses of the same query come from one cached result"""
+    client.post("/items", json={"value": "apple"})
+    client.post("/items", json={"value": "pear"})
+
+    before = lookups("items")
+    page = client.get("/items", params={"limit": 1}).json()
+    columns = client.get(
+        "/items", params={"limit": 1}, headers={"Accept": "application/vnd.items.columns+json"}
+    ).json()
+    assert columns == {"ids": [page["items"][0]["id"]], "values": ["apple"], "next_cursor": page["next_cursor"]}
+    after = lookups("items")
+    assert (after["hit"] - before["hit"], after["miss"] - before["miss"]) == (1, 1)
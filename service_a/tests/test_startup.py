@@ -0,0 +1,55 @@
+import threading
+import time
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import db, models, startup
+from app.main import app
+
+def test_schema_is_prepared_once(tmp_path):
+    """Test that the schema is created on the first start and only checked afterwards"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'items.db'}")
+    db.configure_engine(engine, "startup")
+
+    assert models.prepare_schema(engine)
+    assert not models.prepare_schema(engine)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA user_version").scalar() == models.SCHEMA_VERSION
+        triggers = connection.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'").scalar()
+    assert triggers == len(models.ITEM_COUNT_DDL) + len(models.GENERATION_DDL) + len(models.CHANGE_LOG_DDL) + 3
+    engine.dispose()
+
+def test_ready_after_warm_up():
+    """Test that /ready answers 503 while the worker warms up, and /health answers all along"""
+    release = threading.Event()
+    warm_up_sync = startup._warm_up_sync
+
+    def slow_warm_up():
+        release.wait(5)
+        warm_up_sync()
+
+    with patch("app.startup._ready", False), patch("app.startup._warm_up_sync", slow_warm_up):
+        with TestClient(app) as client:
+            assert client.get("/ready").status_code == 503
+            assert client.get("/health").status_code == 200
+
+            release.set()
+            deadline = time.monotonic() + 5
+            while client.get("/ready").status_code != 200 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert client.get("/ready").json() == {"status": "ready"}
+
+def test_warm_up_queries_run_on_an_empty_database(tmp_path):
+    """Test that every warm-up query succeeds before any item exists"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'items.db'}")
+    models.prepare_schema(engine)
+    with db.Session(bind=engine) as db_session:
+        startup.warm_up_queries(db_session)
+    engine.dispose()
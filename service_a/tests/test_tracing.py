@@ -0,0 +1,89 @@
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from service_common import tracing
+from app import db
+from app.main import app
+
+engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+db.Base.metadata.create_all(bind=engine)
+
+def slow_count(db_session, exact, if_none_match):
+    time.sleep(0.1)
+    return None, 0
+
+@pytest.fixture
+def client():
+    def override_get_db():
+        db_session = Session(bind=engine)
+        try:
+            yield db_session
+        finally:
+            db_session.close()
+
+    app.dependency_overrides[db.get_db] = override_get_db
+    tracing.clear()
+    with TestClient(app) as c:
+        yield c
+    app.dependency_overrides.clear()
+
+def test_propagated_trace(client):
+    """Test that a request carrying a trace ID is traced under it and reports its spans"""
+    with patch("service_common.tracing.TRACING", True):
+        response = client.get("/items/count", headers={"X-Trace-Id": "abc123"})
+        assert response.status_code == 200
+        assert response.headers["X-Trace-Id"] == "abc123"
+        timings = [metric.split(";")[0] for metric in response.headers["Server-Timing"].split(", ")]
+        assert timings == ["parse", "query", "serialize", "total"]
+        # The phases around the recorded spans are inferred, not timed
+        assert response.headers["Server-Timing"].startswith('parse;desc="estimated";dur=')
+
+        traces = client.get("/traces", params={"trace_id": "abc123"}).json()["traces"]
+    assert len(traces) == 1
+    trace = traces[0]
+    assert (trace["service"], trace["method"], trace["path"], trace["status"]) == ("service_a", "GET", "/items/count", 200)
+    assert [span["name"] for span in trace["spans"]] == ["parse", "query", "serialize"]
+    assert [span.get("estimated", False) for span in trace["spans"]] == [True, False, True]
+    assert not trace["slow"]
+    assert "profile" not in trace
+
+def test_traces_are_appended_to_the_trace_file(client, tmp_path):
+    """Test that finished traces reach TRACE_FILE through the writer thread"""
+    path = tmp_path / "traces.jsonl"
+    with patch("service_common.tracing.TRACING", True), patch("service_common.tracing.TRACE_FILE", str(path)):
+        trace_ids = [client.get("/items/count").headers["X-Trace-Id"] for _ in range(3)]
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and len(path.read_text().splitlines() if path.exists() else []) < 3:
+            time.sleep(0.01)
+
+    assert [json.loads(line)["trace_id"] for line in path.read_text().splitlines()] == trace_ids
+
+def test_slow_request_is_profiled(client):
+    """Test that a request over the threshold gets stack samples of where it spent its time"""
+    with patch("service_common.tracing.TRACING", True), patch("service_common.tracing.TRACE_SLOW_MS", 20), \
+            patch("service_common.tracing.TRACE_PROFILE_INTERVAL_MS", 1), patch("app.crud.count_items", slow_count):
+        trace_id = client.get("/items/count").headers["X-Trace-Id"]
+        traces = client.get("/traces", params={"slow": True}).json()["traces"]
+
+    assert [trace["trace_id"] for trace in traces] == [trace_id]
+    assert traces[0]["slow"]
+    assert any(stack.endswith("test_tracing.py:slow_count") for stack in traces[0]["profile"])
+
+def test_untraced_when_disabled(client):
+    """Test that nothing is recorded or added to responses while tracing is off"""
+    response = client.get("/items/count", headers={"X-Trace-Id": "abc123"})
+    assert "X-Trace-Id" not in response.headers
+    assert "Server-Timing" not in response.headers
+    assert client.get("/traces").json() == {"enabled": False, "traces": []}
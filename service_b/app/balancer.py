@@ -0,0 +1,130 @@
+import asyncio
+import random
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+class Backend:
+    """A Service A instance with its load and health as seen by this process"""
+
+    __slots__ = ("url", "outstanding", "latency", "failures", "ejected")
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0  # Requests sent and not answered yet
+        self.latency = 0.0  # Exponentially weighted moving average, in seconds
+        self.failures = 0  # Consecutive failed requests
+        self.ejected = False
+
+    def score(self) -> float:
+        """Expected wait for a new request: the latency times the requests ahead of it"""
+        return self.latency * (self.outstanding + 1)
+
+class Balancer:
+    """
+    Client-side load balancer over several Service A instances
+
+    Every request goes to the backend picked by the policy: "p2c" samples two
+    backends and takes the one with the lower latency-weighted load, "least"
+    takes the one with the fewest outstanding requests. Backends that fail
+    `eject_after` requests in a row (errors, timeouts or 5XX responses) are
+    ejected and only readmitted once their /health check passes. If every
+    backend is ejected, all of them are used again rather than failing.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        policy: str = "p2c",
+        eject_after: int = 3,
+        latency_decay: float = 0.3,
+        rng: Optional[random.Random] = None,
+    ):
+        if not urls:
+            raise ValueError("At least one backend URL is required")
+        if policy not in ("p2c", "least"):
+            raise ValueError(f"Unknown load balancing policy: {policy}")
+        self.backends = [Backend(url) for url in urls]
+        self.policy = policy
+        self.eject_after = eject_after
+        self.latency_decay = latency_decay
+        self._random = rng or random.Random()
+        self.ejections = 0
+
+    def acquire(self) -> Backend:
+        """Pick the backend for a request and count the request as outstanding on it"""
+        candidates = [backend for backend in self.backends if not backend.ejected] or self.backends
+        if len(candidates) == 1:
+            backend = candidates[0]
+        elif self.policy == "least":
+            backend = min(candidates, key=lambda b: (b.outstanding, b.latency))
+        else:
+            first, second = self._random.sample(candidates, 2)
+            backend = first if first.score() <= second.score() else second
+        backend.outstanding += 1
+        return backend
+
+    def release(self, backend: Backend, latency: float, succeeded: Optional[bool]) -> None:
+        """
+        Record the outcome of a request sent to a backend
+
+        Args:
+            backend: Backend returned by acquire
+            latency: Seconds the request took
+            succeeded: Whether the backend answered without a server error, or
+                None if the request was abandoned (e.g. cancelled) before that
+                was known
+        """
+        backend.outstanding -= 1
+        if succeeded is None:
+            return
+        if backend.latency:
+            backend.latency += self.latency_decay * (latency - backend.latency)
+        else:
+            backend.latency = latency
+        if succeeded:
+            backend.failures = 0
+            return
+        backend.failures += 1
+        if backend.failures >= self.eject_after and not backend.ejected:
+            backend.ejected = True
+            self.ejections += 1
+
+    def readmit(self, backend: Backend) -> None:
+        """Put an ejected backend back in rotation with a clean slate"""
+        backend.ejected = False
+        backend.failures = 0
+        backend.latency = 0.0
+
+    async def check_ejected(self, client: httpx.AsyncClient, timeout: float) -> None:
+        """Readmit every ejected backend whose /health check answers 200"""
+        async def check(backend: Backend) -> None:
+            try:
+                response = await client.get(f"{backend.url}/health", timeout=timeout)
+            except httpx.HTTPError:
+                return
+            if response.status_code == 200:
+                self.readmit(backend)
+
+        await asyncio.gather(*(check(backend) for backend in self.backends if backend.ejected))
+
+    async def run_health_checks(
+        self, get_client: Callable[[], httpx.AsyncClient], interval: float, timeout: float
+    ) -> None:
+        """Check the ejected backends every `interval` seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_ejected(get_client(), timeout)
+
+    def stats(self) -> List[Dict[str, object]]:
+        """Load and health of every backend"""
+        return [
+            {
+                "url": backend.url,
+                "outstanding": backend.outstanding,
+                "latency": backend.latency,
+                "failures": backend.failures,
+                "ejected": backend.ejected,
+            }
+            for backend in self.backends
+        ]
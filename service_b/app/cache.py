@@ -0,0 +1,188 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+# A loader fetches a value and returns it together with its size in bytes. It
+# is passed the previous, expired value for the key (or None) so it can
+# revalidate it instead of fetching it again.
+Loader = Callable[[Optional[Any]], Awaitable[Tuple[Any, int]]]
+
+class CachedError(Exception):
+    """
+    Raised by a loader to cache an error instead of a value
+
+    The wrapped error is raised to every caller until the entry expires.
+    """
+
+    def __init__(self, error: Exception, ttl: float):
+        super().__init__(str(error))
+        self.error = error
+        self.ttl = ttl
+
+class _Entry:
+    """A cached value (or error) with its size and expiry times"""
+
+    __slots__ = ("value", "error", "size", "expires_at", "stale_until")
+
+    def __init__(self, value: Any, error: Optional[Exception], size: int, expires_at: float, stale_until: float):
+        self.value = value
+        self.error = error
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+    def result(self) -> Any:
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class ResponseCache:
+    """
+    In-process cache for upstream responses
+
+    Entries are fresh for `ttl` seconds and may then be served stale for
+    another `stale_ttl` seconds while a background refresh runs. Entries are
+    evicted least recently used first once there are more than `max_entries`
+    of them or they take more than `max_bytes`; expired entries are kept
+    until then so they can be revalidated. Concurrent misses for the same
+    key share a single load, which runs in the context (e.g. the deadline)
+    of the caller that started it and is cancelled once every caller
+    waiting for it was cancelled. Background refreshes run outside of any
+    caller's context and are never cancelled.
+
+    Values are shared between callers and must not be modified.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        stale_ttl: float = 0.0,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def get_or_load(self, key: Hashable, loader: Loader) -> Any:
+        """
+        Get a value from the cache, loading it on a miss
+
+        Args:
+            key: Cache key
+            loader: Coroutine function that fetches the value and its size,
+                given the previous value for the key or None
+
+        Returns:
+            The cached or freshly loaded value
+        """
+        entry = self._entries.get(key)
+        previous = None
+        if entry is not None:
+            now = self._clock()
+            if now < entry.expires_at:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry.result()
+            if now < entry.stale_until:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._load(key, loader, entry.value, background=True)
+                return entry.result()
+            previous = entry.value
+
+        self.misses += 1
+        if key in self._inflight:
+            self.coalesced += 1
+        task = self._load(key, loader, previous)
+        self._waiters[task] += 1
+        try:
+            # Shield the load so a cancelled caller does not cancel it for the others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(task) == 1:
+                task.cancel()  # Nobody else wants it, e.g. every client disconnected
+            raise
+        finally:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+
+    def _load(self, key: Hashable, loader: Loader, previous: Optional[Any], background: bool = False) -> asyncio.Task:
+        """Start loading a key, or return the load already in flight for it"""
+        task = self._inflight.get(key)
+        if task is None:
+            if background:
+                # A fresh context, so the refresh is not bound to the deadline of the request that triggered it
+                task = contextvars.Context().run(asyncio.ensure_future, self._fill(key, loader, previous))
+            else:
+                task = asyncio.ensure_future(self._fill(key, loader, previous))
+            self._inflight[key] = task
+            self._waiters[task] = 0
+            task.add_done_callback(lambda done: self._load_done(key, done))
+        if background:
+            self._waiters[task] += 1  # Never drops to zero, so the refresh is not cancelled
+        return task
+
+    def _load_done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        self._waiters.pop(task, None)
+        if not task.cancelled():
+            task.exception()  # Mark background refresh errors as retrieved
+
+    async def _fill(self, key: Hashable, loader: Loader, previous: Optional[Any]) -> Any:
+        try:
+            value, size = await loader(previous)
+        except CachedError as e:
+            self._store(key, _Entry(None, e.error, 0, self._clock() + e.ttl, 0.0))
+            raise e.error
+        now = self._clock()
+        self._store(key, _Entry(value, None, size, now + self.ttl, now + self.ttl + self.stale_ttl))
+        return value
+
+    def _store(self, key: Hashable, entry: _Entry) -> None:
+        if key in self._entries:
+            self._remove(key)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def clear(self) -> None:
+        """Drop all entries (loads in flight are kept)"""
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Return the cache counters and current size"""
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
@@ -1,25 +1,652 @@
 import os
+import json
+import asyncio
+import time
 import httpx
-from typing import Dict, Any, List
+from typing import Dict, Any, Awaitable, Callable, Iterable, List, Optional, AsyncIterator, NamedTuple, Tuple, Union
+
+from service_common import metrics, tracing
+
+from . import deadlines, serialization
+from .balancer import Balancer
+from .cache import ResponseCache, CachedError
+from .replica import Replica
+from .resilience import CircuitBreaker, CircuitOpenError, LatencyTracker, backoff_delay
 
 # Get Service A base URL from environment variable or use default
 SERVICE_A_BASE_URL = os.getenv("SERVICE_A_BASE_URL", "http://localhost:8000")
 
+# Comma-separated URLs of several Service A instances to balance requests
+# over; defaults to SERVICE_A_BASE_URL alone. The policy is "p2c" (power of
+# two choices weighted by latency) or "least" (fewest outstanding requests).
+# An instance failing SERVICE_A_EJECT_AFTER requests in a row is ejected
+# until its /health check, run every SERVICE_A_HEALTH_CHECK_INTERVAL
+# seconds, passes again.
+SERVICE_A_BASE_URLS = [
+    url.strip() for url in os.getenv("SERVICE_A_BASE_URLS", SERVICE_A_BASE_URL).split(",") if url.strip()
+]
+SERVICE_A_LB_POLICY = os.getenv("SERVICE_A_LB_POLICY", "p2c")
+SERVICE_A_EJECT_AFTER = int(os.getenv("SERVICE_A_EJECT_AFTER", "3"))
+SERVICE_A_HEALTH_CHECK_INTERVAL = float(os.getenv("SERVICE_A_HEALTH_CHECK_INTERVAL", "5"))
+SERVICE_A_HEALTH_CHECK_TIMEOUT = float(os.getenv("SERVICE_A_HEALTH_CHECK_TIMEOUT", "1"))
+
+# Connection pool settings for the shared client
+SERVICE_A_MAX_CONNECTIONS = int(os.getenv("SERVICE_A_MAX_CONNECTIONS", "100"))
+SERVICE_A_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("SERVICE_A_MAX_KEEPALIVE_CONNECTIONS", "20"))
+SERVICE_A_KEEPALIVE_EXPIRY = float(os.getenv("SERVICE_A_KEEPALIVE_EXPIRY", "30"))
+
+# Per-phase timeouts (seconds) for calls to Service A
+SERVICE_A_CONNECT_TIMEOUT = float(os.getenv("SERVICE_A_CONNECT_TIMEOUT", "2"))
+SERVICE_A_READ_TIMEOUT = float(os.getenv("SERVICE_A_READ_TIMEOUT", "10"))
+SERVICE_A_WRITE_TIMEOUT = float(os.getenv("SERVICE_A_WRITE_TIMEOUT", "10"))
+SERVICE_A_POOL_TIMEOUT = float(os.getenv("SERVICE_A_POOL_TIMEOUT", "5"))
+
+# Every client call gets SERVICE_A_DEADLINE seconds in total, retries
+# included, or what is left of the budget Service B's own caller sent in
+# X-Deadline-Ms if that is less; attempts are cut short so the deadline is
+# never overrun.
+# Idempotent requests that time out, fail to connect or get a 502/503/504 are
+# retried up to SERVICE_A_RETRIES times after a jittered exponential backoff
+# starting at SERVICE_A_RETRY_BACKOFF seconds, unless the deadline would pass
+# first.
+SERVICE_A_DEADLINE = float(os.getenv("SERVICE_A_DEADLINE", "5"))
+SERVICE_A_RETRIES = int(os.getenv("SERVICE_A_RETRIES", "2"))
+SERVICE_A_RETRY_BACKOFF = float(os.getenv("SERVICE_A_RETRY_BACKOFF", "0.05"))
+SERVICE_A_RETRY_BACKOFF_MAX = float(os.getenv("SERVICE_A_RETRY_BACKOFF_MAX", "1"))
+
+# An idempotent request still unanswered after this percentile of the recent
+# latencies of its client function (and at least SERVICE_A_HEDGE_MIN_DELAY
+# seconds) is sent a second time, possibly to another instance; the first
+# answer wins. 0 disables hedging.
+SERVICE_A_HEDGE_PERCENTILE = float(os.getenv("SERVICE_A_HEDGE_PERCENTILE", "95"))
+SERVICE_A_HEDGE_MIN_DELAY = float(os.getenv("SERVICE_A_HEDGE_MIN_DELAY", "0.01"))
+
+# After SERVICE_A_BREAKER_FAILURES failed requests in a row, requests fail
+# fast for SERVICE_A_BREAKER_RESET seconds (0 disables the breaker). Cached
+# responses are served, however old, while Service A is failing unless
+# SERVICE_B_SERVE_STALE_ON_ERROR is off.
+SERVICE_A_BREAKER_FAILURES = int(os.getenv("SERVICE_A_BREAKER_FAILURES", "5"))
+SERVICE_A_BREAKER_RESET = float(os.getenv("SERVICE_A_BREAKER_RESET", "10"))
+SERVICE_B_SERVE_STALE_ON_ERROR = os.getenv("SERVICE_B_SERVE_STALE_ON_ERROR", "true").lower() in ("1", "true", "yes")
+
+# HTTP/2 needs the optional "h2" package (pip install "httpx[http2]")
+SERVICE_A_HTTP2 = os.getenv("SERVICE_A_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Number of items requested per page when following cursors
+SERVICE_A_PAGE_SIZE = int(os.getenv("SERVICE_A_PAGE_SIZE", "500"))
+
+# Format requested for lists and exports: "columns" asks Service A for its
+# compact columns format (parallel id and value arrays), "json" for objects
+SERVICE_A_WIRE_FORMAT = os.getenv("SERVICE_A_WIRE_FORMAT", "columns").lower()
+
+# Batch lookups are split into chunks of this many IDs (at most Service A's
+# limit of 1000), fetched with at most SERVICE_A_LOOKUP_CONCURRENCY in flight
+SERVICE_A_LOOKUP_CHUNK_SIZE = int(os.getenv("SERVICE_A_LOOKUP_CHUNK_SIZE", "200"))
+SERVICE_A_LOOKUP_CONCURRENCY = int(os.getenv("SERVICE_A_LOOKUP_CONCURRENCY", "4"))
+
+# Response cache settings. Entries are fresh for SERVICE_B_CACHE_TTL seconds
+# and can be served stale for SERVICE_B_CACHE_STALE_TTL more seconds while
+# they are refreshed in the background. 404s from get_item are only cached
+# when SERVICE_B_CACHE_NEGATIVE_TTL is above zero.
+SERVICE_B_CACHE_TTL = float(os.getenv("SERVICE_B_CACHE_TTL", "0"))
+SERVICE_B_CACHE_STALE_TTL = float(os.getenv("SERVICE_B_CACHE_STALE_TTL", "0"))
+SERVICE_B_CACHE_NEGATIVE_TTL = float(os.getenv("SERVICE_B_CACHE_NEGATIVE_TTL", "0"))
+SERVICE_B_CACHE_MAX_ENTRIES = int(os.getenv("SERVICE_B_CACHE_MAX_ENTRIES", "10000"))
+SERVICE_B_CACHE_MAX_BYTES = int(os.getenv("SERVICE_B_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Keep an in-memory replica of Service A's items, followed through its change
+# feed, and serve reads from it while it is at most SERVICE_B_REPLICA_MAX_LAG
+# seconds behind; otherwise reads go to Service A as usual. Each poll of the
+# feed waits up to SERVICE_B_REPLICA_POLL_WAIT seconds for a change.
+SERVICE_B_REPLICA = os.getenv("SERVICE_B_REPLICA", "false").lower() in ("1", "true", "yes")
+SERVICE_B_REPLICA_MAX_LAG = float(os.getenv("SERVICE_B_REPLICA_MAX_LAG", "2"))
+SERVICE_B_REPLICA_POLL_WAIT = float(os.getenv("SERVICE_B_REPLICA_POLL_WAIT", "1"))
+SERVICE_B_REPLICA_BATCH_SIZE = int(os.getenv("SERVICE_B_REPLICA_BATCH_SIZE", "1000"))
+
+# Before /ready reports the process ready, open SERVICE_B_WARMUP_CONNECTIONS
+# keep-alive connections to every Service A instance, giving up after
+# SERVICE_B_WARMUP_TIMEOUT seconds so an unreachable instance does not keep
+# the process out of rotation
+SERVICE_B_WARMUP = os.getenv("SERVICE_B_WARMUP", "true").lower() in ("1", "true", "yes")
+SERVICE_B_WARMUP_TIMEOUT = float(os.getenv("SERVICE_B_WARMUP_TIMEOUT", "5"))
+SERVICE_B_WARMUP_CONNECTIONS = int(os.getenv("SERVICE_B_WARMUP_CONNECTIONS", "2"))
+
+# Cache shared by the functions below; concurrent identical misses share one request
+cache = ResponseCache(
+    ttl=SERVICE_B_CACHE_TTL,
+    stale_ttl=SERVICE_B_CACHE_STALE_TTL,
+    max_entries=SERVICE_B_CACHE_MAX_ENTRIES,
+    max_bytes=SERVICE_B_CACHE_MAX_BYTES,
+)
+
+# Balancer, circuit breaker and latency history shared by the functions below
+balancer = Balancer(SERVICE_A_BASE_URLS, policy=SERVICE_A_LB_POLICY, eject_after=SERVICE_A_EJECT_AFTER)
+breaker = CircuitBreaker(SERVICE_A_BREAKER_FAILURES, SERVICE_A_BREAKER_RESET)
+latencies = LatencyTracker(SERVICE_A_HEDGE_PERCENTILE)
+replica = Replica()
+
+# Statuses worth retrying: the instance or a proxy in front of it is overloaded or restarting
+RETRY_STATUSES = {502, 503, 504}
+
+# Header carrying the remaining budget of a request to Service A, in
+# milliseconds, and the header Service A sets when it gave up on a request
+# because that budget ran out. Such responses are not retried.
+DEADLINE_HEADER = deadlines.DEADLINE_HEADER
+DEADLINE_EXCEEDED_HEADER = deadlines.DEADLINE_EXCEEDED_HEADER
+
+SERVICE_A_REQUEST_DURATION = metrics.Histogram(
+    "service_a_request_duration_seconds",
+    "Latency of requests to Service A by client function and status",
+    ("function", "status"),
+    buckets=metrics.DEFAULT_BUCKETS,
+)
+
+# Each worker has its own cache, breaker, balancer and replica. Gauges that
+# add up (counters and sizes) are summed over the workers, the breaker and
+# ejection flags report whether any worker's is set, and the replica's
+# position and lag are kept per worker.
+CACHE_STATS = metrics.Gauge(
+    "service_b_cache", "Response cache counters and size (see /cache/stats)", ("stat",),
+    multiprocess_mode="livesum",
+)
+
+def _collect_cache_stats() -> None:
+    for name, value in cache.stats().items():
+        CACHE_STATS.labels(name).set(value)
+
+metrics.register_collector(_collect_cache_stats)
+
+SERVICE_A_RETRIES_TOTAL = metrics.Counter(
+    "service_a_retries_total", "Requests to Service A sent again after a failure", ("function",)
+)
+SERVICE_A_HEDGES_TOTAL = metrics.Counter(
+    "service_a_hedges_total", "Hedged second requests sent to Service A", ("function",)
+)
+STALE_SERVED_TOTAL = metrics.Counter(
+    "service_b_stale_served_total", "Expired cached responses served because Service A failed"
+)
+CIRCUIT_OPEN = metrics.Gauge(
+    "service_a_circuit_open", "Whether the circuit breaker to Service A is open or half-open (1) or closed (0)",
+    multiprocess_mode="livemax",
+)
+
+BACKEND_OUTSTANDING = metrics.Gauge(
+    "service_a_backend_outstanding", "Requests in flight per Service A instance", ("backend",),
+    multiprocess_mode="livesum",
+)
+BACKEND_EJECTED = metrics.Gauge(
+    "service_a_backend_ejected", "Whether a Service A instance is ejected (1) or in rotation (0)", ("backend",),
+    multiprocess_mode="livemax",
+)
+BACKEND_EJECTIONS = metrics.Gauge(
+    "service_a_backend_ejections", "Times a Service A instance was ejected since startup",
+    multiprocess_mode="livesum",
+)
+
+def _collect_backend_stats() -> None:
+    for backend in balancer.backends:
+        BACKEND_OUTSTANDING.labels(backend.url).set(backend.outstanding)
+        BACKEND_EJECTED.labels(backend.url).set(int(backend.ejected))
+    BACKEND_EJECTIONS.set(balancer.ejections)
+    CIRCUIT_OPEN.set(int(breaker.state != CircuitBreaker.CLOSED))
+
+metrics.register_collector(_collect_backend_stats)
+
+REPLICA_READS_TOTAL = metrics.Counter(
+    "service_b_replica_reads_total", "Reads by whether the replica served them or Service A did", ("source",)
+)
+REPLICA_RELOADS_TOTAL = metrics.Counter(
+    "service_b_replica_reloads_total", "Full reads of Service A's items to load the replica"
+)
+REPLICA_STATE = metrics.Gauge(
+    "service_b_replica", "Replica position in the change feed, size and lag in seconds (see /replica/stats)", ("stat",),
+    multiprocess_mode="liveall",
+)
+
+def _collect_replica_stats() -> None:
+    if not SERVICE_B_REPLICA:
+        return
+    stats = replica.stats()
+    REPLICA_STATE.labels("seq").set(stats["seq"] or 0)
+    REPLICA_STATE.labels("items").set(stats["items"])
+    # A replica that never caught up is reported as infinitely behind
+    REPLICA_STATE.labels("lag").set(stats["lag"] if stats["lag"] is not None else float("inf"))
+
+metrics.register_collector(_collect_replica_stats)
+
+# App-scoped client, opened and closed by the FastAPI lifespan in main.py,
+# the task readmitting ejected Service A instances, the one following the
+# change feed and the one warming the client up
+_client: Optional[httpx.AsyncClient] = None
+_health_checks: Optional[asyncio.Task] = None
+_replication: Optional[asyncio.Task] = None
+_warm_up: Optional[asyncio.Task] = None
+_ready = not SERVICE_B_WARMUP
+
+def create_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    """
+    Create a pooled HTTP client for Service A
+
+    Args:
+        transport: Optional transport to use instead of the network (e.g. in tests)
+
+    Returns:
+        A new httpx.AsyncClient configured from the SERVICE_A_* settings
+    """
+    limits = httpx.Limits(
+        max_connections=SERVICE_A_MAX_CONNECTIONS,
+        max_keepalive_connections=SERVICE_A_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=SERVICE_A_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=SERVICE_A_CONNECT_TIMEOUT,
+        read=SERVICE_A_READ_TIMEOUT,
+        write=SERVICE_A_WRITE_TIMEOUT,
+        pool=SERVICE_A_POOL_TIMEOUT,
+    )
+    return httpx.AsyncClient(
+        base_url=SERVICE_A_BASE_URL,
+        limits=limits,
+        timeout=timeout,
+        http2=SERVICE_A_HTTP2,
+        transport=transport,
+    )
+
+async def start_client() -> None:
+    """Open the shared client if it is not already open, and start the health checks, replication and warm-up"""
+    global _client, _health_checks, _replication, _warm_up
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    if len(balancer.backends) > 1 and _health_checks is None:
+        _health_checks = asyncio.create_task(balancer.run_health_checks(
+            get_client, SERVICE_A_HEALTH_CHECK_INTERVAL, SERVICE_A_HEALTH_CHECK_TIMEOUT
+        ))
+    if SERVICE_B_REPLICA and _replication is None:
+        _replication = asyncio.create_task(run_replication())
+    if not _ready and _warm_up is None:
+        _warm_up = asyncio.create_task(warm_up())
+
+async def _stop(task: Optional[asyncio.Task]) -> None:
+    """Cancel a background task and wait for it to end"""
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+async def close_client() -> None:
+    """Stop the background tasks, close the shared client and release its pooled connections"""
+    global _client, _health_checks, _replication, _warm_up
+    await _stop(_health_checks)
+    await _stop(_replication)
+    await _stop(_warm_up)
+    _health_checks = _replication = _warm_up = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def warm_up() -> None:
+    """
+    Open keep-alive connections to every Service A instance, then mark the process ready
+
+    Each connection is opened by a /health request; failures are ignored,
+    since requests open the connections they need anyway.
+    """
+    global _ready
+    client = get_client()
+    requests = [
+        client.get(f"{backend.url}/health", timeout=SERVICE_B_WARMUP_TIMEOUT)
+        for backend in balancer.backends
+        for _ in range(SERVICE_B_WARMUP_CONNECTIONS)
+    ]
+    try:
+        await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), SERVICE_B_WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    _ready = True
+
+def is_ready() -> bool:
+    """Whether the client finished warming up"""
+    return _ready
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Get the shared client for Service A
+
+    The client is normally opened by the application lifespan. It is created
+    lazily here so the functions below also work when the lifespan has not
+    run (e.g. when a test patches `_client` or uses TestClient without `with`).
+
+    Returns:
+        The app-scoped httpx.AsyncClient
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    return _client
+
+class Validated(NamedTuple):
+    """A decoded response body from Service A with the ETag it was served with"""
+    data: Any
+    etag: Optional[str]
+    size: int
+
+def _accept(media_type: str) -> Dict[str, str]:
+    """Accept header asking for a compact format, with JSON as the fallback"""
+    if SERVICE_A_WIRE_FORMAT != "columns":
+        return {}
+    return {"Accept": f"{media_type}, application/json;q=0.5"}
+
+async def _attempt(
+    function: str,
+    method: str,
+    path: str,
+    deadline: float,
+    stream: bool = False,
+    **kwargs: Any,
+) -> httpx.Response:
+    """
+    Send one request to the Service A instance picked by the balancer
+
+    The request's timeouts are shortened to what is left before `deadline`,
+    which is also sent to Service A so it stops working on the request when
+    the budget is spent (except for streams, which may take longer). The
+    outcome is recorded for the balancer, the circuit breaker and the
+    metrics; answers cut short by the deadline count as neither success nor
+    failure.
+    """
+    if not breaker.allow():
+        raise CircuitOpenError("Circuit breaker to Service A is open")
+    # From here on the breaker expects an outcome (allow() may have reserved
+    # its half-open trial), so even a request that cannot be built records one
+    backend = None
+    start = time.perf_counter()
+    status = "error"
+    succeeded = None
+    try:
+        remaining = max(deadline - time.monotonic(), 0.001)
+        timeout = httpx.Timeout(
+            connect=min(SERVICE_A_CONNECT_TIMEOUT, remaining),
+            read=min(SERVICE_A_READ_TIMEOUT, remaining),
+            write=min(SERVICE_A_WRITE_TIMEOUT, remaining),
+            pool=min(SERVICE_A_POOL_TIMEOUT, remaining),
+        )
+
+        if not stream:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), DEADLINE_HEADER: str(int(remaining * 1000))}
+        trace = tracing.current()
+        if trace is not None:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), tracing.TRACE_HEADER: trace.trace_id}
+
+        client = get_client()
+        backend = balancer.acquire()
+        request = client.build_request(method, backend.url + path, timeout=timeout, **kwargs)
+        start = time.perf_counter()
+        with tracing.span("upstream", sync=False):
+            response = await client.send(request, stream=stream)
+        tracing.add_remote_spans("service_a", response.headers.get(tracing.SERVER_TIMING_HEADER), start)
+        status = str(response.status_code)
+        if not _deadline_exceeded(response):
+            succeeded = response.status_code < 500
+        return response
+    except httpx.TransportError:
+        succeeded = False
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if backend is not None:
+            balancer.release(backend, elapsed, succeeded)
+        breaker.record(succeeded)
+        SERVICE_A_REQUEST_DURATION.labels(function, status).observe(elapsed)
+        if succeeded:
+            latencies.observe(function, elapsed)
+
+def _deadline_exceeded(response: httpx.Response) -> bool:
+    """Whether Service A gave up on a request because its deadline passed"""
+    return response.status_code == 504 and DEADLINE_EXCEEDED_HEADER in response.headers
+
+async def _hedged(function: str, method: str, path: str, deadline: float, **kwargs: Any) -> httpx.Response:
+    """
+    Send a request, and a second copy if the first is slower than usual
+
+    The first successful answer wins and the other attempt is cancelled.
+    """
+    threshold = latencies.threshold(function)
+    if threshold is None:
+        return await _attempt(function, method, path, deadline, **kwargs)
+    first = asyncio.ensure_future(_attempt(function, method, path, deadline, **kwargs))
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=max(threshold, SERVICE_A_HEDGE_MIN_DELAY))
+        if done:
+            return first.result()
+        SERVICE_A_HEDGES_TOTAL.labels(function).inc()
+        pending.add(asyncio.ensure_future(_attempt(function, method, path, deadline, **kwargs)))
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception() and task.result().status_code < 500:
+                    return task.result()
+            if not pending:
+                # Both attempts failed: report the last one
+                return done.pop().result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def _request(
+    function: str,
+    method: str,
+    path: str,
+    stream: bool = False,
+    idempotent: Optional[bool] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    """
+    Send a request to Service A within SERVICE_A_DEADLINE, or the request's deadline if it is sooner
+
+    Idempotent requests are hedged (unless streamed) and retried after
+    timeouts, connection errors and 502/503/504 responses while the deadline
+    allows, except when Service A reports that the deadline itself passed. Requests are not sent at all while the circuit breaker is open.
+
+    Args:
+        function: Name of the client function making the request, used as label
+        method: HTTP method
+        path: Path of the endpoint
+        stream: Return before the body is read (see httpx.AsyncClient.send)
+        idempotent: Whether the request may be sent more than once; defaults
+            to True for GET
+        **kwargs: Passed to httpx.AsyncClient.build_request
+
+    Returns:
+        The response
+    """
+    if idempotent is None:
+        idempotent = method == "GET"
+    deadline = deadlines.upstream_deadline(SERVICE_A_DEADLINE)
+    attempt = 0
+    while True:
+        response = None
+        error = None
+        try:
+            if idempotent and not stream:
+                response = await _hedged(function, method, path, deadline, **kwargs)
+            else:
+                response = await _attempt(function, method, path, deadline, stream, **kwargs)
+            if (
+                not idempotent
+                or response.status_code not in RETRY_STATUSES
+                or _deadline_exceeded(response)
+            ):
+                return response
+        except httpx.TransportError as e:
+            if not idempotent:
+                raise
+            error = e
+
+        attempt += 1
+        delay = backoff_delay(attempt, SERVICE_A_RETRY_BACKOFF, SERVICE_A_RETRY_BACKOFF_MAX)
+        if attempt > SERVICE_A_RETRIES or time.monotonic() + delay >= deadline:
+            if response is not None:
+                return response
+            raise error
+        if response is not None:
+            await response.aclose()
+        SERVICE_A_RETRIES_TOTAL.labels(function).inc()
+        await asyncio.sleep(delay)
+
+async def _fetch_json(
+    function: str,
+    path: str,
+    params: Optional[Dict[str, Any]] = None,
+    previous: Optional[Validated] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Tuple[Validated, int]:
+    """
+    Get a JSON response from Service A
+
+    If a previous response with an ETag is given, it is revalidated with
+    If-None-Match and reused when Service A answers 304, which skips both
+    the download and the JSON parse.
+
+    Args:
+        function: Name of the calling client function, for metrics
+        path: Path of the endpoint
+        params: Query parameters
+        previous: Previous response for the same request, if any
+        headers: Extra request headers
+
+    Returns:
+        The decoded body with its ETag, and its size in bytes
+    """
+    headers = dict(headers or {})
+    if previous is not None and previous.etag:
+        headers["If-None-Match"] = previous.etag
+    response = await _request(function, "GET", path, params=params, headers=headers)
+    if response.status_code == 304 and previous is not None:
+        return previous, previous.size
+    response.raise_for_status()  # Raise exception for 4XX/5XX responses
+    with tracing.span("decode"):
+        data = serialization.decode_response(response)
+    body = Validated(data, response.headers.get("ETag"), len(response.content))
+    return body, body.size
+
+def _page_items(page: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+    """Items of a list page in either of Service A's formats"""
+    if "ids" in page:
+        return ({"id": item_id, "value": value} for item_id, value in zip(page["ids"], page["values"]))
+    return page["items"]
+
+async def _get_all_pages(
+    function: str,
+    path: str,
+    params: Dict[str, Any],
+    previous: Optional[Validated] = None,
+) -> Tuple[Validated, int]:
+    """
+    Get every page of a paged list endpoint of Service A
+
+    Service A's list ETags are the generation of the whole items table, so
+    if the first page is unchanged, so are all the others and the previous
+    result is reused.
+
+    Args:
+        function: Name of the calling client function, for metrics
+        path: Path of the endpoint
+        params: Query parameters other than the paging ones
+        previous: Previous result for the same request, if any
+
+    Returns:
+        Dict containing the items of all pages with the first page's ETag,
+        and the total size in bytes
+    """
+    first_page = None
+    if previous is not None:
+        first_page = Validated(None, previous.etag, previous.size)
+
+    items: List[Dict[str, Any]] = []
+    etag = None
+    size = 0
+    page_params: Dict[str, Any] = {**params, "limit": SERVICE_A_PAGE_SIZE}
+    while True:
+        page, page_size = await _fetch_json(
+            function, path, page_params, first_page, _accept(serialization.COLUMNS_MEDIA_TYPE)
+        )
+        if page is first_page:
+            return previous, previous.size
+        first_page = None
+        etag = etag or page.etag
+        items.extend(_page_items(page.data))
+        size += page_size
+
+        next_cursor = page.data.get("next_cursor")
+        if not next_cursor:
+            result = Validated({"items": items}, etag, size)
+            return result, size
+        page_params = {**params, "limit": SERVICE_A_PAGE_SIZE, "cursor": next_cursor}
+
+def _is_upstream_failure(error: Exception) -> bool:
+    """Whether an error means Service A is unavailable, rather than that the request was wrong"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, CircuitOpenError))
+
+async def _cached(key: Tuple[Any, ...], loader: Callable[[Optional[Validated]], Awaitable[Tuple[Validated, int]]]) -> Any:
+    """
+    Get a response through the cache, loading it with `loader` on a miss
+
+    If Service A fails while an expired response for the key is still
+    cached, that response is served again instead of failing.
+
+    Returns:
+        The decoded response body
+    """
+    async def load(previous: Optional[Validated]) -> Tuple[Validated, int]:
+        try:
+            return await loader(previous)
+        except Exception as e:
+            if previous is None or not SERVICE_B_SERVE_STALE_ON_ERROR or not _is_upstream_failure(e):
+                raise
+            STALE_SERVED_TOTAL.inc()
+            return previous, previous.size
+
+    result = await cache.get_or_load(key, load)
+    return result.data
+
+def _use_replica() -> bool:
+    """Whether a read can be served from the replica, counting the outcome"""
+    if not SERVICE_B_REPLICA:
+        return False
+    fresh = replica.fresh(SERVICE_B_REPLICA_MAX_LAG)
+    REPLICA_READS_TOTAL.labels("replica" if fresh else "service_a").inc()
+    return fresh
+
 async def get_items() -> Dict[str, List[Dict[str, Any]]]:
     """
-    Get all items from Service A
+    Get all items from the replica, or from Service A
+
+    Service A returns items one page at a time, so this follows
+    `next_cursor` until the last page. The result is cached and must not
+    be modified.
 
     Returns:
         Dict containing a list of items
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{SERVICE_A_BASE_URL}/items")
-        response.raise_for_status()  # Raise exception for 4XX/5XX responses
-        return response.json()
+    if _use_replica():
+        return {"items": replica.all_items()}
+    return await _cached(
+        ("items",), lambda previous: _get_all_pages("get_items", "/items", {}, previous)
+    )
 
 async def get_item(item_id: int) -> Dict[str, Any]:
     """
-    Get a specific item from Service A
+    Get a specific item from the replica, or from Service A
+
+    Items missing from the replica are asked from Service A, since they may
+    have been created after the replica's last poll. The result is cached
+    and must not be modified.
 
     Args:
         item_id: ID of the item to get
@@ -27,14 +654,26 @@ async def get_item(item_id: int) -> Dict[str, Any]:
     Returns:
         Dict containing the item data
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{SERVICE_A_BASE_URL}/items/{item_id}")
-        response.raise_for_status()  # Raise exception for 4XX/5XX responses
-        return response.json()
+    if _use_replica():
+        item = replica.get(item_id)
+        if item is not None:
+            return item
+
+    async def load(previous: Optional[Validated]) -> Tuple[Validated, int]:
+        try:
+            return await _fetch_json("get_item", f"/items/{item_id}", previous=previous)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404 and SERVICE_B_CACHE_NEGATIVE_TTL > 0:
+                raise CachedError(e, SERVICE_B_CACHE_NEGATIVE_TTL)
+            raise
+
+    return await _cached(("item", item_id), load)
 
 async def search_items(query: str) -> Dict[str, List[Dict[str, Any]]]:
     """
-    Search items from Service A
+    Search items in the replica, or in Service A
+
+    The result is cached and must not be modified.
 
     Args:
         query: Search query
@@ -42,22 +681,235 @@ async def search_items(query: str) -> Dict[str, List[Dict[str, Any]]]:
     Returns:
         Dict containing a list of matching items
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{SERVICE_A_BASE_URL}/items/search?q={query}")
-        response.raise_for_status()  # Raise exception for 4XX/5XX responses
-        return response.json()
+    if _use_replica():
+        return {"items": replica.search(query)}
+    return await _cached(
+        ("search", query),
+        lambda previous: _get_all_pages("search_items", "/items/search", {"q": query}, previous),
+    )
 
 async def count_items() -> int:
     """
-    Count items from Service A
+    Count items in the replica, or in Service A
 
     Returns:
         Number of items
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{SERVICE_A_BASE_URL}/items/count")
+    if _use_replica():
+        return len(replica.items)
+    return await _cached(
+        ("count",), lambda previous: _fetch_json("count_items", "/items/count", previous=previous)
+    )
+
+async def get_items_by_ids(item_ids: List[int]) -> Dict[str, Any]:
+    """
+    Get many items from the replica, or from Service A by ID
+
+    The replica only answers if it has all the items. Otherwise the IDs are
+    split into chunks that are looked up concurrently in Service A. A chunk
+    that fails is reported per ID in `errors` instead of failing the others.
+
+    Args:
+        item_ids: IDs of the items to get
+
+    Returns:
+        Dict with the found `items` in request order, the `missing` IDs and
+        per-ID `errors`
+    """
+    unique_ids = list(dict.fromkeys(item_ids))
+    if _use_replica() and all(item_id in replica.items for item_id in unique_ids):
+        return {"items": [replica.get(item_id) for item_id in unique_ids], "missing": [], "errors": []}
+
+    chunks = [
+        unique_ids[start:start + SERVICE_A_LOOKUP_CHUNK_SIZE]
+        for start in range(0, len(unique_ids), SERVICE_A_LOOKUP_CHUNK_SIZE)
+    ]
+    semaphore = asyncio.Semaphore(SERVICE_A_LOOKUP_CONCURRENCY)
+
+    async def lookup(chunk: List[int]) -> Dict[str, Any]:
+        async with semaphore:
+            response = await _request(
+                "get_items_by_ids", "POST", "/items/lookup", idempotent=True, json={"ids": chunk}
+            )
+            response.raise_for_status()  # Raise exception for 4XX/5XX responses
+            return serialization.decode_response(response)
+
+    results = await asyncio.gather(*(lookup(chunk) for chunk in chunks), return_exceptions=True)
+
+    found: Dict[int, Dict[str, Any]] = {}
+    missing: List[int] = []
+    errors: List[Dict[str, Any]] = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            errors.extend({"id": item_id, "detail": str(result)} for item_id in chunk)
+            continue
+        found.update((item["id"], item) for item in result["items"])
+        missing.extend(result["missing"])
+
+    return {
+        "items": [found[item_id] for item_id in unique_ids if item_id in found],
+        "missing": missing,
+        "errors": errors,
+    }
+
+async def _get_changes(since: Optional[int], wait: float = 0) -> Dict[str, Any]:
+    """
+    Get the changes after `since` from Service A's change feed
+
+    Feed requests are not retried or hedged here, since long polls are
+    expected to be slow; run_replication polls again after a failure.
+
+    Raises:
+        httpx.HTTPStatusError: For error responses, including 410 when the
+            changes after `since` are no longer available
+    """
+    params: Dict[str, Any] = {"limit": SERVICE_B_REPLICA_BATCH_SIZE, "wait": wait}
+    if since is not None:
+        params["since"] = since
+    response = await _request("get_changes", "GET", "/items/changes", idempotent=False, params=params)
+    response.raise_for_status()  # Raise exception for 4XX/5XX responses
+    return serialization.decode_response(response)
+
+async def load_replica() -> None:
+    """Load the replica with every item, positioned where the change feed was just before"""
+    head = await _get_changes(None)
+    snapshot, _ = await _get_all_pages("load_replica", "/items", {})
+    replica.load(_page_items(snapshot.data), head["last_seq"])
+    REPLICA_RELOADS_TOTAL.inc()
+
+async def poll_replica(wait: float = 0) -> None:
+    """
+    Apply the next changes from the feed to the replica, loading it first if needed
+
+    The replica is marked as synced as of when the poll was sent once a poll
+    returns less than a full batch. If the feed no longer has the changes
+    the replica needs, it is loaded again.
+    """
+    if replica.seq is None:
+        await load_replica()
+    sent = time.monotonic()
+    try:
+        feed = await _get_changes(replica.seq, wait)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 410:
+            raise
+        replica.clear()
+        return
+    replica.apply(feed["changes"], feed["last_seq"])
+    if len(feed["changes"]) < SERVICE_B_REPLICA_BATCH_SIZE:
+        replica.mark_synced(sent)
+
+async def run_replication() -> None:
+    """Keep the replica up to date until cancelled, backing off while Service A fails"""
+    failures = 0
+    while True:
+        try:
+            await poll_replica(SERVICE_B_REPLICA_POLL_WAIT)
+            failures = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Reads fall back to Service A once the replica is too far behind
+            failures += 1
+            await asyncio.sleep(backoff_delay(failures, SERVICE_A_RETRY_BACKOFF, SERVICE_B_REPLICA_POLL_WAIT))
+
+async def open_export() -> httpx.Response:
+    """
+    Start streaming all items from Service A as newline-delimited JSON
+
+    The status is checked before returning, so errors can still be turned
+    into an error response. The caller must consume or close the response,
+    e.g. with transform_export.
+
+    Returns:
+        The streaming response from Service A's /items/export
+    """
+    response = await _request(
+        "open_export", "GET", "/items/export", stream=True,
+        headers=_accept(serialization.COLUMNS_NDJSON_MEDIA_TYPE),
+    )
+    try:
         response.raise_for_status()  # Raise exception for 4XX/5XX responses
-        return response.json()
+    except httpx.HTTPStatusError:
+        await response.aclose()
+        raise
+    return response
+
+async def iter_export_lines(response: httpx.Response) -> AsyncIterator[str]:
+    """
+    Yield the non-empty lines of a response opened by open_export
+
+    The response is closed when the iteration ends or is abandoned.
+    """
+    try:
+        async for line in response.aiter_lines():
+            if line:
+                yield line
+    finally:
+        await response.aclose()
+
+def transform_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Transform a single item from Service A by adding a "source" field
+
+    Args:
+        item: Item data from Service A
+
+    Returns:
+        Transformed item
+    """
+    return {
+        **item,
+        "source": "service_a"
+    }
+
+async def transform_item_lines(lines: AsyncIterator[str]) -> AsyncIterator[Union[str, bytes]]:
+    """
+    Transform a stream of NDJSON items one line at a time
+
+    Args:
+        lines: NDJSON lines from Service A, one item per line
+
+    Yields:
+        Transformed items as NDJSON lines
+    """
+    if serialization.enabled():
+        async for line in lines:
+            yield serialization.dumps(transform_item(serialization.loads(line))) + b"\n"
+        return
+    async for line in lines:
+        yield json.dumps(transform_item(json.loads(line))) + "\n"
+
+async def transform_export(response: httpx.Response) -> AsyncIterator[Union[str, bytes]]:
+    """
+    Transform an export opened by open_export into NDJSON of transformed items
+
+    Exports in the columns format hold one batch of items per line, which is
+    transformed and yielded as one chunk.
+
+    Args:
+        response: Streaming response from open_export
+
+    Yields:
+        Transformed items as NDJSON lines
+    """
+    lines = iter_export_lines(response)
+    if not serialization.is_media_type(response, serialization.COLUMNS_NDJSON_MEDIA_TYPE):
+        async for chunk in transform_item_lines(lines):
+            yield chunk
+        return
+
+    async for line in lines:
+        batch = serialization.loads(line)
+        # Build the transformed items straight from the columns
+        items = [
+            {"id": item_id, "value": value, "source": "service_a"}
+            for item_id, value in zip(batch["ids"], batch["values"])
+        ]
+        if serialization.enabled():
+            yield b"".join(serialization.dumps(item) + b"\n" for item in items)
+        else:
+            yield "".join(json.dumps(item) + "\n" for item in items)
 
 def transform_items(items_data: Dict[str, List[Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
     """
@@ -72,14 +924,6 @@ def transform_items(items_data: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Li
     Returns:
         Transformed data
     """
-    transformed_items = []
-
-    for item in items_data.get("items", []):
-        # Add a source field to each item
-        transformed_item = {
-            **item,
-            "source": "service_a"
-        }
-        transformed_items.append(transformed_item)
-
-    return {"items": transformed_items}
+    # Add a source field to each item
+    with tracing.span("transform"):
+        return {"items": [transform_item(item) for item in items_data.get("items", [])]}
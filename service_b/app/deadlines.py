@@ -0,0 +1,126 @@
+import asyncio
+import contextvars
+import time
+from typing import Any, Optional
+
+from fastapi.responses import JSONResponse
+
+# Remaining time budget of a request in milliseconds, taken from Service B's
+# callers and sent on to Service A with what is left of it
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+# Set on responses to requests whose deadline passed, so callers can tell
+# them from other 504s and do not retry them
+DEADLINE_EXCEEDED_HEADER = "X-Deadline-Exceeded"
+
+# Status recorded for requests abandoned by their client (nginx's convention)
+CLIENT_CLOSED_REQUEST = 499
+
+# Deadline of the request being served, as a time.monotonic() value
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+def current() -> Optional[float]:
+    """Deadline of the request being served, or None if its caller sent no budget"""
+    return _deadline.get()
+
+def upstream_deadline(limit: float) -> float:
+    """Deadline of a call to Service A: `limit` seconds from now, or the request's deadline if it is sooner"""
+    deadline = time.monotonic() + limit
+    request_deadline = _deadline.get()
+    if request_deadline is not None:
+        deadline = min(deadline, request_deadline)
+    return deadline
+
+def parse(value: Optional[str]) -> Optional[float]:
+    """Deadline of a request from its header, ignoring missing and malformed values"""
+    if value is None:
+        return None
+    try:
+        return time.monotonic() + max(float(value), 0.0) / 1000
+    except ValueError:
+        return None
+
+def exceeded_response() -> JSONResponse:
+    """504 with DEADLINE_EXCEEDED_HEADER"""
+    return JSONResponse(
+        {"detail": "Deadline exceeded"}, status_code=504, headers={DEADLINE_EXCEEDED_HEADER: "true"}
+    )
+
+class DeadlineMiddleware:
+    """
+    Pure ASGI middleware applying the budget of a request to its calls to Service A
+
+    The budget comes from DEADLINE_HEADER. Requests arriving with their
+    budget already spent are answered with a 504 straight away, and errors
+    answered after it ran out become a 504 with DEADLINE_EXCEEDED_HEADER.
+    The request's messages are read by a background task so a client
+    disconnect is noticed while the endpoint runs, and cancels it along with
+    its calls to Service A.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        header = DEADLINE_HEADER.lower().encode()
+        deadline = parse(next((v.decode("latin-1") for k, v in scope["headers"] if k == header), None))
+        if deadline is not None and time.monotonic() >= deadline:
+            await exceeded_response()(scope, receive, send)
+            return
+
+        started = completed = disconnected = False
+        messages: asyncio.Queue = asyncio.Queue()
+
+        async def pump() -> None:
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    if not completed:
+                        disconnected = True
+                        handler.cancel()
+                    return
+
+        async def receive_message() -> Any:
+            message = await messages.get()
+            if message["type"] == "http.disconnect":
+                # Every later call gets the disconnect too
+                messages.put_nowait(message)
+            return message
+
+        async def send_message(message: Any) -> None:
+            nonlocal started, completed
+            if message["type"] == "http.response.start":
+                started = True
+                if message["status"] >= 500 and deadline is not None and time.monotonic() >= deadline:
+                    headers = [*message.get("headers", []), (DEADLINE_EXCEEDED_HEADER.lower().encode(), b"true")]
+                    message = {**message, "status": 504, "headers": headers}
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                completed = True
+            await send(message)
+
+        token = _deadline.set(deadline)
+        try:
+            handler = asyncio.ensure_future(self.app(scope, receive_message, send_message))
+        finally:
+            _deadline.reset(token)
+        reader = asyncio.ensure_future(pump())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+            if not started:
+                # Nobody reads it, but the status is recorded by the outer middleware
+                await JSONResponse({"detail": "Client disconnected"}, status_code=CLIENT_CLOSED_REQUEST)(
+                    scope, receive_message, send
+                )
+        finally:
+            reader.cancel()
+            if not handler.done():
+                handler.cancel()
@@ -1,11 +1,28 @@
-from fastapi import FastAPI, HTTPException
-from typing import Dict, Any, List
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import Dict, Any, List, Optional
 import httpx
 
-from . import client
+from service_common import metrics, tracing
+
+from . import client, deadlines, serialization
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the shared Service A client and start warming it up on startup, close it on shutdown"""
+    await client.start_client()
+    try:
+        yield
+    finally:
+        await client.close_client()
 
 # Create FastAPI app
-app = FastAPI(title="Service B - Proxy API")
+app = FastAPI(title="Service B - Proxy API", lifespan=lifespan)
+app.add_middleware(deadlines.DeadlineMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(tracing.TracingMiddleware, service="service_b")
 
 @app.get("/proxy-items")
 async def proxy_items():
@@ -22,7 +39,7 @@ async def proxy_items():
         # Transform the items
         transformed_data = client.transform_items(items_data)
 
-        return transformed_data
+        return serialization.render(transformed_data)
     except Exception as e:
         # Handle errors (e.g., Service A is down)
         raise HTTPException(
@@ -48,7 +65,7 @@ async def proxy_search_items(q: str):
         # Transform the items
         transformed_data = client.transform_items(items_data)
 
-        return transformed_data
+        return serialization.render(transformed_data)
     except Exception as e:
         raise HTTPException(
             status_code=503,
@@ -73,6 +90,67 @@ async def proxy_count_items():
             detail=f"Error communicating with Service A: {str(e)}"
         )
 
+@app.get("/proxy-items/export")
+async def proxy_export_items():
+    """
+    Proxy endpoint that streams all items from Service A and transforms them
+
+    Items are transformed line by line as they arrive, so the full table is
+    never held in memory.
+
+    Returns:
+        Newline-delimited JSON stream of transformed items
+    """
+    try:
+        # Start the export from Service A
+        response = await client.open_export()
+    except Exception as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Error communicating with Service A: {str(e)}"
+        )
+
+    return StreamingResponse(
+        client.transform_export(response),
+        media_type="application/x-ndjson"
+    )
+
+# Maximum number of IDs accepted by /proxy-items/batch
+MAX_BATCH_IDS = int(os.getenv("SERVICE_B_MAX_BATCH_IDS", "5000"))
+
+@app.get("/proxy-items/batch")
+async def proxy_items_batch(ids: str = Query(..., description="Comma-separated item IDs")):
+    """
+    Proxy endpoint that gets many items from Service A and transforms them
+
+    Args:
+        ids: Comma-separated IDs of the items to get
+
+    Returns:
+        Dict with the transformed items, the IDs that do not exist and the
+        IDs that could not be fetched
+    """
+    try:
+        item_ids = [int(item_id) for item_id in ids.split(",") if item_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="ids must be comma-separated integers")
+    if len(item_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_BATCH_IDS} ids are allowed")
+
+    result = await client.get_items_by_ids(item_ids)
+    if result["errors"] and not result["items"] and not result["missing"]:
+        # Every lookup failed
+        raise HTTPException(
+            status_code=503,
+            detail=f"Error communicating with Service A: {result['errors'][0]['detail']}"
+        )
+
+    return serialization.render({
+        "items": [client.transform_item(item) for item in result["items"]],
+        "missing": result["missing"],
+        "errors": result["errors"],
+    })
+
 @app.get("/proxy-items/{item_id}")
 async def proxy_item(item_id: int):
     """
@@ -89,10 +167,7 @@ async def proxy_item(item_id: int):
         item_data = await client.get_item(item_id)
 
         # Add the source field
-        transformed_item = {
-            **item_data,
-            "source": "service_a"
-        }
+        transformed_item = client.transform_item(item_data)
 
         return transformed_item
     except httpx.HTTPStatusError as e:
@@ -108,6 +183,48 @@ async def proxy_item(item_id: int):
             detail=f"Error communicating with Service A: {str(e)}"
         )
 
+@app.get("/traces")
+def read_traces(
+    limit: int = Query(50, ge=1, le=1000),
+    slow: bool = False,
+    trace_id: Optional[str] = None,
+):
+    """
+    Recent traces of the worker answering, newest first
+
+    Only recorded when TRACING is enabled. Each trace includes the spans
+    Service A reported for its calls; `slow=true` keeps the traces over
+    TRACE_SLOW_MS, which include a stack profile.
+    """
+    return {"enabled": tracing.TRACING, "traces": tracing.recent(limit, slow, trace_id)}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Hit, miss and coalescing counters of the Service A response cache"""
+    return client.cache.stats()
+
+@app.get("/upstream/stats")
+def upstream_stats():
+    """Load and health of every Service A instance as seen by the balancer"""
+    return client.balancer.stats()
+
+@app.get("/replica/stats")
+def replica_stats():
+    """Position in Service A's change feed, size and lag of the replica, when it is enabled"""
+    return {"enabled": client.SERVICE_B_REPLICA, **client.replica.stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Request, Service A call and cache metrics of all workers in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/ready")
+def readiness_check():
+    """Readiness endpoint: 503 until the connections to Service A are warmed up"""
+    if not client.is_ready():
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    return {"status": "ready"}
+
 @app.get("/health")
 def health_check():
     """Health check endpoint"""
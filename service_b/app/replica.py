@@ -0,0 +1,120 @@
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+# Length of the substrings indexed for search, as in Service A's trigram index
+TOKEN_LENGTH = 3
+
+def _tokens(value: str) -> Set[str]:
+    """Case-insensitive trigrams of a value"""
+    value = value.lower()
+    return {value[i:i + TOKEN_LENGTH] for i in range(len(value) - TOKEN_LENGTH + 1)}
+
+class Replica:
+    """
+    In-memory copy of Service A's items, kept up to date from its change feed
+
+    Items are indexed by ID and by the trigrams of their values, so lists,
+    lookups and substring searches are answered without Service A. The
+    replica is loaded from a full read of the items and the feed position
+    (`seq`) taken just before it; replaying changes already included in that
+    read is harmless since every change carries the item's whole value.
+    `synced_at` is when the last poll that found the replica caught up was
+    sent, so the replica was at most `lag()` seconds behind Service A.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.clear()
+
+    def clear(self) -> None:
+        """Forget every item, e.g. before loading the replica again"""
+        self.items: Dict[int, str] = {}
+        self._index: Dict[str, Set[int]] = {}
+        self._sorted: Optional[List[Dict[str, Any]]] = None
+        self.seq: Optional[int] = None  # None until loaded
+        self.synced_at: Optional[float] = None
+
+    def _put(self, item_id: int, value: str) -> None:
+        previous = self.items.get(item_id)
+        if previous == value:
+            return
+        if previous is not None:
+            self._remove(item_id)
+        self.items[item_id] = value
+        for token in _tokens(value):
+            self._index.setdefault(token, set()).add(item_id)
+        self._sorted = None
+
+    def _remove(self, item_id: int) -> None:
+        value = self.items.pop(item_id, None)
+        if value is None:
+            return
+        for token in _tokens(value):
+            ids = self._index[token]
+            ids.discard(item_id)
+            if not ids:
+                del self._index[token]
+        self._sorted = None
+
+    def load(self, items: Iterable[Dict[str, Any]], seq: int) -> None:
+        """Replace the contents with a full read of the items, taken after feed position `seq`"""
+        self.clear()
+        for item in items:
+            self._put(item["id"], item["value"])
+        self.seq = seq
+
+    def apply(self, changes: Iterable[Dict[str, Any]], last_seq: int) -> None:
+        """Apply changes from the feed in order; a null value deletes the item"""
+        for change in changes:
+            if change["value"] is None:
+                self._remove(change["id"])
+            else:
+                self._put(change["id"], change["value"])
+        self.seq = last_seq
+
+    def mark_synced(self, at: float) -> None:
+        """Record that the replica held every change made before `at`"""
+        self.synced_at = at
+
+    def lag(self) -> Optional[float]:
+        """Seconds the replica may be behind Service A, or None if it never caught up"""
+        if self.synced_at is None:
+            return None
+        return max(self._clock() - self.synced_at, 0.0)
+
+    def fresh(self, max_lag: float) -> bool:
+        """Whether the replica is at most `max_lag` seconds behind"""
+        lag = self.lag()
+        return lag is not None and lag <= max_lag
+
+    def all_items(self) -> List[Dict[str, Any]]:
+        """Every item ordered by ID, as Service A lists them; must not be modified"""
+        if self._sorted is None:
+            self._sorted = [{"id": item_id, "value": self.items[item_id]} for item_id in sorted(self.items)]
+        return self._sorted
+
+    def get(self, item_id: int) -> Optional[Dict[str, Any]]:
+        value = self.items.get(item_id)
+        if value is None:
+            return None
+        return {"id": item_id, "value": value}
+
+    def search(self, query: str) -> List[Dict[str, Any]]:
+        """Items whose value contains the query (case-insensitive), ordered by ID"""
+        query = query.lower()
+        tokens = _tokens(query)
+        if tokens:
+            postings = sorted((self._index.get(token, set()) for token in tokens), key=len)
+            candidates: Iterable[int] = set.intersection(*postings)
+        else:
+            # Too short to be indexed: check every item
+            candidates = self.items
+        return [
+            {"id": item_id, "value": self.items[item_id]}
+            for item_id in sorted(candidates)
+            if query in self.items[item_id].lower()
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """Position in the change feed, size and lag of the replica"""
+        return {"seq": self.seq, "items": len(self.items), "lag": self.lag()}
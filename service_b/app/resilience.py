@@ -0,0 +1,119 @@
+import random
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Service A while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """
+    Circuit breaker for calls to Service A
+
+    After `failure_threshold` failed calls in a row the circuit opens and
+    calls fail fast for `reset_timeout` seconds. Then one trial call is let
+    through: if it succeeds the circuit closes, otherwise it opens again.
+    A threshold of 0 disables the breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int,
+        reset_timeout: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.reset()
+
+    def reset(self) -> None:
+        """Close the circuit and forget past failures"""
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        """Whether a call may be made now; a True in half-open state reserves the trial call"""
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if self._clock() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record(self, succeeded: Optional[bool]) -> None:
+        """
+        Record the outcome of an allowed call
+
+        Args:
+            succeeded: Whether Service A answered without a server error, or
+                None if the call was abandoned before that was known
+        """
+        if self.failure_threshold <= 0:
+            return
+        if self.state == self.HALF_OPEN:
+            self._trial_in_flight = False
+        if succeeded is None:
+            return
+        if succeeded:
+            self.failures = 0
+            self.state = self.CLOSED
+            return
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = self._clock()
+
+class LatencyTracker:
+    """
+    Recent latencies per client function, to decide when to hedge a request
+
+    The percentile is recomputed every `refresh_every` observations rather
+    than on every request.
+    """
+
+    def __init__(self, percentile: float, min_samples: int = 20, window: int = 500, refresh_every: int = 50):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.refresh_every = refresh_every
+        self.clear()
+
+    def clear(self) -> None:
+        self._samples: Dict[str, Deque[float]] = {}
+        self._thresholds: Dict[str, float] = {}
+        self._pending: Dict[str, int] = {}
+
+    def observe(self, key: str, latency: float) -> None:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(latency)
+        pending = self._pending.get(key, 0) + 1
+        if pending >= self.refresh_every or key not in self._thresholds:
+            if len(samples) >= self.min_samples:
+                ordered = sorted(samples)
+                index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+                self._thresholds[key] = ordered[index]
+            pending = 0
+        self._pending[key] = pending
+
+    def threshold(self, key: str) -> Optional[float]:
+        """The latency percentile for a key, or None until there are enough samples"""
+        if self.percentile <= 0:
+            return None
+        return self._thresholds.get(key)
+
+def backoff_delay(attempt: int, base: float, cap: float, rng: random.Random = random) -> float:
+    """Full-jitter exponential backoff: a random delay up to base * 2^(attempt - 1), at most cap"""
+    return rng.uniform(0, min(cap, base * 2 ** (attempt - 1)))
@@ -0,0 +1,58 @@
+import json
+import os
+from typing import Any, Union
+
+import httpx
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Optional, the stdlib decoder and encoder are used without it
+    orjson = None
+
+# Decode Service A responses and encode our own with orjson (when installed),
+# and return list responses without FastAPI's jsonable_encoder pass
+SERVICE_B_FAST_SERIALIZATION = os.getenv("SERVICE_B_FAST_SERIALIZATION", "false").lower() in ("1", "true", "yes")
+
+# Service A's compact list formats: parallel `ids` and `values` arrays instead
+# of one object per item, and NDJSON of such objects for exports
+COLUMNS_MEDIA_TYPE = "application/vnd.items.columns+json"
+COLUMNS_NDJSON_MEDIA_TYPE = "application/vnd.items.columns+x-ndjson"
+
+def enabled() -> bool:
+    """Whether the fast serialization path is used"""
+    return SERVICE_B_FAST_SERIALIZATION
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Decode JSON, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(content: Any) -> bytes:
+    """Encode a value as compact JSON, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def is_media_type(response: httpx.Response, media_type: str) -> bool:
+    """Check the media type of a response, ignoring its parameters"""
+    return response.headers.get("content-type", "").split(";")[0].strip().lower() == media_type
+
+def decode_response(response: httpx.Response) -> Any:
+    """Decode a JSON response from Service A"""
+    if enabled():
+        return loads(response.content)
+    return response.json()
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with `dumps`"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def render(content: Any) -> Any:
+    """Return content as is, or as a FastJSONResponse when the fast path is enabled"""
+    if not enabled():
+        return content
+    return FastJSONResponse(content)
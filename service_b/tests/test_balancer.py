@@ -0,0 +1,102 @@
+import asyncio
+import random
+import sys
+import os
+import httpx
+import pytest
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.balancer import Balancer
+
+URLS = ["http://a1:8000", "http://a2:8000"]
+
+def test_p2c_prefers_the_faster_backend():
+    """Test that power of two choices sends requests to the backend with the lower latency"""
+    balancer = Balancer(URLS, rng=random.Random(0))
+    fast, slow = balancer.backends
+    fast.latency, slow.latency = 0.01, 0.2
+
+    picks = []
+    for _ in range(10):
+        backend = balancer.acquire()
+        picks.append(backend.url)
+        balancer.release(backend, backend.latency, True)
+
+    assert picks == [fast.url] * 10
+
+def test_p2c_weighs_latency_by_outstanding_requests():
+    """Test that a fast but busy backend loses to a slower idle one"""
+    balancer = Balancer(URLS, rng=random.Random(0))
+    fast, slow = balancer.backends
+    fast.latency, slow.latency = 0.01, 0.02
+    fast.outstanding = 5
+
+    assert balancer.acquire() is slow
+
+def test_least_outstanding_policy():
+    """Test that the least policy picks the backend with the fewest requests in flight"""
+    balancer = Balancer(URLS, policy="least")
+    first = balancer.acquire()
+    second = balancer.acquire()
+    assert first is not second
+    balancer.release(first, 0.01, True)
+    assert balancer.acquire() is first
+
+def test_failing_backend_is_ejected():
+    """Test that consecutive failures eject a backend and successes reset the count"""
+    balancer = Balancer(URLS, policy="least", eject_after=2)
+    bad, good = balancer.backends
+
+    balancer.release(balancer.acquire(), 0.01, False)
+    bad.outstanding += 1
+    balancer.release(bad, 0.01, True)  # A success resets the count
+    assert bad.failures == 0
+
+    for _ in range(2):
+        bad.outstanding += 1
+        balancer.release(bad, 0.01, False)
+    assert bad.ejected
+    assert balancer.ejections == 1
+    assert all(balancer.acquire() is good for _ in range(5))
+
+def test_cancelled_requests_are_not_failures():
+    """Test that an abandoned request only frees its slot"""
+    balancer = Balancer(URLS, eject_after=1)
+    backend = balancer.acquire()
+    balancer.release(backend, 5.0, None)
+    assert backend.outstanding == 0
+    assert backend.latency == 0.0
+    assert not backend.ejected
+
+def test_all_backends_ejected_falls_back_to_all():
+    """Test that requests are still sent when every backend is ejected"""
+    balancer = Balancer(URLS, eject_after=1)
+    for backend in balancer.backends:
+        backend.ejected = True
+    assert balancer.acquire() in balancer.backends
+
+def test_health_check_readmits_backends():
+    """Test that ejected backends come back once /health answers 200"""
+    balancer = Balancer(URLS)
+    for backend in balancer.backends:
+        backend.ejected = True
+    checked = []
+
+    def handler(request):
+        checked.append(request.url.host)
+        return httpx.Response(200 if request.url.host == "a1" else 503)
+
+    async def check():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await balancer.check_ejected(client, timeout=1)
+
+    asyncio.run(check())
+    assert sorted(checked) == ["a1", "a2"]
+    assert [backend.ejected for backend in balancer.backends] == [False, True]
+
+def test_unknown_policy():
+    """Test that an unknown policy is rejected"""
+    with pytest.raises(ValueError):
+        Balancer(URLS, policy="random")
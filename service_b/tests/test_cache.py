@@ -0,0 +1,138 @@
+import asyncio
+import sys
+import os
+import pytest
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.cache import ResponseCache, CachedError
+
+class FakeClock:
+    """Clock that only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def make_loader(values, calls, size=10):
+    """Loader returning the next value of `values` and recording each call"""
+    async def loader(previous):
+        calls.append(previous)
+        return values[len(calls) - 1], size
+    return loader
+
+def test_fresh_entries_are_hits():
+    """Test that a fresh entry is served without loading"""
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, clock=clock)
+    calls = []
+    loader = make_loader(["a", "b"], calls)
+
+    assert asyncio.run(cache.get_or_load("key", loader)) == "a"
+    clock.now = 5
+    assert asyncio.run(cache.get_or_load("key", loader)) == "a"
+    clock.now = 11
+    assert asyncio.run(cache.get_or_load("key", loader)) == "b"
+
+    assert len(calls) == 2
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+def test_stale_while_revalidate():
+    """Test that a stale entry is served while it is refreshed in the background"""
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, stale_ttl=10, clock=clock)
+    calls = []
+    loader = make_loader(["a", "b"], calls)
+
+    async def scenario():
+        await cache.get_or_load("key", loader)
+        clock.now = 15
+        stale = await cache.get_or_load("key", loader)
+        await asyncio.sleep(0)  # Let the refresh run
+        await asyncio.sleep(0)
+        fresh = await cache.get_or_load("key", loader)
+        return stale, fresh
+
+    assert asyncio.run(scenario()) == ("a", "b")
+    assert cache.stats()["stale_hits"] == 1
+
+def test_lru_eviction_by_bytes():
+    """Test that the least recently used entries are evicted over the byte budget"""
+    cache = ResponseCache(ttl=10, max_bytes=25)
+
+    async def scenario():
+        for key in ("a", "b"):
+            await cache.get_or_load(key, make_loader([key], [], size=10))
+        await cache.get_or_load("a", make_loader(["a"], []))  # "a" is now most recent
+        await cache.get_or_load("c", make_loader(["c"], [], size=10))
+
+    asyncio.run(scenario())
+    assert list(cache._entries) == ["a", "c"]
+    assert cache.stats()["bytes"] == 20
+    assert cache.stats()["evictions"] == 1
+
+def test_errors_are_not_cached_unless_wrapped():
+    """Test that loader errors are only cached when raised as CachedError"""
+    cache = ResponseCache(ttl=10)
+    calls = []
+
+    async def failing(previous):
+        calls.append(1)
+        raise ValueError("boom")
+
+    async def cached_failure(previous):
+        calls.append(1)
+        raise CachedError(KeyError("gone"), ttl=10)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                await cache.get_or_load("plain", failing)
+        for _ in range(2):
+            with pytest.raises(KeyError):
+                await cache.get_or_load("negative", cached_failure)
+
+    asyncio.run(scenario())
+    assert len(calls) == 3
+
+def test_expired_entries_are_passed_to_the_loader():
+    """Test that an expired value is handed to the loader for revalidation"""
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, clock=clock)
+    calls = []
+    loader = make_loader(["a", "b"], calls)
+
+    asyncio.run(cache.get_or_load("key", loader))
+    clock.now = 20
+    assert asyncio.run(cache.get_or_load("key", loader)) == "b"
+    assert calls == [None, "a"]
+
+def test_load_is_cancelled_with_its_last_caller():
+    """Test that a shared load outlives one cancelled caller but not all of them"""
+    cache = ResponseCache(ttl=10, clock=FakeClock())
+    events = []
+
+    async def loader(previous):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+        return "a", 10
+
+    async def scenario():
+        first = asyncio.ensure_future(cache.get_or_load("key", loader))
+        second = asyncio.ensure_future(cache.get_or_load("key", loader))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        assert events == []
+        second.cancel()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert events == ["cancelled"]
@@ -1,18 +1,36 @@
 import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import patch, AsyncMock
+import json
 import sys
 import os
+import asyncio
 import httpx
 
 # Add the parent directory to sys.path to allow imports from the app package
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app.main import app
+from app import client as service_a_client
+from service_common import tracing
+from app.balancer import Balancer
 
 # Create a test client
 client = TestClient(app)
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Start every test with an empty response cache and replica, a closed circuit and no latency history"""
+    service_a_client.cache.clear()
+    service_a_client.breaker.reset()
+    service_a_client.latencies.clear()
+    service_a_client.replica.clear()
+    yield
+    service_a_client.cache.clear()
+    service_a_client.breaker.reset()
+    service_a_client.latencies.clear()
+    service_a_client.replica.clear()
+
 @pytest.fixture
 def mock_get_items():
     """Fixture to mock the get_items function"""
@@ -157,3 +175,613 @@ def test_health_check():
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "healthy"}
+
+def test_client_reuses_shared_pool():
+    """Test that all client functions share one pooled client"""
+    seen_clients = set()
+
+    def handler(request):
+        if request.url.path == "/items/count":
+            return httpx.Response(200, json=2)
+        return httpx.Response(200, json={"id": 1, "value": "test item 1"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+
+    async def call_service_a():
+        seen_clients.add(id(service_a_client.get_client()))
+        count = await service_a_client.count_items()
+        item = await service_a_client.get_item(1)
+        seen_clients.add(id(service_a_client.get_client()))
+        return count, item
+
+    with patch("app.client._client", shared):
+        count, item = asyncio.run(call_service_a())
+
+    assert count == 2
+    assert item["value"] == "test item 1"
+    assert seen_clients == {id(shared)}
+
+def test_client_lifespan():
+    """Test that the lifespan opens and closes the shared client"""
+    with TestClient(app):
+        shared = service_a_client._client
+        assert shared is not None
+        assert not shared.is_closed
+
+    assert shared.is_closed
+    assert service_a_client._client is None
+
+def test_trace_is_propagated_to_service_a():
+    """Test that a traced request sends its trace ID to Service A and records Service A's spans"""
+    seen = []
+
+    timing = 'parse;desc="estimated";dur=0.5, query;dur=2.5, serialize;desc="estimated";dur=0.25, total;dur=3.5'
+
+    def handler(request):
+        seen.append(request.headers.get("X-Trace-Id"))
+        return httpx.Response(200, json=3, headers={"Server-Timing": timing})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    tracing.clear()
+    with patch("app.client._client", shared), patch("service_common.tracing.TRACING", True):
+        response = client.get("/proxy-items/count")
+        traces = client.get("/traces", params={"trace_id": response.headers["X-Trace-Id"]}).json()["traces"]
+
+    assert response.json() == 3
+    assert seen == [response.headers["X-Trace-Id"]]
+    spans = {span["name"]: span["duration_ms"] for span in traces[0]["spans"]}
+    assert list(spans) == ["parse", "upstream", "service_a.parse", "service_a.query", "service_a.serialize", "decode", "serialize"]
+    assert spans["service_a.query"] == pytest.approx(2.5)
+    estimated = [span["name"] for span in traces[0]["spans"] if span.get("estimated")]
+    assert estimated == ["parse", "service_a.parse", "service_a.serialize", "serialize"]
+
+def test_ready_after_warm_up():
+    """Test that /ready answers 503 until the client opened its connections to Service A"""
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        return httpx.Response(200, json={"status": "healthy"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.client._ready", False):
+        assert client.get("/ready").status_code == 503
+        assert client.get("/health").status_code == 200
+
+        asyncio.run(service_a_client.warm_up())
+        response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready"}
+    assert paths == ["/health"] * service_a_client.SERVICE_B_WARMUP_CONNECTIONS
+
+def test_get_items_follows_cursors():
+    """Test that get_items pages through the whole table"""
+    pages = {
+        None: {"items": [{"id": 1, "value": "a"}, {"id": 2, "value": "b"}], "next_cursor": "c1"},
+        "c1": {"items": [{"id": 3, "value": "c"}], "next_cursor": None},
+    }
+    cursors_seen = []
+
+    def handler(request):
+        cursor = request.url.params.get("cursor")
+        cursors_seen.append(cursor)
+        return httpx.Response(200, json=pages[cursor])
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        data = asyncio.run(service_a_client.get_items())
+
+    assert cursors_seen == [None, "c1"]
+    assert [item["id"] for item in data["items"]] == [1, 2, 3]
+
+def test_proxy_export_items():
+    """Test that the export stream is transformed line by line"""
+    def handler(request):
+        assert request.url.path == "/items/export"
+        body = b'{"id": 1, "value": "a"}\n{"id": 2, "value": "b"}\n'
+        return httpx.Response(200, content=body, headers={"content-type": "application/x-ndjson"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        response = client.get("/proxy-items/export")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {"id": 1, "value": "a", "source": "service_a"},
+        {"id": 2, "value": "b", "source": "service_a"},
+    ]
+
+def test_proxy_export_items_error():
+    """Test that an upstream error before streaming becomes a 503"""
+    shared = service_a_client.create_client(
+        transport=httpx.MockTransport(lambda request: httpx.Response(500))
+    )
+    with patch("app.client._client", shared):
+        response = client.get("/proxy-items/export")
+
+    assert response.status_code == 503
+
+def test_get_item_coalesces_concurrent_misses():
+    """Test that concurrent requests for the same item share one upstream call"""
+    upstream_calls = []
+
+    async def handler(request):
+        upstream_calls.append(request.url.path)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"id": 1, "value": "test item 1"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+
+    async def fetch_concurrently():
+        return await asyncio.gather(*(service_a_client.get_item(1) for _ in range(5)))
+
+    with patch("app.client._client", shared), patch.object(service_a_client.cache, "ttl", 30):
+        results = asyncio.run(fetch_concurrently())
+        stats = service_a_client.cache.stats()
+        # A second call is served from the cache
+        asyncio.run(service_a_client.get_item(1))
+
+    assert upstream_calls == ["/items/1"]
+    assert all(result["value"] == "test item 1" for result in results)
+    assert stats["coalesced"] == 4
+    assert service_a_client.cache.stats()["hits"] == 1
+
+def test_get_item_negative_caching():
+    """Test that 404s are only cached when negative caching is enabled"""
+    upstream_calls = []
+
+    def handler(request):
+        upstream_calls.append(request.url.path)
+        return httpx.Response(404, json={"detail": "Item not found"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+
+    async def fetch_twice():
+        for _ in range(2):
+            with pytest.raises(httpx.HTTPStatusError):
+                await service_a_client.get_item(999)
+
+    with patch("app.client._client", shared):
+        asyncio.run(fetch_twice())
+        assert len(upstream_calls) == 2
+
+        with patch("app.client.SERVICE_B_CACHE_NEGATIVE_TTL", 30):
+            service_a_client.cache.clear()
+            upstream_calls.clear()
+            asyncio.run(fetch_twice())
+            assert len(upstream_calls) == 1
+
+def test_cache_stats():
+    """Test the cache stats endpoint"""
+    response = client.get("/cache/stats")
+    assert response.status_code == 200
+    assert set(response.json()) >= {"hits", "misses", "coalesced", "entries", "bytes"}
+
+def test_client_revalidates_with_etags():
+    """Test that expired cache entries are revalidated with If-None-Match"""
+    conditional_headers = []
+
+    def handler(request):
+        conditional_headers.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304, headers={"ETag": '"v1"'})
+        return httpx.Response(200, json={"id": 1, "value": "test item 1"}, headers={"ETag": '"v1"'})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch.object(service_a_client.cache, "ttl", 0):
+        first = asyncio.run(service_a_client.get_item(1))
+        second = asyncio.run(service_a_client.get_item(1))
+
+    assert conditional_headers == [None, '"v1"']
+    assert second is first
+
+def test_list_revalidation_reuses_all_pages():
+    """Test that an unchanged first page reuses the whole cached list"""
+    requests_seen = []
+
+    def handler(request):
+        cursor = request.url.params.get("cursor")
+        requests_seen.append((cursor, request.headers.get("If-None-Match")))
+        if request.headers.get("If-None-Match") == '"g7"':
+            return httpx.Response(304, headers={"ETag": '"g7"'})
+        pages = {
+            None: {"items": [{"id": 1, "value": "a"}], "next_cursor": "c1"},
+            "c1": {"items": [{"id": 2, "value": "b"}], "next_cursor": None},
+        }
+        return httpx.Response(200, json=pages[cursor], headers={"ETag": '"g7"'})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch.object(service_a_client.cache, "ttl", 0):
+        first = asyncio.run(service_a_client.get_items())
+        second = asyncio.run(service_a_client.get_items())
+
+    assert requests_seen == [(None, None), ("c1", None), (None, '"g7"')]
+    assert [item["id"] for item in second["items"]] == [1, 2]
+    assert second is first
+
+def test_proxy_items_batch():
+    """Test that batch lookups are chunked and report missing and failed IDs"""
+    chunks_seen = []
+
+    def handler(request):
+        ids = json.loads(request.content)["ids"]
+        chunks_seen.append(ids)
+        if 5 in ids:
+            return httpx.Response(500)
+        return httpx.Response(200, json={
+            "items": [{"id": item_id, "value": f"item {item_id}"} for item_id in ids if item_id != 3],
+            "missing": [item_id for item_id in ids if item_id == 3],
+        })
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.client.SERVICE_A_LOOKUP_CHUNK_SIZE", 2):
+        response = client.get("/proxy-items/batch?ids=1,2,3,4,5,1")
+
+    assert response.status_code == 200
+    assert sorted(chunks_seen) == [[1, 2], [3, 4], [5]]
+    data = response.json()
+    assert [item["id"] for item in data["items"]] == [1, 2, 4]
+    assert all(item["source"] == "service_a" for item in data["items"])
+    assert data["missing"] == [3]
+    assert [error["id"] for error in data["errors"]] == [5]
+
+def test_proxy_items_batch_invalid_ids():
+    """Test that malformed ID lists are rejected"""
+    response = client.get("/proxy-items/batch?ids=1,two")
+    assert response.status_code == 422
+
+def test_fast_serialization():
+    """Test that the fast path decodes and encodes the same data"""
+    def handler(request):
+        if request.url.path == "/items/export":
+            return httpx.Response(200, content=b'{"id": 1, "value": "a"}\n')
+        return httpx.Response(200, json={"items": [{"id": 1, "value": "été"}], "next_cursor": None})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.serialization.SERVICE_B_FAST_SERIALIZATION", True):
+        items = client.get("/proxy-items")
+        export = client.get("/proxy-items/export")
+
+    assert items.status_code == 200
+    assert items.json() == {"items": [{"id": 1, "value": "été", "source": "service_a"}]}
+    assert [json.loads(line) for line in export.text.splitlines()] == [
+        {"id": 1, "value": "a", "source": "service_a"}
+    ]
+
+def test_client_requests_columns_format():
+    """Test that lists and exports are requested and decoded in the columns format"""
+    accepts = []
+
+    def handler(request):
+        accepts.append(request.headers.get("Accept"))
+        if request.url.path == "/items/export":
+            return httpx.Response(
+                200,
+                content=b'{"ids": [1, 2], "values": ["a", "b"]}\n{"ids": [3], "values": ["c"]}\n',
+                headers={"content-type": "application/vnd.items.columns+x-ndjson"},
+            )
+        if "cursor" in request.url.params:
+            body = {"ids": [3], "values": ["c"], "next_cursor": None}
+        else:
+            body = {"ids": [1, 2], "values": ["a", "b"], "next_cursor": "next"}
+        return httpx.Response(
+            200, content=json.dumps(body), headers={"content-type": "application/vnd.items.columns+json"}
+        )
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        items = client.get("/proxy-items")
+        export = client.get("/proxy-items/export")
+
+    assert accepts[0].startswith("application/vnd.items.columns+json")
+    assert accepts[-1].startswith("application/vnd.items.columns+x-ndjson")
+    expected = [
+        {"id": 1, "value": "a", "source": "service_a"},
+        {"id": 2, "value": "b", "source": "service_a"},
+        {"id": 3, "value": "c", "source": "service_a"},
+    ]
+    assert items.json() == {"items": expected}
+    assert [json.loads(line) for line in export.text.splitlines()] == expected
+
+def test_metrics():
+    """Test that requests to Service A are timed per client function"""
+    shared = service_a_client.create_client(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, json=3))
+    )
+    with patch("app.client._client", shared):
+        client.get("/proxy-items/count")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert any(
+        line.startswith('service_a_request_duration_seconds_count{function="count_items",status="200"}')
+        for line in lines
+    )
+    assert any(line.startswith('http_requests_total{method="GET",route="/proxy-items/count",status="200"}') for line in lines)
+    assert any(line.startswith('service_b_cache{stat="misses"}') for line in lines)
+
+def test_requests_are_balanced_across_instances():
+    """Test that requests are spread over instances and a failing one is ejected"""
+    balancer = Balancer(["http://a1:8000", "http://a2:8000"], policy="least", eject_after=1)
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        if request.url.host == "a1":
+            return httpx.Response(500)
+        return httpx.Response(200, json={"id": 1, "value": "test item 1"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.client.balancer", balancer):
+        statuses = [client.get(f"/proxy-items/{item_id}").status_code for item_id in range(1, 5)]
+        stats = client.get("/upstream/stats").json()
+
+    assert hosts == ["a1", "a2", "a2", "a2"]
+    assert statuses == [503, 200, 200, 200]
+    assert [backend["ejected"] for backend in stats] == [True, False]
+
+def test_get_requests_are_retried():
+    """Test that a 503 from Service A is retried"""
+    statuses = [503, 200]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0), json=3)
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.client.SERVICE_A_RETRY_BACKOFF", 0.001):
+        response = client.get("/proxy-items/count")
+
+    assert response.status_code == 200
+    assert response.json() == 3
+    assert statuses == []
+
+def test_retries_stop_at_the_deadline():
+    """Test that no retry is attempted when its backoff would overrun the deadline"""
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return httpx.Response(503)
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.client.SERVICE_A_DEADLINE", 0.05), \
+            patch("app.client.SERVICE_A_RETRY_BACKOFF", 10), patch("app.client.SERVICE_A_RETRY_BACKOFF_MAX", 10), \
+            patch("random.uniform", lambda low, high: high):
+        response = client.get("/proxy-items/count")
+
+    assert response.status_code == 503
+    assert calls == ["/items/count"]
+
+def test_slow_requests_are_hedged():
+    """Test that a request slower than the usual latency is sent again and the first answer wins"""
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+        return httpx.Response(200, json={"id": 1, "value": "test item 1"})
+
+    for _ in range(service_a_client.latencies.min_samples):
+        service_a_client.latencies.observe("get_item", 0.001)
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        started = asyncio.get_event_loop_policy().new_event_loop()
+        try:
+            item = started.run_until_complete(service_a_client.get_item(1))
+        finally:
+            started.close()
+
+    assert item == {"id": 1, "value": "test item 1"}
+    assert len(calls) == 2
+
+def test_circuit_breaker_fails_fast_and_serves_stale_data():
+    """Test that an open circuit skips Service A and cached responses are served meanwhile"""
+    calls = []
+    healthy = [True]
+
+    def handler(request):
+        calls.append(request.url.path)
+        if healthy[0]:
+            return httpx.Response(200, json={"id": 1, "value": "test item 1"})
+        return httpx.Response(500)
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch.object(service_a_client.cache, "ttl", 0), \
+            patch.object(service_a_client.cache, "stale_ttl", 0), \
+            patch.object(service_a_client.breaker, "failure_threshold", 2):
+        assert client.get("/proxy-items/1").status_code == 200
+        healthy[0] = False
+        # Service A fails, but the expired response is served again
+        stale = [client.get("/proxy-items/1") for _ in range(2)]
+        assert service_a_client.breaker.state == "open"
+        calls.clear()
+        uncached = client.get("/proxy-items/2")
+
+    assert [response.json()["value"] for response in stale] == ["test item 1", "test item 1"]
+    assert uncached.status_code == 503
+    assert "Circuit breaker" in uncached.json()["detail"]
+    assert calls == []
+
+def test_half_open_trial_is_released_when_the_request_cannot_be_built():
+    """Test that a request failing before it is sent does not keep the circuit's half-open trial reserved"""
+    breaker = service_a_client.breaker
+    backend = service_a_client.balancer.backends[0]
+    with patch.object(breaker, "failure_threshold", 1), patch.object(backend, "url", "http://service-a:port"):
+        breaker.state = breaker.OPEN
+        breaker.opened_at = -breaker.reset_timeout
+        loop = asyncio.new_event_loop()
+        try:
+            with pytest.raises(httpx.InvalidURL):
+                loop.run_until_complete(service_a_client.get_item(1))
+        finally:
+            loop.close()
+
+        assert breaker.state == breaker.HALF_OPEN
+        assert breaker.allow()
+    assert backend.outstanding == 0
+
+def test_deadline_is_sent_and_not_retried_once_exceeded():
+    """Test that Service A gets the remaining budget, and a deadline 504 from it is not retried"""
+    budgets = []
+
+    def handler(request):
+        budgets.append(int(request.headers[service_a_client.DEADLINE_HEADER]))
+        return httpx.Response(504, headers={service_a_client.DEADLINE_EXCEEDED_HEADER: "true"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.client.SERVICE_A_RETRY_BACKOFF", 0.001):
+        response = client.get("/proxy-items/count")
+
+    assert response.status_code == 503
+    assert len(budgets) == 1
+    assert 0 < budgets[0] <= service_a_client.SERVICE_A_DEADLINE * 1000
+    # Running out of time says nothing about Service A's health
+    assert service_a_client.breaker.failures == 0
+
+def test_incoming_deadline_caps_the_upstream_budget():
+    """Test that Service A gets what is left of the caller's budget when it is less than SERVICE_A_DEADLINE"""
+    budgets = []
+
+    def handler(request):
+        budgets.append(int(request.headers[service_a_client.DEADLINE_HEADER]))
+        return httpx.Response(200, json={"items": [], "next_cursor": None})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        response = client.get("/proxy-items/count", headers={"X-Deadline-Ms": "300"})
+
+    assert response.status_code == 200
+    assert 0 < budgets[0] <= 300
+
+def test_spent_deadline_is_answered_without_calling_service_a():
+    """Test that requests arriving with no budget left get a deadline 504, and late failures become one"""
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        await asyncio.sleep(0.05)  # Answers after the budget ran out
+        return httpx.Response(504, headers={service_a_client.DEADLINE_EXCEEDED_HEADER: "true"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        spent = client.get("/proxy-items/count", headers={"X-Deadline-Ms": "0"})
+        assert calls == []
+        late = client.get("/proxy-items/count", headers={"X-Deadline-Ms": "10"})
+
+    assert spent.status_code == 504
+    assert spent.headers["X-Deadline-Exceeded"] == "true"
+    assert late.status_code == 504
+    assert late.headers["X-Deadline-Exceeded"] == "true"
+
+def test_client_disconnect_cancels_the_upstream_call():
+    """Test that the call to Service A is cancelled when Service B's own client goes away"""
+    events = []
+
+    async def handler(request):
+        events.append("sent")
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+        return httpx.Response(200, json={"items": [], "next_cursor": None})
+
+    async def run():
+        sent = []
+
+        async def receive():
+            while "sent" not in events:
+                await asyncio.sleep(0.001)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": "/proxy-items/count", "raw_path": b"/proxy-items/count",
+            "root_path": "", "query_string": b"", "headers": [], "client": ("test", 1), "server": ("test", 80),
+        }
+        await asyncio.wait_for(app(scope, receive, send), 2)
+        return sent
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        sent = asyncio.run(run())
+
+    assert events == ["sent", "cancelled"]
+    assert sent[0]["status"] == 499
+    # Giving up says nothing about Service A's health
+    assert service_a_client.breaker.failures == 0
+
+def test_reads_are_served_from_the_replica():
+    """Test that the replica follows the change feed and serves reads while it is fresh"""
+    calls = []
+    feed = [{"seq": 3, "id": 1, "value": "renamed item"}, {"seq": 4, "id": 2, "value": None}]
+
+    def handler(request):
+        calls.append(request.url.path)
+        if request.url.path == "/items":
+            return httpx.Response(200, json={"items": [
+                {"id": 1, "value": "test item 1"}, {"id": 2, "value": "test item 2"},
+            ], "next_cursor": None})
+        if request.url.path == "/items/changes":
+            since = request.url.params.get("since")
+            if since is None:
+                return httpx.Response(200, json={"changes": [], "last_seq": 2})
+            changes = [change for change in feed if change["seq"] > int(since)]
+            return httpx.Response(200, json={"changes": changes, "last_seq": 4})
+        return httpx.Response(200, json={"id": 3, "value": "new item"})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared), patch("app.client.SERVICE_B_REPLICA", True):
+        # Not loaded yet: reads go to Service A
+        assert client.get("/proxy-items/count").status_code == 200
+        asyncio.run(service_a_client.poll_replica())
+        assert client.get("/replica/stats").json()["seq"] == 4
+
+        calls.clear()
+        items = client.get("/proxy-items").json()["items"]
+        assert [item["value"] for item in items] == ["renamed item"]
+        assert client.get("/proxy-items/search", params={"q": "RENAMED"}).json()["items"][0]["id"] == 1
+        assert client.get("/proxy-items/count").json() == 1
+        assert client.get("/proxy-items/batch", params={"ids": "1"}).json()["items"][0]["value"] == "renamed item"
+        assert calls == []
+
+        # Items the replica does not have yet are asked from Service A
+        assert client.get("/proxy-items/3").json()["value"] == "new item"
+        assert calls == ["/items/3"]
+
+        # Too far behind: back to Service A
+        service_a_client.replica.mark_synced(service_a_client.replica.synced_at - 60)
+        service_a_client.cache.clear()
+        calls.clear()
+        client.get("/proxy-items/count")
+        assert calls == ["/items/count"]
+
+def test_replica_is_reloaded_when_the_feed_is_gone():
+    """Test that a 410 from the change feed makes the replica load all items again"""
+    reloads = []
+
+    def handler(request):
+        if request.url.path == "/items":
+            reloads.append(True)
+            return httpx.Response(200, json={"items": [{"id": 1, "value": "item"}], "next_cursor": None})
+        if "since" in request.url.params:
+            return httpx.Response(410, json={"detail": "Gone"})
+        return httpx.Response(200, json={"changes": [], "last_seq": 7})
+
+    shared = service_a_client.create_client(transport=httpx.MockTransport(handler))
+    with patch("app.client._client", shared):
+        asyncio.run(service_a_client.poll_replica())
+        assert service_a_client.replica.seq is None
+        assert not service_a_client.replica.fresh(60)
+        asyncio.run(service_a_client.poll_replica())
+
+    assert len(reloads) == 2
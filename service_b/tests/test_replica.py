@@ -0,0 +1,67 @@
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.replica import Replica
+
+class FakeClock:
+    """Clock that only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_load_and_apply_changes():
+    """Test that changes update, delete and add items in feed order"""
+    replica = Replica()
+    replica.load([{"id": 2, "value": "b"}, {"id": 1, "value": "a"}], seq=5)
+    replica.apply([
+        {"seq": 6, "id": 1, "value": "a2"},
+        {"seq": 7, "id": 3, "value": "c"},
+        {"seq": 8, "id": 2, "value": None},
+        {"seq": 9, "id": 4, "value": None},  # Created and deleted before the load
+    ], last_seq=9)
+
+    assert replica.seq == 9
+    assert replica.all_items() == [{"id": 1, "value": "a2"}, {"id": 3, "value": "c"}]
+    assert replica.get(2) is None
+    assert replica.get(3) == {"id": 3, "value": "c"}
+
+def test_search_matches_substrings_case_insensitively():
+    """Test that the trigram index finds substrings like Service A's search, in ID order"""
+    replica = Replica()
+    replica.load([
+        {"id": 3, "value": "Apple pie"},
+        {"id": 1, "value": "pineapple"},
+        {"id": 2, "value": "banana"},
+    ], seq=0)
+
+    assert [item["id"] for item in replica.search("APPLE")] == [1, 3]
+    assert [item["id"] for item in replica.search("pie")] == [3]
+    # Shorter than a trigram: every item is checked
+    assert [item["id"] for item in replica.search("an")] == [2]
+    assert replica.search("cherry") == []
+
+    # Updated values are indexed again
+    replica.apply([{"seq": 1, "id": 2, "value": "apple juice"}], last_seq=1)
+    assert [item["id"] for item in replica.search("apple")] == [1, 2, 3]
+    assert replica.search("banana") == []
+
+def test_lag():
+    """Test that the lag grows from the last time the replica was known to be caught up"""
+    clock = FakeClock()
+    replica = Replica(clock=clock)
+    assert replica.lag() is None
+    assert not replica.fresh(10)
+
+    replica.mark_synced(clock())
+    clock.now = 3
+    assert replica.lag() == 3
+    assert replica.fresh(5)
+    assert not replica.fresh(2)
+
+    replica.clear()
+    assert not replica.fresh(10)
@@ -0,0 +1,87 @@
+import random
+import sys
+import os
+
+# Add the parent directory to sys.path to allow imports from the app package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.resilience import CircuitBreaker, LatencyTracker, backoff_delay
+
+class FakeClock:
+    """Clock that only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_breaker_opens_after_consecutive_failures():
+    """Test that the circuit opens after the threshold and fails fast until the reset timeout"""
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+
+    breaker.record(False)
+    breaker.record(True)  # A success resets the count
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now = 10
+    assert breaker.allow()  # The trial call
+    assert not breaker.allow()  # Only one at a time
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+def test_breaker_reopens_when_trial_fails():
+    """Test that a failed trial call opens the circuit again"""
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record(False)
+
+    clock.now = 10
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 15
+    assert not breaker.allow()
+
+def test_breaker_ignores_abandoned_calls():
+    """Test that a cancelled trial call frees the slot without closing or opening the circuit"""
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record(False)
+    clock.now = 10
+    assert breaker.allow()
+    breaker.record(None)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+def test_disabled_breaker_always_allows():
+    """Test that a threshold of 0 disables the breaker"""
+    breaker = CircuitBreaker(failure_threshold=0, reset_timeout=10)
+    for _ in range(10):
+        breaker.record(False)
+    assert breaker.allow()
+
+def test_latency_tracker_percentile():
+    """Test that the threshold is the percentile of recent latencies, once there are enough"""
+    tracker = LatencyTracker(percentile=90, min_samples=10, refresh_every=1)
+    for latency in range(1, 10):
+        tracker.observe("get_item", latency / 100)
+    assert tracker.threshold("get_item") is None
+    tracker.observe("get_item", 0.10)
+    assert tracker.threshold("get_item") == 0.10
+    assert tracker.threshold("count_items") is None
+
+    assert LatencyTracker(percentile=0).threshold("get_item") is None
+
+def test_backoff_delay_is_jittered_and_capped():
+    """Test that backoff grows exponentially up to the cap"""
+    rng = random.Random(0)
+    delays = [backoff_delay(attempt, 0.1, 0.3, rng) for attempt in (1, 2, 3, 4) for _ in range(50)]
+    assert all(0 <= delay <= 0.3 for delay in delays)
+    assert max(delays[:50]) <= 0.1
+    assert max(delays[150:]) > 0.2